@@ -2,42 +2,126 @@
 
 import os
 import asyncio
-import aiohttp
 import json
 import csv
 import datetime
+import logging
 from pathlib import Path
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
 from speechkit import init_tts_manager, get_tts_manager
+from safety import find_dangerous_word, warm_up as warm_up_safety
+from stats_store import UserStatsStore, TaleRollups, TALE_FIELDS, parse_stats_range
+from stats_writer import StatsWriter
+from http_client import create_session
+from metrics import metrics, start_metrics_server
+from audio_cache import AudioCache
+from moderation_cache import ModerationCache
+from sessions import SessionStore, PrivacyStore, SessionPreloadMiddleware
+from scheduler import Scheduler, scheduler_settings, QueueFull, AlreadyRunning
+from resilience import get_upstream, raise_for_status, CircuitOpen
+from prompts import build_story_messages, build_moderation_messages, MODERATION_PROMPT_VERSION
+from fallback_stories import fallback_story, without_free_text
+from webhook import bot_mode, UpdateDeduplicator, run_webhook
+from workers import worker_settings, run_front
+from logs import setup_logging, CorrelationMiddleware
+from ratelimit import RateLimitMiddleware
 
 load_dotenv()
+setup_logging()						#JSON-логи в stdout через отдельный поток
+log = logging.getLogger("bot")
 
 #Конфигурация
+BOT_MODE = bot_mode()					#polling, webhook или worker (см. webhook.py)
+WORKERS = worker_settings()["workers"]			#Больше одного - принимающий процесс и обработчики (см. workers.py)
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")	#Можно заменить заглушкой для нагрузочных тестов
 
-bot=Bot(token=TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+#Потоковая генерация: сказка появляется в сообщении по мере написания
+STORY_STREAMING = os.getenv("STORY_STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))	#Не чаще одного редактирования за N секунд
+
+#Генерация сказки запускается одновременно с модерацией; при отказе модерации результат отбрасывается.
+#Упреждающий запрос занимает отдельное место DeepSeek в планировщике (без свободного места не запускается).
+#Важнее STORY_STREAMING: готовая упреждающая сказка отправляется целиком, потоковый вывод - только без нее
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "0") == "1"
+
+#Упреждающая озвучка: синтез в наиболее вероятном голосе начинается сразу после отправки сказки
+SPECULATIVE_TTS = os.getenv("SPECULATIVE_TTS", "0") == "1"
+SPECULATIVE_TTS_TTL = float(os.getenv("SPECULATIVE_TTS_TTL", "600"))	#Через сколько секунд неиспользованный результат удаляется
+
+#Планировщик запросов: лимиты одновременных задач и очереди для DeepSeek и SpeechKit
+#(переменные DEEPSEEK_CONCURRENCY, DEEPSEEK_QUEUE, SPEECHKIT_CONCURRENCY, SPEECHKIT_QUEUE)
+scheduler = Scheduler(scheduler_settings())
 
-'''Хранение данных пользователя'''
-user_data = {}
+#Общие сессии с пулом соединений к DeepSeek и SpeechKit (создаются в main)
+deepseek_session = None
+speechkit_session = None
 
-'''Хранение статуса согласия пользователя с политикой конфе-ти и условиям использования'''
-user_privacy_status = {}
+#Адрес Bot API можно заменить (локальный сервер Bot API или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+#Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics; 0 - выключено.
+#Обработчик i (WORKERS > 1) отдает свои метрики на METRICS_PORT + 1 + i
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+bot=Bot(token=TELEGRAM_TOKEN,
+	session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)),
+	default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+dp = Dispatcher()
+dp.update.outer_middleware(CorrelationMiddleware())	#request_id и user_id в каждой записи лога
+dp.update.outer_middleware(UpdateDeduplicator())	#Повторно доставленные обновления не обрабатываются
 
 #Создание папки data для хранения статистики если она не существует
-DATA_DIR = "/bot/data"
+DATA_DIR = os.getenv("DATA_DIR", "/bot/data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
+SESSIONS_DB = os.path.join(DATA_DIR,"sessions.sqlite3")
+
+'''Хранение данных пользователя (анкеты сохраняются в SQLite и переживают перезапуск)'''
+user_data = SessionStore(SESSIONS_DB,
+			 ttl = float(os.getenv("SESSION_TTL", str(24 * 3600))),
+			 max_cached = int(os.getenv("SESSION_CACHE_SIZE", "1000")),
+			 on_expire = lambda user_id: cancel_speculative_tts(user_id, "expired"))
+
+'''Хранение статуса согласия пользователя с политикой конфе-ти и условиям использования (бессрочно)'''
+user_privacy_status = PrivacyStore(SESSIONS_DB)
+
+#Шаги, после которых запускается генерация сказки или озвучка
+EXPENSIVE_STEPS = ("gender", "voice_choice")
+
+def rate_limit_kind(message: Message) -> str:
+   '''Вид сообщения для ограничения частоты: команда, шаг анкеты или дорогое действие.
+   Анкета берется только из памяти: middleware работает в цикле событий и не читает базу.
+   Вытесненная из памяти анкета считается обычным шагом'''
+   if (message.text or "").startswith("/"):
+      return "command"
+   session = user_data.cached(message.from_user.id)
+   if session and session.get("step") in EXPENSIVE_STEPS:
+      return "expensive"
+   return "step"
+
+#Лимиты на пользователя задаются в RATE_LIMITS (см. ratelimit.py)
+dp.update.outer_middleware(RateLimitMiddleware(rate_limit_kind))
+dp.update.outer_middleware(SessionPreloadMiddleware(user_data))	#Анкета читается из базы вне цикла событий
+
 """++++++++++++++СТАТИСТИКА++++++++++++++"""
-STATS_FILE = os.path.join(DATA_DIR,"user_stats.csv")
-TALE_STATS_FILE = os.path.join(DATA_DIR,"tale_stats.csv")
+STATS_FILE = os.path.join(DATA_DIR,"user_stats.csv")		#Старый формат, импортируется в STATS_DB при первом запуске
+STATS_DB = os.path.join(DATA_DIR,"stats.sqlite3")
+TALE_STATS_FILE = os.path.join(DATA_DIR,"tale_stats.csv")		#Строки за последние TALE_STATS_RETENTION_DAYS дней, старые - в архивах .csv.gz
+
+#Кэш озвучки: одинаковый текст и голос не синтезируются и не загружаются повторно
+AUDIO_CACHE_DIR = os.path.join(DATA_DIR,"audio_cache")
+audio_cache = AudioCache(AUDIO_CACHE_DIR, int(os.getenv("AUDIO_CACHE_MAX_MB", "200")) * 1024 * 1024)
 
 AGE_GROUP_NAMES = {"1":"1-2 года",
    		   "2":"3-5 лет",
@@ -46,63 +130,40 @@ AGE_GROUP_NAMES = {"1":"1-2 года",
 #Инициализация файлов статистики
 def init_stats_files():			
    
-   #Файл статистики пользователей
-   if not Path(STATS_FILE).exists():			#Проверка существует файл или нет
-      with open(STATS_FILE, 'w', newline = '', encoding = 'utf-8') as f:
-         writer = csv.writer(f)				#Создать новый файл, если он не найден
-         
-         writer.writerow(['user_id', 'username','first_name', 'last_name',
-		 'first_seen', 'last_seen', 'tales_generated'])	#Записать строку заголовков
-
    #Файл статистики сказок
    if not Path(TALE_STATS_FILE).exists():		#Проверка существует файл или нет
       with open(TALE_STATS_FILE, 'w', newline = '', encoding = 'utf-8') as f:
          writer = csv.writer(f)				#Создать новый файл, если он не найден
 
-         writer.writerow(['timestamp', 'user_id', 'age_group',
-		 'genre', 'style','location', 'hero',
-		 'enemy', 'child_name', 'gender',
-		 'audio_requested', 'voice_type'])	#Записать строку заголовков
+         writer.writerow(TALE_FIELDS)			#Записать строку заголовков
+
+init_stats_files()		#Инициализация файлов статистики при запуске
+
+#Статистика пользователей хранится в SQLite с ключом user_id
+user_store = UserStatsStore(STATS_DB, STATS_FILE, TALE_STATS_FILE)
+
+#Агрегаты для /stats по часам, дням и за все время обновляются при записи, а не пересчитываются по CSV.
+#Процессы-обработчики пишут их в общую базу, каждый - свои строки
+tale_rollups = TaleRollups(STATS_DB, TALE_STATS_FILE)
+
+#Обработчики только ставят записи в очередь, на диск их пишет фоновая задача
+stats_writer = StatsWriter(TALE_STATS_FILE, user_store, tale_rollups,
+			   batch_size = int(os.getenv("STATS_BATCH_SIZE", "100")),
+			   flush_interval = float(os.getenv("STATS_FLUSH_INTERVAL", "2.0")),
+			   retention_days = int(os.getenv("TALE_STATS_RETENTION_DAYS", "7")),
+			   archive_days = int(os.getenv("TALE_STATS_ARCHIVE_DAYS", "365")),
+			   hourly_days = int(os.getenv("TALE_STATS_HOURLY_DAYS", "30")))
 		 
 #Обновление статистики пользователя
 def update_user_stats(user: types.User):
-   user_id = user.id
-   username = user.username or "N/A"
-   first_name = user.first_name or "N/A"
-   last_name = user.last_name or "N/A"
    current_time = datetime.datetime.now().isoformat()	#Получение даты и прео-е в строку
-
-   #Читаем существующую статистику
-   users = {}
-   if Path(STATS_FILE).exists():
-      with open(STATS_FILE, 'r', newline = '', encoding = 'utf-8') as f:
-         reader = csv.DictReader(f)	#DictReader исп-ет 1-ю строку ф-ла, как заголовки столбцов
-         for row in reader:		#Пройти по строкам
-            users[row['user_id']] = row	#Сохраняем данные пользователя в словарь users
-
-   #Обновляем данные пользователя
-   if str(user_id) in users:
-      users[str(user_id)]['last_seen'] = current_time
-      users[str(user_id)]['tales_generated'] = str(int(users
-      [str(user_id)].get('tales_generated', 0)) + 1)
-   else:
-      users[str(user_id)] = {'user_id': str(user_id),
-      			'username': username,
-      			'first_name': first_name,
-      			'last_name': last_name,
-      			'first_seen': current_time,
-      			'last_seen': current_time,
-      			'tales_generated': '1'}
-      			
-   #Записываем обновленные данные
-   with open(STATS_FILE, 'w', newline = '', encoding = 'utf-8') as f:
-      writer = csv.DictWriter(f, fieldnames = 
-      		['user_id', 'username', 'first_name',
-      		 'last_name', 'first_seen', 'last_seen',
-      		 'tales_generated'])
-      writer.writeheader()
-      for user_data in users.values():
-         writer.writerow(user_data)
+   
+   #Запись по user_id выполняет фоновая задача stats_writer
+   stats_writer.touch_user(user.id,
+   			   user.username or "N/A",
+   			   user.first_name or "N/A",
+   			   user.last_name or "N/A",
+   			   current_time)
          
 #Запись статистики сказки
 def log_tale_generation(user_id, tale_data):
@@ -110,19 +171,20 @@ def log_tale_generation(user_id, tale_data):
    audio_requested = "yes" if tale_data.get("audio_requested", False) else "no"
    voice_type = tale_data.get("voice_type", "N/A")
    
-   with open(TALE_STATS_FILE, 'a', newline = '', encoding='utf-8') as f:
-      writer = csv.writer(f)			#создание объекта writer для записи данных в файл
-      writer.writerow([timestamp, user_id, 		#Время генерации сказки, id пользователя
-      			 tale_data.get('age', 'N/A'),	#Возрастная группа
-      			 tale_data.get('genre', 'N/A'),	
-      			 tale_data.get('style', 'N/A'),
-      			 tale_data.get('location', 'N/A'),
-      			 tale_data.get('hero', 'N/A'),
-      			 tale_data.get('enemy', 'N/A'),
-      			 tale_data.get('child_name', 'N/A'),
-      			 tale_data.get('gender', 'N/A'),
-      			 audio_requested,
-      			 voice_type])
+   row = [timestamp, user_id, 			#Время генерации сказки, id пользователя
+   	  tale_data.get('age', 'N/A'),		#Возрастная группа
+   	  tale_data.get('genre', 'N/A'),	
+   	  tale_data.get('style', 'N/A'),
+   	  tale_data.get('location', 'N/A'),
+   	  tale_data.get('hero', 'N/A'),
+   	  tale_data.get('enemy', 'N/A'),
+   	  tale_data.get('child_name', 'N/A'),
+   	  tale_data.get('gender', 'N/A'),
+   	  audio_requested,
+   	  voice_type]
+   
+   #Строка попадет в CSV и в агрегаты /stats при очередном сбросе очереди
+   stats_writer.log_tale(row)
       			 	
 #Команда для просмотра статистики (ТОЛЬКО ДЛЯ АДМИНИСТРАТОРА!!!)
 ADMIN_IDS = [691555291]
@@ -133,49 +195,39 @@ async def command_stats(message: Message):
       await message.answer("У вас нет прав для просмотра этих данных.")
       return
       
-   #Статистика пользователей
-   total_users = 0
-   total_tales = 0
-   
-   if Path(STATS_FILE).exists():		#Проверка сущестрования файла
-      with open(STATS_FILE, 'r', newline = '', encoding='utf-8') as f:
-         reader = csv.DictReader(f)	#DictReader исп-ет 1-ю строку ф-ла, как заголовки столбцов
-         for row in reader:		#Пройти по каждой строке (каждому пользователю)
-            total_users +=1		#Увели-е счетчика пользователей на 1 для каждой строки
-            total_tales += int(row.get('tales_generated', 0))	#Добавле-е кол-ва сказок этого пользо-ля к общему счетчику
-               
-   #Статистика по сказкам
-   age_stats = {}
-   genre_stats = {}
-   audio_stats = {}			#Статистика озвучки
-   voice_stats = {}			#Статистика голосов
-   
-   if Path(TALE_STATS_FILE).exists():
-      print(f"📊 Чтение файла статистики сказок: {TALE_STATS_FILE}")
-      with open(TALE_STATS_FILE, 'r', newline = '', encoding='utf-8') as f:
-         reader = csv.DictReader(f)
-         row_count = 0
-         for row in reader:
-            row_count +=1
-            age = row.get('age_group', 'N/A')
-            genre = row.get('genre', 'N/A')
-            audio_requested = row.get('audio_requested', 'no')
-            voice_type = row.get('voice_type', 'N/A')
-            print(f"📖 Сказка {row_count}: audio_requested = '{audio_requested}', voice_type = '{voice_type}'")
-            
-            age_stats[age] = age_stats.get(age, 0) + 1
-            genre_stats[genre] = genre_stats.get(genre, 0) + 1
-            audio_stats[audio_requested] = audio_stats.get(audio_requested, 0) + 1
-            if voice_type != 'N/A':
-               voice_stats[voice_type] = voice_stats.get(voice_type, 0) + 1
-         print(f"📊 Итоги: всего сказок = {row_count}, audio_stats = {audio_stats}, voice_stats = {voice_stats}")
+   #Период: /stats, /stats 7d, /stats 24h, /stats 2026-10-01 2026-10-15
+   try:
+      period, start, end, period_name = parse_stats_range(message.text.partition(" ")[2],
+      							  hourly_days = stats_writer.hourly_days)
+   except ValueError:
+      await message.answer("Не удалось разобрать период. Примеры: /stats, /stats 7d, /stats 24h, "
+      			   "/stats 2026-10-01 2026-10-15")
+      return
+   
+   #Статистика пользователей и сказок из агрегатов по часам и дням
+   stats = await asyncio.to_thread(tale_rollups.summary, period, start, end)
+   age_stats = stats.get("age_group", {})
+   genre_stats = stats.get("genre", {})
+   style_stats = stats.get("style", {})
+   audio_stats = stats.get("audio_requested", {})		#Статистика озвучки
+   voice_stats = stats.get("voice_type", {})			#Статистика голосов
+   voice_stats.pop("N/A", None)
                
    #Формируем отчет
-   report = f"""
+   if period == "all":
+      total_users, total_tales = await asyncio.to_thread(user_store.totals)
+      report = f"""
 📊 Статистика бота:\n
 👥 Всего пользователей: {total_users}
 📖 Всего сгенерировано сказок: {total_tales}
 🎧 Всего озвучено сказок: {audio_stats.get('yes', 0)}\n"""
+   else:
+      new_users = await asyncio.to_thread(user_store.new_users, start, end)
+      report = f"""
+📊 Статистика бота {period_name}:\n
+👥 Новых пользователей: {new_users}
+📖 Сказок: {stats.get('tales', {}).get('', 0)}
+🎧 Озвучено сказок: {audio_stats.get('yes', 0)}\n"""
    if voice_stats:
       report += f"\nТип голоса:\n"
       for voice_type, count in sorted(voice_stats.items(),
@@ -193,6 +245,11 @@ async def command_stats(message: Message):
    for genre, count in list(sorted(genre_stats.items(),
    key = lambda x: x[1], reverse = True))[:5]:
       report += f" • {genre}: {count}\n"  
+   
+   report += "\nПопулярные стили:\n"
+   for style, count in list(sorted(style_stats.items(),
+   key = lambda x: x[1], reverse = True))[:5]:
+      report += f" • {style}: {count}\n"
       
    await message.answer(report)
 
@@ -320,93 +377,8 @@ async def command_terms(message: Message):
    			disable_web_page_preview=True)			#Отключение превью ссылки, чтобы польз-ль увидел торлько короткое сообщение
 
 '''!!!Проверка контента на безопасность!!!'''
-#Быстрая проверка по черному списку
-def safety_check(text: str) -> bool:
-   #Нормализуем текст: замена английских букв на русские в похожих словах
-   def normalize_text(text: str) -> str:
-      replacements = {'a': 'а', 'e': 'е', 'o': 'о', 'p': 'р', 'c': 'с', 'x': 'х',
-      		      'y': 'у', 'k': 'к', 'm': 'м', 'h': 'н', 'b': 'в', 't': 'т'}
-      normalized = text.lower()
-      for eng, rus in replacements.items():
-         normalized = normalized.replace(eng, rus)
-      return normalized
-   dangerous_words = [
-   			# === ПОЛИТИКА И ГОСУДАРСТВО ===
-        		# Должности
-        		'президент', 'премьер', 'министр', 'губернатор', 'мэр', 'депутат',
-        		'сенатор', 'политик', 'чиновник', 'администрация', 'правительство',
-        	 	'парламент', 'правитель', 'власть', 'государство',
-        	 	'глава',
-   			#Политические термины
-        		'выборы', 'голосование', 'избиратель', 'партия', 'оппозиция',
-        		'революция', 'митинг', 'протест', 'демонстрация', 'закон',
-        		'конституция', 'бюллетень', 'пропаганда', 'агитация',
-   			
-   			# === ИЗВЕСТНЫЕ ПОЛИТИКИ ===
-        		#Российские
-        		'путин', 'медведев', 'мишустин', 'собянин', 'жириновский',
-        		'зюганов', 'навальный', 'песков', 'лавров', 'шойгу', 'белоусов'
-        
-        		#Украинские
-        		'зеленский', 'порошенко', 'янукович', 'тимошенко',
-        
-        		#Международные
-        		'трамп', 'байден', 'обама', 'макрон', 'меркель',
-        		'лукашенко', 'эрдоган', 'моди',
-   			
-   			# === КОНФЛИКТЫ И ВОЙНА ===
-        		'война', 'конфликт', 'сражение', 'битва', 'военный', 'армия',
-        		'солдат', 'офицер', 'генерал', 'пушка', 'оружие',
-        		'бомба', 'взрыв', 'стрельба', 'атака', 'оборона', 'фронт',
-        		'окоп', 'пленных', 'убить', 'убийство', 'убив' 'смерть', 'труп',
-        
-        		# === НАСИЛИЕ И АГРЕССИЯ ===
-        		'насилие', 'жестокость', 'агрессия', 'избиение', 'пытка',
-        		'истязание', 'мучение', 'страдание', 'боль', 'кровь',
-        		'рана', 'увечье', 'травма', 'нож', 'пистолет', 'автомат',
-        		'граната', 'мина', 'снаряд',
-        
-        		# === НЕЦЕНЗУРНАЯ ЛЕКСИКА ===
-        		'хуй', 'пизд', 'ебан', 'ебать', 'бляд', 'блять', 'хер',
-        		'мудак', 'говно', 'дерьмо', 'залуп', 'манда', 'пидр', 'пидор',
-        		'пидар', 'гондон', 'гандон', 'шлюх', 'шлюш', 'дрищ', 'даун',
-        		'дебил', 'дибил', 'тупица',
-        		
-        		# === ОПАСНОЕ ПОВЕДЕНИЕ ===
-        		'наркотик', 'героин', 'кокаин', 'марихуана', 'гашиш', 'гошиш',
-        		'алкоголь', 'водка', 'пиво', 'вино', 'пьяный', 'алкаш', 'драл',
-        		'самоубийство', 'суицид', 'вешаться', 'резать', 'отравление',
-        
-        		# === ЭКСТРЕМИЗМ И СЕКТЫ ===
-        		'террор', 'экстреми','экстрими' 'исламист', 'сатанизм', 'секта',
-        		'оккультизм', 'колдовство', 'шаман', 'дьявол',
-        		'сатана', 'демон', 'ислам', 'религия', 'бог', 'аллах',
-        
-        		# === ДИСКРИМИНАЦИЯ ===
-        		'нацист', 'фашист', 'расист', 'ксенофоб', 'гомофоб',
-        		'шовинизм', 'национал', 'еврей', 'цыган', 'кавказ',
-        
-        		# === ЭРОТИКА И ПОРНО ===
-        		'порно', 'секс', 'интим', 'оргазм', 'сперма', 'вагина',
-        		'пенис', 'грудь', 'сиськи', 'сися', 'попа', 'жопа', 'трах', 'пися',
-        		'писька','писюн', 'ебля', 'сексуальный', 'эротика', 'голый', 'нагой',
-        		'гомосек', 'презерват', 'призерват','призирват', 'проститут', 'лисби', 'лисбу',
-        
-        		# === ОПАСНЫЕ МЕСТА И СИТУАЦИИ ===
-        		'тюрьма', 'зона', 'заключение', 'арест', 'суд', 'следователь',
-        		'полиция', 'ментов', 'уголовник', 'преступник', 'бандит',
-        		'мафия', 'наркоторговля', 'проститу', 'сутенер'
-    			]
-   
-   #Нормализуем текст (заменяем английские буквы на русские)
-   normalized_text = normalize_text(text)
-   
-   #Проверяем по черному списку
-   for words in dangerous_words:
-      if words in normalized_text:
-         return False
-   return True
-      
+#Черный список и быстрая проверка вынесены в safety.py
+
 '''Клавиатуры для разных шагов'''
 def get_age_keyboard():							#Кнопки для выбора возраста
    buttons = [[KeyboardButton(text ="1-2 года"),
@@ -442,8 +414,6 @@ def get_style_keyboard():						#Кнопки для выбора стиля
    	     KeyboardButton(text = "скандинавский")]]
    return ReplyKeyboardMarkup(keyboard = buttons, resize_keyboard = True)
 
-init_stats_files()		#Инициализация файлов статистики при запуске
-
 def get_gender_keyboard():						#Кнопки для выбора пола ребенка
    buttons = [[KeyboardButton(text ="мальчик"),
    	     KeyboardButton(text = "девочка")]]
@@ -482,6 +452,7 @@ async def command_start(message:Message):
    else:
       #Повторный запуск - сразу начинаем создание сказки     
       user_data[message.from_user.id] = {"step": "age"}		#Сброс данных пользователя при каждом новом старте
+      cancel_speculative_tts(user_id, "abandoned")		#Озвучка предыдущей сказки больше не нужна
    
       update_user_stats(message.from_user)	#Обновляем статистику пользователя при запуске
 
@@ -515,7 +486,11 @@ async def process_inform(message:Message):
       return
    current_step = user_data[user_id].get("step")
    
-   if not safety_check(message.text):				#Проверка на запретный контент
+   with metrics.timer("stage_duration_seconds", stage = "safety_check", age = age_label(user_id)):
+      dangerous_word = find_dangerous_word(message.text)		#Проверка на запретный контент
+   if dangerous_word:
+      metrics.inc("story_outcome_total", outcome = "blocked", age = age_label(user_id))
+      log.info("🚫 Сообщение пользователя %s отклонено: найдено '%s'", user_id, dangerous_word)
       await message.answer("❌ В вашем сообщении содержатся недопустимые элементы.\n"
       			   "Пожалуйста, используйте другие слова или начните заново с команды /start")
       return
@@ -593,31 +568,14 @@ async def process_inform(message:Message):
          user_data[user_id]["gender"] = message.text
          user_data[user_id]["step"] = "moderation"			#Шаг модерации контента на запрещенные слова
          
-         await message.answer("<i>🔍 Проверяю данные на безопасность...</i>")
-         #Проверка через AI модерацию
-         is_approved, feedback = await moderate_content(user_data[user_id])
-         
-         if is_approved:
-            user_data[user_id]["step"] = "audio_choice"
-            await message.answer("<b><i>Отлично! Все данные собраны.\n🔮Генерирую сказку🔮</i></b>", 
-               reply_markup=ReplyKeyboardRemove())
-        
-            #Генерируем сказку
-            story = await generate_story(user_data[user_id])
-            user_data[user_id]["generated_story"] = story		#Сохраняем сказку
-         
-            #Отправляем текстовую версию и предлагаем озвучку
-            await message.answer(story)				#Отправляем текстовую версию сказки
-            await message.answer("\n🎧 <b>Хочешь получить озвученную версию этой сказки?</b>",
-               reply_markup = get_audio_keyboard()) 
-         else:
-            await message.answer(f"<b>❌ К сожалению, введенные данные не прошли проверку безопасности:</b>\n\n"
-            			 f"{feedback}\n\n"
-            			 f"<i>Пожалуйста, начните заново с помощью /start и выберите более подходящие параметры</i>",
-            			    reply_markup=ReplyKeyboardRemove())
-            #Очищаем данные пользователя
-            if user_id in user_data:
-               del user_data[user_id]
+         #Модерация и генерация идут через планировщик: не больше DEEPSEEK_CONCURRENCY одновременно
+         try:
+            async with scheduler.job("deepseek", user_id, notify = queue_notifier(message)):
+               await create_story(message, user_id)
+         except AlreadyRunning:
+            pass							#Сказка для пользователя уже готовится
+         except QueueFull:
+            await serve_fallback_story(message, user_id)		#Готовая сказка по шаблону без ожидания
       else: 
          await message.answer("Пожалуйста выбери пол ребенка из предложенных вариантов", 
                           reply_markup=get_gender_keyboard())
@@ -634,6 +592,9 @@ async def process_inform(message:Message):
          await message.answer("<b><i>Хорошего чтения! Если захочешь, новую сказку - напиши /start</i></b>",
             reply_markup=ReplyKeyboardRemove())
                  
+         #Озвучка не нужна - отменяем упреждающий синтез
+         cancel_speculative_tts(user_id, "cancelled")
+                 
          #Логируем и очищаем данные
          log_tale_generation(user_id, user_data[user_id])
          del user_data[user_id]
@@ -646,318 +607,626 @@ async def process_inform(message:Message):
       if message.text in ["Женский голос", "Мужской голос"]:
          #Определяем тип голоса
          voice_type = "женский" if "Женский" in message.text else "мужской"
-         user_data[user_id]["voice_type"] = voice_type
-         user_data[user_id]["audio_requested"] = True
-         await message.answer(f"💫 <b><i>Создаю аудиоверсию сказки ({voice_type} голос)...</i></b>",
-         reply_markup=ReplyKeyboardRemove())
-   
+         #Повторное нажатие не запускает вторую озвучку той же сказки
          try:
-            #Получаем сохраненную сказку
-            story_text = user_data[user_id].get("generated_story", "")
-            
-            #Получаем TTS менеджер (используем глобальную переменную или функцию)
-            current_tts_manager = tts_manager or get_tts_manager()
-            
-            #Проверяем инициализацию TTS менеджера
-            if not current_tts_manager:
-               await message.answer("⚠️ <b><i>Сервис озвучки временно недоступен. Попробуйте позже.</i></b>")
-               
-               #Логируем даже при ошибке TTS, но отмечаем как без аудио
-               user_data[user_id]["audio_requested"] = False
-               
-               log_tale_generation(user_id, user_data[user_id])
-               del user_data[user_id]
-               return
-            
-            if story_text:
-               #Генерируем аудио с выбором голоса
-               audio_file = await current_tts_manager.text_to_speech(text = story_text.strip(),
-               						     voice_type = voice_type,
-               						     emotion = "good")
-               #Создаем название аудиофайла
-               hero_name = user_data[user_id].get('hero', 'сказка').replace(' ', '_')[:20]	#Ограничиваем длину
-               filename = f"{hero_name}_сказка.mp3"
-               
-               #Читаем данные из BytesIO
-               audio_data = audio_file.getvalue()
-               
-               #Проверяем размер файла: Telegram ограничивает 50MB
-               if len(audio_data) > 50 * 1024 * 1024:
-                  await message.answer("⚠️ <b><i>Аудиофайл слишком большой для отправки в Telegram</i></b>")
-                  
-                  #Логируем как неудачную попытку озвучки
-                  log_tale_generation(user_id, user_data[user_id])
-                  del user_data[user_id]
-                  return
-                                    
-               else:
-                  #Отправляем аудио с обработкой ошибок
-                  try:
-                     await message.answer_audio(audio = types.BufferedInputFile(audio_data,
-               								  filename = filename),
-               								  title = f"Сказка про {user_data[user_id].get('hero', 'героя')}",
-               								  performer = "Генератор сказок",
-               								  caption = f"Аудиоверсия ({voice_type} голос)")
-                     await message.answer("✅ <b><i>Аудиоверсия готова! Приятного прослушивания!</i></b>")
-
-                     #Логируем генерацию сказки в csv файл
-                     log_tale_generation(user_id, user_data[user_id])
-                     print(f"✅ Успешно залогирована озвученная сказка для пользователя {user_id}")
+            async with scheduler.single_flight("speechkit", user_id):
+               await send_audio_version(message, user_id, voice_type)
+         except AlreadyRunning:
+            await message.answer("⏳ <b><i>Аудиоверсия уже создается, подожди немного</i></b>")
+      else:
+         await message.answer("<b><i>Пожалуйста, выбери тип голоса</i></b> 🗣",
+            reply_markup = get_voice_keyboard())
+         return						#Не очищаем данные, если выбор неправильный
+
+def queue_notifier(message: Message):
+   '''Сообщает пользователю его место в очереди, если задача не началась сразу'''
+   async def notify(position):
+      try:
+         await message.answer(f"⏳ <i>Сейчас много желающих, твое место в очереди: {position}</i>")
+      except Exception as e:
+         log.warning("Ошибка отправки места в очереди: %r", e)
+   return notify
+
+async def create_story(message: Message, user_id):
+   '''Модерация анкеты, генерация сказки и предложение озвучки'''
+   await message.answer("<i>🔍 Проверяю данные на безопасность...</i>")
+   
+   #Упреждающая генерация: не ждем окончания модерации
+   story_task = None
+   if SPECULATIVE_GENERATION:
+      story_task = asyncio.create_task(speculative_story(dict(user_data[user_id])))
+   
+   try:
+      #Проверка через AI модерацию
+      age = age_label(user_id)
+      with metrics.timer("stage_duration_seconds", stage = "moderate_content", age = age):
+         is_approved, feedback = await moderate_content(user_data[user_id])
+      metrics.inc("story_outcome_total", outcome = "approved" if is_approved else "rejected", age = age)
+      
+      if is_approved:
+         user_data[user_id]["step"] = "audio_choice"
+         await message.answer("<b><i>Отлично! Все данные собраны.\n🔮Генерирую сказку🔮</i></b>", 
+            reply_markup=ReplyKeyboardRemove())
+     
+         #Сказка уже пишется с начала модерации - замеряем только оставшееся ожидание.
+         #None - упреждающий запрос не запустился (нет места в планировщике)
+         speculative = None
+         if story_task is not None:
+            with metrics.timer("stage_duration_seconds", stage = "generate_story", age = age, mode = "speculative"):
+               speculative = await story_task
+            story_task = None				#Результат забран, отбрасывать нечего
+      
+         #Генерируем сказку и отправляем текстовую версию
+         if speculative is not None:
+            story, usage = speculative
+            metrics.inc("speculative_story_total", result = "used")
+            await answer_story(message, story, age)
+         elif STORY_STREAMING:
+            #Сказка показывается по мере генерации: замеряем все вместе с редактированием сообщения
+            with metrics.timer("stage_duration_seconds", stage = "generate_story", age = age, mode = "stream"):
+               story = await deliver_story_streaming(message, user_data[user_id])
+         else:
+            with metrics.timer("stage_duration_seconds", stage = "generate_story", age = age, mode = "request"):
+               story = await generate_story(user_data[user_id])
+            await answer_story(message, story, age)			#Отправляем текстовую версию сказки
+         user_data[user_id]["generated_story"] = story		#Сохраняем сказку
+      
+         #Предлагаем озвучку
+         await message.answer("\n🎧 <b>Хочешь получить озвученную версию этой сказки?</b>",
+            reply_markup = get_audio_keyboard()) 
          
-                  except Exception as send_error:
-                     print(f"Audio sending error: {send_error}")
-                     await message.answer("⚠️ <b><i>Ошибка при отправке аудио. Попробуйте позже.</i></b>!")
-                     
-                     #Логируем как неудачную попытку озвучки
-                     log_tale_generation(user_id, user_data[user_id])
-                     #Очищаем данные пользователя после обнаружения ошибки
-                     del user_data[user_id]
-                     return      
-            else:
-               await message.answer("⚠️ <b><i>Текст сказки не найден</i></b>!")
-               
-               #Логируем как ошибку
-               user_data[user_id]["audio_requested"] = False
+         #Пока пользователь выбирает, начинаем озвучку в наиболее вероятном голосе
+         if SPECULATIVE_TTS:
+            await start_speculative_tts(user_id, story)
+      else:
+         await reject_story(message, user_id, feedback)
+   finally:
+      #Модерация не пройдена или обработка прервана ошибкой - упреждающая сказка не нужна
+      if story_task is not None:
+         discard_speculative_story(story_task)
+
+def age_label(user_id) -> str:
+   '''Возрастная группа анкеты для меток метрик'''
+   data = user_data.get(user_id)
+   return data.get("age", "none") if data else "none"
+
+async def answer_story(message: Message, story: str, age: str, **kwargs):
+   '''Отправляет текст сказки, замеряя время ответа Telegram'''
+   with metrics.timer("stage_duration_seconds", stage = "answer", age = age):
+      await message.answer(story, **kwargs)
+
+async def reject_story(message: Message, user_id, feedback: str):
+   '''Анкета не прошла модерацию: объясняем причину и очищаем данные'''
+   await message.answer(f"<b>❌ К сожалению, введенные данные не прошли проверку безопасности:</b>\n\n"
+   			f"{feedback}\n\n"
+   			f"<i>Пожалуйста, начните заново с помощью /start и выберите более подходящие параметры</i>",
+   			   reply_markup=ReplyKeyboardRemove())
+   #Очищаем данные пользователя
+   if user_id in user_data:
+      del user_data[user_id]
+
+async def serve_fallback_story(message: Message, user_id):
+   '''Очередь DeepSeek переполнена: сразу отдаем сказку по готовому шаблону.
+   Ответы анкеты попадают в сказку, только если DeepSeek уже одобрил такую же анкету
+   (кэш модерации); без вердикта герой, злодей, место и имя ребенка берутся по умолчанию.
+   Если DeepSeek раньше отклонил такую же анкету - отказываем'''
+   cached = await asyncio.to_thread(moderation_cache.get, user_data[user_id])
+   if cached is not None and not cached[0]:
+      await reject_story(message, user_id, cached[1])
+      return
+
+   age = age_label(user_id)
+   data = user_data[user_id] if cached is not None else without_free_text(user_data[user_id])
+   metrics.inc("story_fallback_total", reason = "queue_full", age = age)
+   metrics.inc("story_outcome_total", outcome = "fallback", age = age)
+   with metrics.timer("stage_duration_seconds", stage = "generate_story", age = age, mode = "fallback"):
+      story = fallback_story(data)
+   user_data[user_id]["step"] = "audio_choice"
+   user_data[user_id]["generated_story"] = story
+   await answer_story(message, story, age, reply_markup=ReplyKeyboardRemove())
+   await message.answer("\n🎧 <b>Хочешь получить озвученную версию этой сказки?</b>",
+      reply_markup = get_audio_keyboard())
+   if SPECULATIVE_TTS:
+      await start_speculative_tts(user_id, story)
+
+async def answer_tale_audio(message: Message, audio, audio_format: str, title: str, caption: str):
+   '''Отправляет озвучку: oggopus - голосовым сообщением, mp3 - аудиофайлом. Возвращает file_id'''
+   if audio_format == "oggopus":
+      sent = await message.answer_voice(voice = audio, caption = caption)
+      return sent.voice.file_id if sent.voice else None
+   sent = await message.answer_audio(audio = audio,
+   				     title = title,
+   				     performer = "Генератор сказок",
+   				     caption = caption)
+   return sent.audio.file_id if sent.audio else None
+
+async def send_audio_version(message: Message, user_id, voice_type: str):
+   '''Озвучивает сохраненную сказку выбранным голосом и отправляет аудио'''
+   user_data[user_id]["voice_type"] = voice_type
+   user_data[user_id]["audio_requested"] = True
+   await message.answer(f"💫 <b><i>Создаю аудиоверсию сказки ({voice_type} голос)...</i></b>",
+   reply_markup=ReplyKeyboardRemove())
+   
+   try:
+      #Получаем сохраненную сказку
+      story_text = user_data[user_id].get("generated_story", "")
+      
+      #Получаем TTS менеджер (используем глобальную переменную или функцию)
+      current_tts_manager = tts_manager or get_tts_manager()
+      
+      #Проверяем инициализацию TTS менеджера
+      if not current_tts_manager:
+         cancel_speculative_tts(user_id, "cancelled")
+         await message.answer("⚠️ <b><i>Сервис озвучки временно недоступен. Попробуйте позже.</i></b>")
+         
+         #Логируем даже при ошибке TTS, но отмечаем как без аудио
+         user_data[user_id]["audio_requested"] = False
+         
+         log_tale_generation(user_id, user_data[user_id])
+         del user_data[user_id]
+         return
+      
+      if story_text:
+         #Создаем название аудиофайла
+         audio_format = current_tts_manager.format_for(story_text.strip())		#mp3 или oggopus
+         hero_name = user_data[user_id].get('hero', 'сказка').replace(' ', '_')[:20]	#Ограничиваем длину
+         filename = f"{hero_name}_сказка.{'ogg' if audio_format == 'oggopus' else 'mp3'}"
+         audio_title = f"Сказка про {user_data[user_id].get('hero', 'героя')}"
+         caption = f"Аудиоверсия ({voice_type} голос)"
+         
+         #Это аудио уже отправлялось в Telegram - пересылаем по file_id без синтеза и загрузки
+         cache_key = current_tts_manager.cache_key(story_text.strip(), voice_type, "good")
+         file_id = await asyncio.to_thread(audio_cache.get_file_id, cache_key)
+         age = age_label(user_id)
+         if file_id:
+            try:
+               with metrics.timer("stage_duration_seconds", stage = "answer_audio", age = age,
+               			  voice = voice_type, source = "file_id", format = audio_format):
+                  await answer_tale_audio(message, file_id, audio_format, audio_title, caption)
+               cancel_speculative_tts(user_id, "cached")
+               await message.answer("✅ <b><i>Аудиоверсия готова! Приятного прослушивания!</i></b>")
                log_tale_generation(user_id, user_data[user_id])
-               #Очищаем данные пользователя после обнаружения ошибки
                del user_data[user_id]
                return
-               
-         except Exception as e:
-            print(f"Audio generation error: {e}")
-            await message.answer("⚠️ <b><i>Произошла ошибка при создании аудиоверсии</i></b>!")
-        
+            except Exception as send_error:
+               log.warning("Audio file_id sending error: %r", send_error)
+               await asyncio.to_thread(audio_cache.set_file_id, cache_key, None)
+         
+         #Берем результат упреждающей озвучки, если голос угадан
+         audio_file = await take_speculative_tts(user_id, voice_type)
+         
+         #Иначе генерируем аудио с выбором голоса
+         if audio_file is None:
+            async with scheduler.job("speechkit", notify = queue_notifier(message)):
+               with metrics.timer("stage_duration_seconds", stage = "text_to_speech",
+               			  age = age, voice = voice_type, mode = "request"):
+                  audio_file = await current_tts_manager.text_to_speech(text = story_text.strip(),
+                  							voice_type = voice_type,
+                  							emotion = "good")
+         
+         #Читаем данные из BytesIO
+         audio_data = audio_file.getvalue()
+         
+         #Проверяем размер файла: Telegram ограничивает 50MB
+         if len(audio_data) > 50 * 1024 * 1024:
+            await message.answer("⚠️ <b><i>Аудиофайл слишком большой для отправки в Telegram</i></b>")
+            
             #Логируем как неудачную попытку озвучки
             log_tale_generation(user_id, user_data[user_id])
-            #Очищаем данные пользователя после обнаружения ошибки
             del user_data[user_id]
             return
-            
-         #Очищаем данные пользователя после успешной генерации
-         if user_id in user_data:
-            del user_data[user_id]
+                              
+         else:
+            #Отправляем аудио с обработкой ошибок
+            try:
+               #Время загрузки в Telegram по форматам (размер аудио - в tts_audio_bytes)
+               with metrics.timer("stage_duration_seconds", stage = "answer_audio", age = age,
+               			  voice = voice_type, source = "upload", format = audio_format):
+                  sent_file_id = await answer_tale_audio(message,
+                  					 types.BufferedInputFile(audio_data, filename = filename),
+                  					 audio_format, audio_title, caption)
+               metrics.inc("audio_upload_bytes_total", len(audio_data), format = audio_format)
+               #Запоминаем file_id для повторной отправки без загрузки
+               if sent_file_id:
+                  await asyncio.to_thread(audio_cache.set_file_id, cache_key, sent_file_id)
+               await message.answer("✅ <b><i>Аудиоверсия готова! Приятного прослушивания!</i></b>")
+
+               #Логируем генерацию сказки в csv файл
+               log_tale_generation(user_id, user_data[user_id])
+               log.info("✅ Успешно залогирована озвученная сказка для пользователя %s", user_id)
+   
+            except Exception as send_error:
+               log.exception("Audio sending error: %r", send_error)
+               await message.answer("⚠️ <b><i>Ошибка при отправке аудио. Попробуйте позже.</i></b>!")
+               
+               #Логируем как неудачную попытку озвучки
+               log_tale_generation(user_id, user_data[user_id])
+               #Очищаем данные пользователя после обнаружения ошибки
+               del user_data[user_id]
+               return      
       else:
-         await message.answer("<b><i>Пожалуйста, выбери тип голоса</i></b> 🗣",
-            reply_markup = get_voice_keyboard())
-         return						#Не очищаем данные, если выбор неправильный
+         cancel_speculative_tts(user_id, "cancelled")
+         await message.answer("⚠️ <b><i>Текст сказки не найден</i></b>!")
+         
+         #Логируем как ошибку
+         user_data[user_id]["audio_requested"] = False
+         log_tale_generation(user_id, user_data[user_id])
+         #Очищаем данные пользователя после обнаружения ошибки
+         del user_data[user_id]
+         return
+         
+   except QueueFull:
+      #Очередь на озвучку переполнена - данные сохраняем, чтобы можно было выбрать голос еще раз
+      await message.answer("⏳ <b><i>Сейчас озвучивается очень много сказок, очередь переполнена.\n"
+      			   "Пожалуйста, выбери голос еще раз через минуту</i></b>",
+      			   reply_markup = get_voice_keyboard())
+      return
+      
+   except Exception as e:
+      log.exception("Audio generation error: %r", e)
+      metrics.inc("tts_errors_total", age = age_label(user_id), voice = voice_type)
+      await message.answer("⚠️ <b><i>Произошла ошибка при создании аудиоверсии</i></b>!")
+  
+      #Логируем как неудачную попытку озвучки
+      log_tale_generation(user_id, user_data[user_id])
+      #Очищаем данные пользователя после обнаружения ошибки
+      del user_data[user_id]
+      return
+      
+   #Очищаем данные пользователя после успешной генерации
+   if user_id in user_data:
+      del user_data[user_id]
 
 '''AI проверка сказки через модерацию контента'''
-async def moderate_content(user_data: dict) -> tuple:
-   """Проверяем корректность введенных данных через AI и формируем краткое объяснение в случае несоответствия веденных данных
-   Возвращает is_approved: bool, feedback: str"""
-   age_mapping = { "1":"1-2 года",
-   		   "2":"3-5 лет",
-   		   "3":"6-8 лет"}
-   #Формируем промт для проверки
-   check_promt = f"""
-ПРОАНАЛИЗИРУЙ следующие данные для детской сказки и определи, безопасны ли они для ребенка:
-ВОЗРАСТ: {age_mapping.get(user_data.get('age', 'N/A'), user_data.get('age', 'N/A'))}
-ЖАНР: {user_data.get('genre', 'N/A')}
-СТИЛЬ: {user_data.get('style', 'N/A')}
-МЕСТО ДЕЙСТВИЯ: {user_data.get('location', 'N/A')}
-ГЛАВНЫЙ ГЕРОЙ: {user_data.get('hero', 'N/A')}
-ЗЛОДЕЙ/ПРОБЛЕМА: {user_data.get('enemy', 'N/A')}
-ИМЯ РЕБЕНКА: {user_data.get('child_name', 'N/A')}
-ПОЛ РЕБЕНКА: {user_data.get('gender', 'N/A')}
-
-ВАЖНО: Это творческие параметры для сказки, а не готовый текст!
-КРИТЕРИИ ПРОВЕРКИ (только явные нарушения):
-1. Реальные насилие, жестокость, агрессия, преступность, опасные формы поведения
-2. Отсутствие эротики, порнографии, педофилии, гомосэксуализма, лисбиянства, интимных отношений, контента сексуального характера
-3. Отсутствие дискриминации, расизма, ксенофобии, религиозных тем, пропоганды опасного поведения
-4. Отсутствие политических тем, лидеров, должностей
-5. Отсутствие упоминания политиков, государственных деятелей, партии, выборы, митинги, протесты, политические движения и идеологии
-6. Отсутствие упоминаний про государственные структуры: правительство, администрация, дума, государственное управление
-7. Отсутствие упоминаний про президентов, министров, губернаторов, мэров, депутатов и другихгосударственных должностных лиц. Медийных персон, связанных с политикой
-8. Отсутствие межнациональных конфликтов и экстремистских материалов любой направленности
-9. Отсутствие военной тематики: войны, оружие, военные конфликты в любых их проявлениях, военные должностные лица и военные деятели, силовики и т.д.
-10. Отсутствие упоминаний и пропоганды алкоголя, наркотиков, курения в любых проявлениях
-11. Отсутствие любых упоминаний про Украину (СВО, Зеленский, конфликт и т.д.)
-12. Отсутствие упоминаний про Россию в негативном ключе, где она выступает как агрессор или враг.
-13. Соответствие детской тематике
-
-ТВОЯ ЗАДАЧА: Разрешать творческие идеи, блокировать только реально опасный контент.
-
-ЕСЛИ ДАННЫЕ БЕЗОПАСНЫ: ответь
-"APPROVED"
-ЕСЛИ ЕСТЬ ПРОБЛЕМЫ: ответь
-"REJECTED" [краткое объяснение проблемы и рекомендация на русском языке]
-"""
-   #Запрос к API DeepSeek
-   headers = {"Content-Type": "application/json",
-   		"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
+def build_moderation_payload(user_data: dict) -> dict:
+   '''Формирует запрос к DeepSeek для проверки данных анкеты (промт - в prompts.py)'''
    #Данные для запроса
    payload = {"model": "deepseek-chat",
-   	      "messages": [{"role": "system",
-   	      "content": "Ты модератор детского контента. Анализируй данные и давай четкий вердикт с объяснением."},
-   	      {"role": "user", "content": check_promt}],
+   	      "messages": build_moderation_messages(user_data),
    	      "temperature": 0.3,
    	      "max_tokens": 200}
-   try:	      
-   #Отправка запроса к API
-      async with aiohttp.ClientSession() as session:
-         async with session.post(DEEPSEEK_API_URL, 
-         headers = headers, json = payload) as response:
-            if response.status == 200:
-               result = await response.json()
-               moderation_result = result["choices"][0]["message"]["content"].strip()
-               
-               if moderation_result.startswith("APPROVED"):
-                  return True, ""						#При успешной проверке возвращяет True
-                  print(f"Результат модерации: {moderation_result}")		#Для контроля и отладки
-               elif moderation_result.startswith("REJECTED"):
-                  feedback = moderation_result.replace("REJECTED:", "").strip()
-                  return False, feedback					#При отрицательной проверке возвращает False и дает пояснение
-                  print(f"Результат модерации: {feedback}")			#Для контроля и отладки
-               else:
-                  return False, "Данные содержат неподходящие элементы для детской сказки"
-            
-            else:
-               error_text = await moderation_result()
-               print(f"Ошибка модерации:{response.status}, {error_text}")
-               return False, "Ошибка проверки безопасности. Попробуйте позже"
-   except Exception as e:
-        print(f"Исключение при модерации: {e}")
-        return False, "Не удалось проверить данные. Попробуйте позже."
+   return payload
 
-'''Генерация сказки'''
-async def generate_story(data):
-   age_mapping = { "1":"1-2 года",
-   		   "2":"3-5 лет",
-   		   "3":"6-8 лет"}
-   		   
-   #Определяем специфические требивания для разных возрастных групп
-   age_specific_instructions = {"1":"""Для возраста 1-2 года создай очень простую сказку в стиле 'Колобок', 'Курочка Ряба', 'Репка' и других похожих русских сказок.
-   Особые требования:
-   - Простой сюжет с минимумом персонажей
-   - Яркие, понятные образы
-   - Обязательный happy end
-   - Добавь элементы, которые можно повторять 
-   (как 'я от дедушки ушел' в Колобке и так далее)
-   - Длина сказки 1500 символов. Обязательно соблюдай эту длину!""",
-   				
-"2":"""Для возраста 3-5 лет:
-   - Простые, но более развернутые предложения
-   - Четкий сюжет с завязкой, развитием и развязкой
-   - Яркие персонажи с понятными характеристиками
-   - Добрый юмор
-   - Длина сказки 2500 символов. Обязательно соблюдай эту длину!""",
-   				
-"3":"""Для возраста 6-8 лет:
-   - Более сложный сюжет с неожиданными поворотами
-   - Развернутые описания персонажей и мест
-   - Может содержать элементы напряжения и их разрешения
-   - Поучительный компонент
-   - Длина сказки 3500 символов. Обязательно соблюдай эту длину!"""}
-   age_instruction = age_specific_instructions.get(data['age'],"")
-   		  
-   promt = f"""
-Создай детскую сказку на русском языке, идеально подходящую для ребенка 
-{age_mapping.get(data['age'], data['age'])}.
-{age_instruction} 
-Жанр -  {data.get('genre', 'добрый')}.
-Стиль сказки - {data.get('style', 'приключения')}.
-Место действия - {data.get('location', 'сказочный лес')}.
-Главный герой - {data.get('hero', 'добрый медвежонок')}.
-Противник или проблема - {data.get('enemy', 'страшный лев')}.
-Вставь имя ребенка {data.get('child_name', 'малыш')} в историю.
-Пол ребенка - {data.get('gender')}.
-Сказка должна быть поучительной, доброй и интересной.
-В заголовке укажи название сказки.
-ВАЖНО: длина сказки не должна превышать 4000 символов!
-ВАЖНО:
-- Используй только кириллицу (русские буквы)!
-- Выводи только название и саму сказку без дополнительных комментариев!
-СТРОГИЕ ЗАПРЕТЫ:
-- Не упоминать реальных политических деятелей.
-- Не упоминать президентов, глав государств, правительств.
-- Не упоминать губернаторов, мэров, депутатов, министров.
-- Не упоминать политические партии, движения.
-- Не использовать реальные имена и фамилии политиков (Путин, Зеленский ,Трамп, Байден, Макрон и другие).
-- Не упоминать государственные должности (президент, министр, депутат, губернатор, мэр).
-- Не затрагивать политические темы, выборы, государственное управление.
-- Не должно быть эротики, порнографии, педофилии, гомосэксуализма, лисбиянства.
-- Не должно быть пропаганды опасного поведения.
-- Не упоминать политические темы, конфликты, войны, СВО, специальную военную операцию.
-- Не упоминать Украину, лидера Зеленского и все что с нини связано.
-- Не затрагивать межнациональные конфликты и напряженности, расизм, дискриминацию, ксенофобию.
-- Не упоминать Россию в негативном ключе, где она выступает как агрессор или враг. 
-- Не должно быть сцен насилия, жестокости, агрессии, страшных описаний, негативных эмоций.
-- Не затрагивать религиозные темы.
-- Не использовать слова (в названии и тексте сказки) губернатор, мер, президент, депутат, министр, политический деятель.
-- Не упоминать имена и фамилии глав государств, политических деятелей, депутатов, губернаторов субъектов РФ, министров РФ, мэров городов РФ. 
-- Не использовать слова ад, преисподняя, дьявол, люцефер, демон, бес и любые склоняемые с ними слова.
-Сказка должна быть абсолютно аполитичной и безопасной для детей!"""
-   
-   print(promt)	
+def record_usage(kind, usage):
+   '''Учитывает токены из usage ответа DeepSeek: сколько входных токенов взято
+   из кэша контекста (prompt_cache_hit_tokens), сколько нет, и сколько сгенерировано'''
+   if not usage:
+      return
+   for field in ("prompt_cache_hit_tokens", "prompt_cache_miss_tokens", "completion_tokens"):
+      metrics.inc("deepseek_tokens_total", usage.get(field, 0), request = kind, type = field)
+
+async def moderate_content(user_data: dict) -> tuple:
+   """Проверяем корректность введенных данных через AI и формируем краткое объяснение в случае несоответствия веденных данных
+   Возвращает is_approved: bool, feedback: str"""
+   #Повторяющиеся анкеты проверяются без запроса к API
+   cached = await asyncio.to_thread(moderation_cache.get, user_data)
+   if cached is not None:
+      return cached
    
    #Запрос к API DeepSeek
    headers = {"Content-Type": "application/json",
    		"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
+   payload = build_moderation_payload(user_data)
+   
+   async def attempt():
+      #Отправка запроса к API через общую сессию
+      async with deepseek_session.post(DEEPSEEK_API_URL, 
+      headers = headers, json = payload) as response:
+         await raise_for_status("DeepSeek", response)
+         result = await response.json()
+         record_usage("moderation", result.get("usage"))
+         return result["choices"][0]["message"]["content"].strip()
+   
+   try:
+      moderation_result = await get_upstream("deepseek").call(attempt)	#С повторами при сбоях
+   except CircuitOpen as e:
+      log.warning("Модерация пропущена: %s", e)
+      return False, "Сервис проверки временно недоступен. Попробуйте через пару минут."
+   except Exception as e:
+      log.error("Исключение при модерации: %r", e)
+      return False, "Не удалось проверить данные. Попробуйте позже."
+   
+   log.info("Результат модерации: %s", moderation_result)			#Для контроля и отладки
+   if moderation_result.startswith("APPROVED"):
+      await asyncio.to_thread(moderation_cache.put, user_data, True, "")
+      return True, ""							#При успешной проверке возвращяет True
+   elif moderation_result.startswith("REJECTED"):
+      feedback = moderation_result.replace("REJECTED:", "").strip()
+      await asyncio.to_thread(moderation_cache.put, user_data, False, feedback)
+      return False, feedback						#При отрицательной проверке возвращает False и дает пояснение
+   else:
+      return False, "Данные содержат неподходящие элементы для детской сказки"
+
+#Кэш вердиктов модерации; при изменении промта старые вердикты сбрасываются
+moderation_cache = ModerationCache(os.path.join(DATA_DIR, "moderation_cache.sqlite3"),
+				   MODERATION_PROMPT_VERSION,
+				   ttl = float(os.getenv("MODERATION_CACHE_TTL", str(7 * 24 * 3600))),
+				   max_entries = int(os.getenv("MODERATION_CACHE_SIZE", "50000")))
+
+'''Генерация сказки'''
+def build_story_payload(data) -> dict:
+   '''Формирует запрос к DeepSeek для генерации сказки (промт - в prompts.py)'''
    #Данные для запроса
    payload = {"model": "deepseek-chat",
-   	      "messages": [{"role": "system",
-   	      "content": "Ты детский писатель, специализирующийся на создании добрых поучительных сказок."},
-   	      {"role": "user", "content": promt}],
+   	      "messages": build_story_messages(data),
    	      "temperature": 0.7,
    	      "max_tokens": 4000}
-   	      
-   #Отправка запроса к API
-   async with aiohttp.ClientSession() as session:
-      async with session.post(DEEPSEEK_API_URL, 
+   return payload
+
+async def request_story(data) -> tuple:
+   '''Генерация сказки одним запросом. Возвращает (текст, usage из ответа API или None)'''
+   #Запрос к API DeepSeek
+   headers = {"Content-Type": "application/json",
+   		"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
+   payload = build_story_payload(data)
+   
+   async def attempt():
+      #Отправка запроса к API через общую сессию
+      async with deepseek_session.post(DEEPSEEK_API_URL, 
       headers = headers, json = payload) as response:
-         if response.status == 200:
-            result = await response.json()
-            story = result["choices"][0]["message"]["content"]
-            return story
-        
-         else:
-            error_text = await response.text()
-            print(f"Ошибка API:{response.status},{error_text}")
-           
-            #Возвращаем заглушку в случае ошибки 
-            generated_story = f"""
-   **Сказка про {data.get('hero', 'храброго героя')}**
+         await raise_for_status("DeepSeek", response)
+         result = await response.json()
+         record_usage("story", result.get("usage"))
+         return result["choices"][0]["message"]["content"], result.get("usage")
    
-   Жил был {data.get('hero', 'добрый медвежонок')}.
-   Однажды случилась беда: 
-   {data.get('enemy', 'страшный лев')} напал на деревню.
+   try:
+      return await get_upstream("deepseek").call(attempt)		#С повторами при сбоях
+   except Exception as e:
+      #Повторы не помогли или сервис недоступен - возвращаем заглушку
+      log.error("Ошибка API: %r", e)
+      metrics.inc("story_fallback_total", reason = "circuit_open" if isinstance(e, CircuitOpen) else "error",
+      		  age = data.get("age", "none"))
+      return fallback_story(data), None
+
+async def generate_story(data):
+   story, usage = await request_story(data)
+   return story
+
+async def speculative_story(data):
+   '''Упреждающая генерация в отдельном месте DeepSeek планировщика, чтобы анкета
+   не занимала два места под одним. Без свободного места возвращает None'''
+   try:
+      async with scheduler.job("deepseek", wait = False):
+         return await request_story(data)
+   except QueueFull:
+      metrics.inc("speculative_story_total", result = "skipped")
+      return None
+
+def discard_speculative_story(story_task: asyncio.Task):
+   '''Сказка не понадобилась: отменяем генерацию или учитываем потраченные впустую токены'''
+   if not story_task.done():
+      story_task.cancel()
+      metrics.inc("speculative_story_total", result = "cancelled")
+      return
+   if story_task.cancelled() or story_task.exception():
+      metrics.inc("speculative_story_total", result = "failed")
+      return
+   if story_task.result() is None:
+      return						#Не запускалась: не было места в планировщике
+   story, usage = story_task.result()
+   metrics.inc("speculative_story_total", result = "discarded")
+   if usage:
+      metrics.inc("speculative_story_wasted_tokens_total", usage.get("prompt_tokens", 0), kind = "prompt")
+      metrics.inc("speculative_story_wasted_tokens_total", usage.get("completion_tokens", 0), kind = "completion")
+
+async def stream_story(data, on_text) -> str:
+   '''Потоковая генерация (stream=True): разбирает SSE-фрагменты DeepSeek
+   и вызывает on_text(текст) с накопленным текстом после каждого фрагмента'''
+   headers = {"Content-Type": "application/json",
+   		"Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
+   payload = build_story_payload(data)
+   payload["stream"] = True
+   payload["stream_options"] = {"include_usage": True}	#Итоговый usage с токенами из кэша контекста
    
-   Маленький {data.get('child_name', 'малыш')} решил помочь!
-   Он собрал всех зверей вместе и победил злодея!
+   async def attempt():
+      #Повторная попытка начинает сказку заново - on_text получит текст с начала
+      story = ""
+      async with deepseek_session.post(DEEPSEEK_API_URL, 
+      headers = headers, json = payload) as response:
+         await raise_for_status("DeepSeek", response)
+         
+         async for raw_line in response.content:		#SSE: строки вида "data: {...}"
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+               continue
+            chunk = line[len("data:"):].strip()
+            if chunk == "[DONE]":
+               break
+            chunk = json.loads(chunk)
+            record_usage("story", chunk.get("usage"))		#usage приходит в последнем фрагменте
+            if not chunk.get("choices"):
+               continue
+            delta = chunk["choices"][0].get("delta", {}).get("content")
+            if delta:
+               story += delta
+               on_text(story)
+      return story
    
-   **Мораль: дружба решает любые проблемы!"""
+   story = await get_upstream("deepseek").call(attempt)
+   if not story.strip():
+      raise Exception("DeepSeek stream returned empty story")
+   return story
+
+async def edit_story_message(placeholder: Message, text: str, parse_mode = ParseMode.HTML):
+   '''Редактирует сообщение со сказкой, соблюдая ограничения Telegram'''
+   try:
+      await placeholder.edit_text(text[:4096], parse_mode = parse_mode)
+   except TelegramRetryAfter as e:			#Слишком частое редактирование
+      await asyncio.sleep(e.retry_after)
+      await placeholder.edit_text(text[:4096], parse_mode = parse_mode)
+   except TelegramBadRequest as e:
+      if "not modified" in str(e):
+         return
+      if parse_mode is None:
+         raise
+      await placeholder.edit_text(text[:4096], parse_mode = None)	#Текст с неполной HTML-разметкой
+
+async def deliver_story_streaming(message: Message, data) -> str:
+   '''Отправляет сообщение-заготовку и дописывает в него сказку по мере генерации.
+   При ошибке потока сказка генерируется обычным запросом'''
+   placeholder = await message.answer("<i>✍️ Сказка пишется...</i>")
+   state = {"text": "", "shown": ""}
+   
+   async def updater():
+      #Периодически показываем накопленный текст, не чаще STREAM_EDIT_INTERVAL
+      while True:
+         await asyncio.sleep(STREAM_EDIT_INTERVAL)
+         text = state["text"]
+         if text and text != state["shown"]:
+            state["shown"] = text
+            try:
+               await edit_story_message(placeholder, text + " ✍️", parse_mode = None)
+            except Exception as e:
+               log.warning("Ошибка обновления сообщения: %r", e)
+   
+   update_task = asyncio.create_task(updater())
+   try:
+      story = await stream_story(data, lambda text: state.update(text = text))
+   except Exception as e:
+      log.warning("Ошибка потоковой генерации, переходим к обычной: %r", e)
+      story = None
+   finally:
+      update_task.cancel()
    
-            return generated_story
+   if story is None:
+      story = await generate_story(data)
+   await edit_story_message(placeholder, story)
+   return story
+'''Упреждающая озвучка'''
+#Задачи синтеза по user_id: {"voice_type": голос, "task": asyncio.Task, "expire": отложенная отмена}
+speculative_tts = {}
+
+async def predict_voice(user_id) -> str:
+   '''Наиболее вероятный голос: чаще всего выбираемый пользователем,
+   иначе самый популярный среди всех пользователей. Статистика читается из SQLite в отдельном потоке'''
+   voice_type = await asyncio.to_thread(user_store.preferred_voice, user_id)
+   if voice_type:
+      return voice_type
+   voice_stats = (await asyncio.to_thread(tale_rollups.summary)).get("voice_type", {})
+   voice_stats.pop("N/A", None)
+   if voice_stats:
+      return max(voice_stats.items(), key = lambda x: x[1])[0]
+   return "женский"
+
+async def start_speculative_tts(user_id, story: str):
+   '''Запускает синтез сказки в фоне, не дожидаясь выбора пользователя'''
+   current_tts_manager = tts_manager or get_tts_manager()
+   if not current_tts_manager or not story:
+      return
+   voice_type = await predict_voice(user_id)
+   cancel_speculative_tts(user_id, "abandoned")
+   if not scheduler.has_capacity("speechkit"):		#Упреждающая работа не занимает очередь
+      metrics.inc("speculative_tts_total", result = "skipped")
+      return
+   task = asyncio.create_task(speculative_synthesis(current_tts_manager, story, voice_type,
+   						    age_label(user_id)))
+   #Ошибку фоновой задачи заберет take_speculative_tts; здесь только глушим предупреждение
+   task.add_done_callback(lambda t: t.cancelled() or t.exception())
+   expire = asyncio.get_running_loop().call_later(SPECULATIVE_TTS_TTL,
+   						  cancel_speculative_tts, user_id, "expired")
+   speculative_tts[user_id] = {"voice_type": voice_type, "task": task, "expire": expire}
+   metrics.inc("speculative_tts_total", result = "started")
+
+async def speculative_synthesis(current_tts_manager, story: str, voice_type: str, age: str):
+   async with scheduler.job("speechkit", wait = False):
+      with metrics.timer("stage_duration_seconds", stage = "text_to_speech",
+      			 age = age, voice = voice_type, mode = "speculative"):
+         return await current_tts_manager.text_to_speech(text = story.strip(),
+         						 voice_type = voice_type,
+         						 emotion = "good")
+
+def cancel_speculative_tts(user_id, result: str):
+   '''Отменяет упреждающий синтез. result - причина для метрик'''
+   entry = speculative_tts.pop(user_id, None)
+   if entry:
+      entry["task"].cancel()
+      entry["expire"].cancel()
+      metrics.inc("speculative_tts_total", result = result)
+
+async def take_speculative_tts(user_id, voice_type: str):
+   '''Возвращает готовое (или почти готовое) аудио, если голос совпал с выбранным, иначе None'''
+   entry = speculative_tts.get(user_id)
+   if not entry:
+      return None
+   if entry["voice_type"] != voice_type:
+      cancel_speculative_tts(user_id, "miss")
+      return None
+   speculative_tts.pop(user_id)
+   entry["expire"].cancel()
+   try:
+      audio_file = await entry["task"]
+   except Exception as e:
+      log.warning("Ошибка упреждающей озвучки: %r", e)
+      metrics.inc("speculative_tts_total", result = "error")
+      metrics.inc("tts_errors_total", age = age_label(user_id), voice = voice_type)
+      return None
+   metrics.inc("speculative_tts_total", result = "hit")
+   return audio_file
+
 #Инициализируем TTS менеджер при старте
 tts_manager = None
    
 async def main():
-   global tts_manager
+   global tts_manager, deepseek_session, speechkit_session
+   
+   metrics_runner = None
+   if METRICS_PORT:
+      port = METRICS_PORT + 1 + int(os.getenv("WORKER_INDEX", "0")) if BOT_MODE == "worker" else METRICS_PORT
+      metrics_runner = await start_metrics_server(METRICS_HOST, port)
+
+   #Несколько процессов: этот только принимает обновления и раскладывает их по обработчикам
+   if WORKERS > 1 and BOT_MODE != "worker":
+      log.info("Бот запущен! Режим: %s, обработчиков: %s", BOT_MODE, WORKERS)
+      try:
+         await run_front(bot, dp, BOT_MODE, TELEGRAM_API_URL)
+      finally:
+         if metrics_runner is not None:
+            await metrics_runner.cleanup()
+      return
+   
+   #Одна сессия на каждый внешний сервис: соединения переиспользуются между запросами
+   deepseek_session = create_session("deepseek")
+   speechkit_session = create_session("speechkit")
+   
    try:
       #Проверяем переменные окружения перед инициализацией
       api_key = os.getenv("YANDEX_TTS_API_KEY")
       folder_id = os.getenv("YANDEX_FOLDER_ID")
       
-      print(f"🔑 Yandex API Key: {'✅ Set' if api_key else '❌ Missing'}")
-      print(f"🗂 Yandex Folder ID: {'✅ Set' if folder_id else '❌ Missing'}")
-      if api_key:
-         print(f"API Key starts with: {api_key[:10]}...")
-      if folder_id:
-         print(f" Folder ID: {folder_id}")
+      log.info("🔑 Yandex API Key: %s", "✅ Set" if api_key else "❌ Missing")
+      log.info("🗂 Yandex Folder ID: %s", "✅ Set" if folder_id else "❌ Missing")
          
-      tts_manager = init_tts_manager()			#Инициализируем глобальную переменную
+      tts_manager = init_tts_manager(speechkit_session, audio_cache)	#Инициализируем глобальную переменную
       if tts_manager:
-         print("✅ Yandex SpeechKit initialized successfully!")
+         log.info("✅ Yandex SpeechKit initialized successfully!")
       else:
-         print("❌ Yandex SpeechKit initialization failed")
+         log.error("❌ Yandex SpeechKit initialization failed")
    except Exception as e:
-      print(f"❌ SpeechKit initialization failed: {e}")
+      log.exception("❌ SpeechKit initialization failed: %r", e)
       tts_manager = None
       
-   print("Бот запущен!")
-   await bot.delete_webhook(drop_pending_updates=True)
-   await dp.start_polling(bot)
+   await stats_writer.start()				#Фоновая запись статистики
+   user_data.start_sweeper(float(os.getenv("SESSION_SWEEP_INTERVAL", "300")))	#Очистка брошенных анкет
+   session_flush_interval = float(os.getenv("SESSION_FLUSH_INTERVAL", "1"))	#Как часто анкеты и согласия пишутся в базу
+   user_data.start_writer(session_flush_interval)
+   user_privacy_status.start_writer(session_flush_interval)
+   await asyncio.to_thread(warm_up_safety)		#Загружаем словари pymorphy2 до первого сообщения
+      
+   log.info("Бот запущен! Режим: %s", BOT_MODE)
+   try:
+      if BOT_MODE in ("webhook", "worker"):
+         await run_webhook(dp, bot)			#Telegram (или принимающий процесс) сам присылает обновления
+      else:
+         await bot.delete_webhook(drop_pending_updates=True)
+         await dp.start_polling(bot)
+   finally:
+      await user_data.stop()				#Дописываем незаписанные анкеты
+      await user_privacy_status.stop()
+      await stats_writer.stop()				#Дописываем очередь статистики и делаем fsync
+      await deepseek_session.close()
+      await speechkit_session.close()
+      if metrics_runner is not None:
+         await metrics_runner.cleanup()
    
 if __name__=="__main__":
    asyncio.run(main())
@@ -0,0 +1,109 @@
+import hashlib			#Для ключа кэша по содержимому
+import os			#Для работы с файлами кэша
+import threading		#Кэш используется из потоков asyncio.to_thread
+import time
+from metrics import metrics
+from stats_store import connect_db
+
+class AudioCache:
+   '''Кэш озвучки по содержимому: ключ - хэш подготовленного SSML и параметров голоса.
+   Аудио хранится файлами на диске, общий размер ограничен max_bytes (вытесняются
+   давно не использованные). Для каждого ключа также запоминается file_id Telegram,
+   чтобы повторная отправка обходилась без синтеза и загрузки'''
+   def __init__(self, cache_dir, max_bytes):
+      self.cache_dir = cache_dir			#Папка с аудиофайлами
+      self.max_bytes = max_bytes			#Ограничение общего размера кэша
+      self.lock = threading.Lock()
+      os.makedirs(cache_dir, exist_ok = True)
+      self.conn = connect_db(os.path.join(cache_dir, "index.sqlite3"))
+      with self.conn:
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+         			key TEXT PRIMARY KEY,
+         			size INTEGER NOT NULL,
+         			last_used REAL NOT NULL,
+         			file_id TEXT)""")
+         self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+   @staticmethod
+   def make_key(ssml, voice, emotion, speed, audio_format = "mp3") -> str:
+      '''Ключ записи: хэш SSML, параметров голоса и формата аудио (у mp3 и oggopus разные ключи)'''
+      return hashlib.sha256("\x00".join([ssml, voice, emotion, str(speed), audio_format])
+      			    .encode("utf-8")).hexdigest()
+
+   def path(self, key):
+      return os.path.join(self.cache_dir, f"{key}.audio")
+
+   def get(self, key):
+      '''Аудио по ключу или None'''
+      with self.lock:
+         row = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+         if row and row[0]:
+            try:
+               with open(self.path(key), 'rb') as f:
+                  data = f.read()
+            except OSError:
+               data = None
+            if data is not None:
+               with self.conn:
+                  self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+               metrics.inc("audio_cache_total", result = "hit")
+               return data
+      metrics.inc("audio_cache_total", result = "miss")
+      return None
+
+   def put(self, key, data: bytes):
+      '''Сохраняет аудио и вытесняет старые записи при превышении max_bytes'''
+      if len(data) > self.max_bytes:
+         return
+      tmp_path = f"{self.path(key)}.{os.getpid()}.tmp"		#Свой файл у каждого процесса
+      with open(tmp_path, 'wb') as f:
+         f.write(data)
+      os.replace(tmp_path, self.path(key))
+      with self.lock:
+         with self.conn:
+            self.conn.execute("""INSERT INTO entries (key, size, last_used) VALUES (?, ?, ?)
+            			 ON CONFLICT (key) DO UPDATE SET size = excluded.size,
+            			 last_used = excluded.last_used""", (key, len(data), time.time()))
+         self.evict()
+
+   def evict(self):
+      '''Удаляет аудио давно не использованных записей, пока кэш больше max_bytes.
+      file_id остается: Telegram повторно отправит аудио без синтеза и загрузки'''
+      total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+      if total <= self.max_bytes:
+         return
+      evicted = []
+      #Записи только с file_id (аудио уже удалено) места не занимают и не вытесняются
+      for key, size in self.conn.execute("SELECT key, size FROM entries WHERE size > 0 ORDER BY last_used"):
+         if total <= self.max_bytes:
+            break
+         evicted.append(key)
+         total -= size
+      for key in evicted:
+         try:
+            os.remove(self.path(key))
+         except OSError:
+            pass
+      with self.conn:
+         self.conn.executemany("UPDATE entries SET size = 0 WHERE key = ?", [(key,) for key in evicted])
+         self.conn.executemany("DELETE FROM entries WHERE key = ? AND file_id IS NULL",	#Без file_id запись не нужна
+         		       [(key,) for key in evicted])
+      metrics.inc("audio_cache_evictions_total", len(evicted))
+
+   def get_file_id(self, key):
+      '''file_id ранее отправленного в Telegram аудио или None'''
+      with self.lock:
+         row = self.conn.execute("SELECT file_id FROM entries WHERE key = ?", (key,)).fetchone()
+         if row and row[0]:
+            with self.conn:
+               self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+      file_id = row[0] if row else None
+      metrics.inc("audio_file_id_total", result = "hit" if file_id else "miss")
+      return file_id
+
+   def set_file_id(self, key, file_id):
+      '''Запоминает file_id Telegram (None - забыть недействительный)'''
+      with self.lock, self.conn:
+         self.conn.execute("""INSERT INTO entries (key, size, last_used, file_id) VALUES (?, 0, ?, ?)
+         		      ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id""",
+         		      (key, time.time(), file_id))
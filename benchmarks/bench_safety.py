@@ -0,0 +1,53 @@
+'''Микробенчмарк safety_check: скомпилированный поиск против прежней построчной проверки.
+
+Запуск: python benchmarks/bench_safety.py [число повторов]'''
+
+import sys
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from safety import DANGEROUS_WORDS, safety_check
+
+#Типичные ответы пользователей и несколько запрещенных
+SAMPLES = ["волшебная сказка", "уютный", "сказочный лес", "придумай сам",
+	   "котенок-плутишка", "принцесса, которая не верила в магию",
+	   "Дракон-лентяй", "высохшая река", "Маша", "мальчик",
+	   "пещера дружелюбного тролля, где живут добрые гномы и светятся грибы " * 3,
+	   "пoлиция", "президент страны", "злой солдат"]
+
+def legacy_safety_check(text: str) -> bool:
+   '''Прежняя реализация: 12 проходов str.replace и поиск каждого слова по отдельности'''
+   def normalize_text(text: str) -> str:
+      replacements = {'a': 'а', 'e': 'е', 'o': 'о', 'p': 'р', 'c': 'с', 'x': 'х',
+      		      'y': 'у', 'k': 'к', 'm': 'м', 'h': 'н', 'b': 'в', 't': 'т'}
+      normalized = text.lower()
+      for eng, rus in replacements.items():
+         normalized = normalized.replace(eng, rus)
+      return normalized
+   dangerous_words = list(DANGEROUS_WORDS)		#Прежде список собирался заново при каждом вызове
+   normalized_text = normalize_text(text)
+   for words in dangerous_words:
+      if words in normalized_text:
+         return False
+   return True
+
+def main():
+   number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+   for text in SAMPLES:				#Обе реализации должны давать одинаковый ответ
+      if safety_check(text) != legacy_safety_check(text):
+         print(f"❌ Расхождение на '{text}'")
+         sys.exit(1)
+
+   calls = number * len(SAMPLES)
+   legacy = timeit.timeit(lambda: [legacy_safety_check(text) for text in SAMPLES], number = number)
+   compiled = timeit.timeit(lambda: [safety_check(text) for text in SAMPLES], number = number)
+   print(f"Прежняя проверка:        {legacy / calls * 1e6:8.2f} мкс на сообщение")
+   print(f"Скомпилированная:        {compiled / calls * 1e6:8.2f} мкс на сообщение")
+   print(f"Ускорение:               {legacy / compiled:8.1f}x")
+
+if __name__ == "__main__":
+   main()
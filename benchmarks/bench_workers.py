@@ -0,0 +1,143 @@
+'''Пропускная способность: один процесс против нескольких обработчиков (WORKERS).
+Поднимает заглушку Telegram Bot API, запускает Bot_tale.py с TELEGRAM_API_URL на нее
+и прогоняет пользователей по шагам анкеты от /start до имени ребенка (без DeepSeek
+и SpeechKit). Каждый пользователь отправляет следующий ответ только после ответа бота.
+
+Запуск: python benchmarks/bench_workers.py [пользователей] [обработчиков ...]
+Например: python benchmarks/bench_workers.py 300 1 4'''
+
+import asyncio
+import os
+import shutil
+import signal
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+API_PORT = 8190
+TOKEN = "123456:bench"
+
+#Ответы пользователя по шагам: каждый порождает ровно одно сообщение бота
+STEPS = ["/start",
+	 "✅ Я согласен с политикой конфиденциальности и условиями использования",
+	 "3-5 лет", "Волшебная", "Уютный", "сказочный лес",
+	 "котенок-плутишка", "Дракон-лентяй", "Маша"]
+
+class FakeBotAPI:
+   '''Заглушка Bot API: отдает обновления через getUpdates и принимает ответы бота'''
+   def __init__(self):
+      self.pending = []				#Обновления, которые еще не забрал бот
+      self.new_updates = asyncio.Event()
+      self.next_update_id = 1
+      self.users = {}				#user_id -> {"step": номер шага, "sent": время, "done": future}
+      self.latencies = []
+
+   def start_user(self, user_id, done):
+      self.users[user_id] = {"step": 0, "sent": 0.0, "done": done}
+      self.push(user_id)
+
+   def push(self, user_id):
+      user = self.users[user_id]
+      text = STEPS[user["step"]]
+      message = {"message_id": user["step"] + 1, "date": int(time.time()),
+      		 "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+      		 "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+      		 "text": text}
+      if text.startswith("/"):
+         message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+      self.pending.append({"update_id": self.next_update_id, "message": message})
+      self.next_update_id += 1
+      user["sent"] = time.perf_counter()
+      self.new_updates.set()
+
+   def reply(self, chat_id):
+      user = self.users.get(chat_id)
+      if user is None:
+         return
+      self.latencies.append(time.perf_counter() - user["sent"])
+      user["step"] += 1
+      if user["step"] < len(STEPS):
+         self.push(chat_id)
+      elif not user["done"].done():
+         user["done"].set_result(None)
+
+   async def handle(self, request):
+      method = request.match_info["method"]
+      params = dict(request.query)
+      if request.method == "POST":
+         params.update(await request.post())
+      if method == "getUpdates":
+         offset = int(params.get("offset", 0) or 0)
+         self.pending = [update for update in self.pending if update["update_id"] >= offset]
+         if not self.pending:
+            self.new_updates.clear()
+            try:
+               await asyncio.wait_for(self.new_updates.wait(), 1)
+            except asyncio.TimeoutError:
+               pass
+         return web.json_response({"ok": True, "result": self.pending[:100]})
+      if method == "getMe":
+         return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True,
+         						  "first_name": "Bench", "username": "bench_bot"}})
+      if method == "sendMessage":
+         chat_id = int(params["chat_id"])
+         self.reply(chat_id)
+         return web.json_response({"ok": True, "result": {
+         	"message_id": 1, "date": int(time.time()),
+         	"chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}})
+      return web.json_response({"ok": True, "result": True})
+
+async def run(users, workers):
+   api = FakeBotAPI()
+   app = web.Application()
+   app.router.add_route("*", "/bot{token}/{method}", api.handle)
+   runner = web.AppRunner(app)
+   await runner.setup()
+   await web.TCPSite(runner, "127.0.0.1", API_PORT).start()
+
+   data_dir = tempfile.mkdtemp(prefix = "bench_workers_")
+   env = dict(os.environ, TELEGRAM_TOKEN = TOKEN, TELEGRAM_API_URL = f"http://127.0.0.1:{API_PORT}",
+   	      DATA_DIR = data_dir, BOT_MODE = "polling", WORKERS = str(workers))
+   bot = await asyncio.create_subprocess_exec(sys.executable, str(ROOT / "Bot_tale.py"), env = env,
+   					      stdout = asyncio.subprocess.DEVNULL, cwd = str(ROOT))
+   loop = asyncio.get_running_loop()
+   try:
+      #Прогрев: запуск процессов, загрузка словарей, первые соединения
+      warm_up = [loop.create_future() for _ in range(4 * max(workers, 1))]
+      for index, done in enumerate(warm_up):
+         api.start_user(10_000_000 + index, done)
+      await asyncio.wait_for(asyncio.gather(*warm_up), 120)
+      api.latencies.clear()
+
+      started = time.perf_counter()
+      finished = [loop.create_future() for _ in range(users)]
+      for index, done in enumerate(finished):
+         api.start_user(1_000_000 + index, done)
+      await asyncio.wait_for(asyncio.gather(*finished), 600)
+      elapsed = time.perf_counter() - started
+   finally:
+      bot.send_signal(signal.SIGTERM)
+      await bot.wait()
+      await runner.cleanup()
+      shutil.rmtree(data_dir, ignore_errors = True)
+
+   latencies = sorted(api.latencies)
+   updates = users * len(STEPS)
+   p95 = latencies[int(len(latencies) * 0.95) - 1]
+   print(f"WORKERS={workers}: {updates} обновлений за {elapsed:.2f} сек, "
+   	 f"{updates / elapsed:.0f} обн/сек, задержка p50 {statistics.median(latencies) * 1000:.1f} мс, "
+   	 f"p95 {p95 * 1000:.1f} мс")
+
+def main():
+   users = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+   variants = [int(value) for value in sys.argv[2:]] or [1, os.cpu_count() or 2]
+   print(f"Пользователей: {users}, ядер: {os.cpu_count()}")
+   for workers in variants:
+      asyncio.run(run(users, workers))
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,240 @@
+'''Нагрузочный тест всего сценария без обращения к настоящим API.
+Поднимает заглушки DeepSeek, SpeechKit и Telegram Bot API (см. standins.py), запускает Bot_tale.py
+с адресами заглушек и проводит N пользователей по анкете от /start до готовой аудиоверсии.
+Каждый пользователь отправляет следующий ответ только после ответа бота.
+
+Отчет: задержка p50/p95/p99 по шагам анкеты, сказок в секунду и пиковая память процесса бота.
+Настройки бота (STORY_STREAMING, SPECULATIVE_TTS, DEEPSEEK_CONCURRENCY...) берутся из окружения.
+
+Запуск: python benchmarks/loadtest.py [пользователей] [параметры]
+Например: python benchmarks/loadtest.py 200 --deepseek-latency 2 --deepseek-errors 0.05 --json result.json'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from pathlib import Path
+from aiohttp import web
+from standins import Behaviour, FakeDeepSeek, FakeSpeechKit, FakeTelegram
+
+ROOT = Path(__file__).resolve().parent.parent
+TOKEN = "123456:loadtest"
+
+AGES = ["1-2 года", "3-5 лет", "6-8 лет"]
+GENRES = ["волшебная сказка", "сказка о животных", "приключения", "поучительная история"]
+STYLES = ["уютный", "юмористический", "приключенческий"]
+HEROES = ["котенок-плутишка", "маленькая фея", "робот Вертушка", "девочка Катя"]
+ENEMIES = ["Дракон-лентяй", "высохшая река", "злое облако", "хитрая лиса"]
+NAMES = [("Маша", "девочка"), ("Петя", "мальчик"), ("Аня", "девочка"), ("Ваня", "мальчик")]
+
+#Признаки окончания шага в сообщениях бота: шаг завершен, когда пришло подходящее сообщение
+FINAL_MARKERS = {"gender": "озвученную версию",		#Сказка отправлена, предложена озвучка
+		 "voice_choice": "Аудиоверсия готова"}
+FAILURE_MARKERS = ("❌", "⚠️", "переполнена", "Подождите немного")
+
+def user_steps(index, same_form) -> list:
+   '''Ответы пользователя по шагам: [(шаг, текст)]'''
+   rnd = random.Random(0 if same_form else index)
+   name, gender = rnd.choice(NAMES)
+   location = "сказочный лес" if same_form else f"сказочный лес у озера {index}"	#Разные анкеты - без попаданий в кэш модерации
+   return [("start", "/start"),
+   	   ("privacy", "✅ Я согласен с политикой конфиденциальности и условиями использования"),
+   	   ("age", rnd.choice(AGES)),
+   	   ("genre", rnd.choice(GENRES)),
+   	   ("style", rnd.choice(STYLES)),
+   	   ("location", location),
+   	   ("hero", rnd.choice(HEROES)),
+   	   ("enemy", rnd.choice(ENEMIES)),
+   	   ("child_name", name),
+   	   ("gender", gender),
+   	   ("audio_choice", "🔈 Да, хочу озвучить сказку"),
+   	   ("voice_choice", rnd.choice(["Женский голос", "Мужской голос"]))]
+
+class LoadGenerator:
+   '''Ведет пользователей по анкете и замеряет время от ответа пользователя до ответа бота'''
+   def __init__(self, think_time = 0.0, same_form = False):
+      self.think_time = think_time
+      self.same_form = same_form
+      self.telegram = None
+      self.users = {}				#user_id -> {"steps", "step", "sent", "done"}
+      self.latencies = {}			#Шаг -> [секунды]
+      self.outcomes = {}			#Итог пользователя -> количество
+      self.last_finished = 0.0			#Когда закончил последний пользователь
+
+   def start_user(self, user_id, index, done):
+      self.users[user_id] = {"steps": user_steps(index, self.same_form), "step": 0, "sent": 0.0, "done": done}
+      self.send(user_id)
+
+   def send(self, user_id):
+      user = self.users[user_id]
+      user["sent"] = time.perf_counter()
+      self.telegram.push_text(user_id, user["steps"][user["step"]][1])
+
+   def finish(self, user_id, outcome):
+      user = self.users.pop(user_id)
+      self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+      self.last_finished = time.perf_counter()
+      if not user["done"].done():
+         user["done"].set_result(outcome)
+
+   def on_message(self, chat_id, text):
+      '''Сообщение бота пользователю chat_id'''
+      user = self.users.get(chat_id)
+      if user is None:
+         return
+      name = user["steps"][user["step"]][0]
+      if any(marker in text for marker in FAILURE_MARKERS):
+         self.finish(chat_id, f"failed:{name}")
+         return
+      marker = FINAL_MARKERS.get(name)
+      if marker and marker not in text:
+         return						#Промежуточное сообщение ("Проверяю данные...", место в очереди)
+      self.latencies.setdefault(name, []).append(time.perf_counter() - user["sent"])
+      user["step"] += 1
+      if user["step"] == len(user["steps"]):
+         self.finish(chat_id, "ok")
+      elif self.think_time:
+         asyncio.get_running_loop().call_later(self.think_time, self.send, chat_id)
+      else:
+         self.send(chat_id)
+
+   def reset(self):
+      self.latencies.clear()
+      self.outcomes.clear()
+
+def percentile(values, fraction) -> float:
+   values = sorted(values)
+   return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+def peak_rss_mb(pid):
+   '''Пиковая память процесса (VmHWM из /proc, только Linux)'''
+   try:
+      for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+         if line.startswith("VmHWM:"):
+            return int(line.split()[1]) / 1024
+   except OSError:
+      pass
+   return None
+
+async def run(args):
+   generator = LoadGenerator(args.think, args.same_form)
+   deepseek = FakeDeepSeek(Behaviour(args.deepseek_latency, args.deepseek_sigma, args.deepseek_errors),
+   			   story_chars = args.story_chars)
+   speechkit = FakeSpeechKit(Behaviour(args.speechkit_latency, args.speechkit_sigma, args.speechkit_errors))
+   telegram = FakeTelegram(Behaviour(args.telegram_latency, args.telegram_sigma, args.telegram_errors),
+   			   generator.on_message)
+   generator.telegram = telegram
+
+   app = web.Application(client_max_size = 64 * 1024 * 1024)		#Бот загружает аудио целиком
+   for stand_in in (deepseek, speechkit, telegram):
+      stand_in.register(app)
+   runner = web.AppRunner(app, access_log = None)
+   await runner.setup()
+   await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+   base_url = f"http://127.0.0.1:{args.port}"
+   data_dir = tempfile.mkdtemp(prefix = "loadtest_")
+   env = dict(os.environ,
+   	      TELEGRAM_TOKEN = TOKEN,
+   	      TELEGRAM_API_URL = base_url,
+   	      DEEPSEEK_API_KEY = "loadtest",
+   	      DEEPSEEK_API_URL = f"{base_url}/v1/chat/completions",
+   	      YANDEX_TTS_API_KEY = "loadtest",
+   	      YANDEX_FOLDER_ID = "loadtest",
+   	      SPEECHKIT_API_URL = f"{base_url}/speech/v1/tts:synthesize",
+   	      DATA_DIR = data_dir,
+   	      BOT_MODE = "polling",
+   	      WORKERS = "0",
+   	      LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING"))
+   bot = await asyncio.create_subprocess_exec(sys.executable, str(ROOT / "Bot_tale.py"), env = env,
+   					      stdout = None if args.verbose else asyncio.subprocess.DEVNULL,
+   					      cwd = str(ROOT))
+   loop = asyncio.get_running_loop()
+   try:
+      #Прогрев без ошибок: запуск процесса, загрузка словарей, первые соединения
+      behaviours = [stand_in.behaviour for stand_in in (deepseek, speechkit, telegram)]
+      error_rates = [behaviour.error_rate for behaviour in behaviours]
+      for behaviour in behaviours:
+         behaviour.error_rate = 0.0
+      warm_up = [loop.create_future() for _ in range(3)]
+      for index, done in enumerate(warm_up):
+         generator.start_user(10_000_000 + index, index, done)
+      await asyncio.wait_for(asyncio.gather(*warm_up), 120)
+      for behaviour, error_rate in zip(behaviours, error_rates):
+         behaviour.error_rate = error_rate
+      generator.reset()
+      deepseek.requests = speechkit.requests = 0
+
+      started = time.perf_counter()
+      finished = [loop.create_future() for _ in range(args.users)]
+      for index, done in enumerate(finished):
+         generator.start_user(1_000_000 + index, index, done)
+      pending = (await asyncio.wait(finished, timeout = args.timeout))[1]
+      elapsed = max(generator.last_finished, started + 0.001) - started	#Зависшие пользователи не растягивают время
+      generator.outcomes["timeout"] = len(pending)
+      peak_rss = peak_rss_mb(bot.pid)
+   finally:
+      if bot.returncode is None:
+         bot.send_signal(signal.SIGTERM)
+      await bot.wait()
+      await runner.cleanup()
+      shutil.rmtree(data_dir, ignore_errors = True)
+
+   stories = generator.outcomes.get("ok", 0)
+   result = {"users": args.users,
+   	     "stories": stories,
+   	     "elapsed": round(elapsed, 3),
+   	     "stories_per_second": round(stories / elapsed, 3),
+   	     "peak_rss_mb": round(peak_rss, 1) if peak_rss else None,
+   	     "outcomes": {key: value for key, value in generator.outcomes.items() if value},
+   	     "upstream_requests": {"deepseek": deepseek.requests, "speechkit": speechkit.requests},
+   	     "stages": {}}
+   for name, _ in user_steps(0, True):
+      values = generator.latencies.get(name)
+      if values:
+         result["stages"][name] = {"count": len(values),
+         			   "p50": round(percentile(values, 0.5) * 1000, 1),
+         			   "p95": round(percentile(values, 0.95) * 1000, 1),
+         			   "p99": round(percentile(values, 0.99) * 1000, 1)}
+   return result
+
+def report(result):
+   print(f"Пользователей: {result['users']}, готовых сказок: {result['stories']}, "
+   	 f"итоги: {result['outcomes']}")
+   print(f"Время: {result['elapsed']:.1f} сек, сказок в секунду: {result['stories_per_second']:.2f}")
+   print(f"Запросов к заглушкам: {result['upstream_requests']}")
+   rss = result["peak_rss_mb"]
+   print(f"Пиковая память бота: {f'{rss:.1f} МБ' if rss else 'н/д'}")
+   print(f"\n{'Шаг':<14}{'N':>6}{'p50, мс':>12}{'p95, мс':>12}{'p99, мс':>12}")
+   for name, stage in result["stages"].items():
+      print(f"{name:<14}{stage['count']:>6}{stage['p50']:>12.1f}{stage['p95']:>12.1f}{stage['p99']:>12.1f}")
+
+def main():
+   parser = argparse.ArgumentParser(description = "Нагрузочный тест бота на заглушках API")
+   parser.add_argument("users", nargs = "?", type = int, default = 50)
+   for name, latency, sigma in (("deepseek", 1.0, 0.3), ("speechkit", 0.5, 0.3), ("telegram", 0.02, 0.2)):
+      parser.add_argument(f"--{name}-latency", type = float, default = latency, help = "медиана задержки, сек")
+      parser.add_argument(f"--{name}-sigma", type = float, default = sigma, help = "разброс задержки (логнормальное распределение)")
+      parser.add_argument(f"--{name}-errors", type = float, default = 0.0, help = "доля ответов с ошибкой")
+   parser.add_argument("--story-chars", type = int, default = 2500, help = "длина сказки от заглушки DeepSeek")
+   parser.add_argument("--think", type = float, default = 0.0, help = "пауза пользователя перед ответом, сек")
+   parser.add_argument("--same-form", action = "store_true", help = "одинаковые анкеты (проверка кэшей)")
+   parser.add_argument("--timeout", type = float, default = 600, help = "сколько ждать всех пользователей, сек")
+   parser.add_argument("--port", type = int, default = 8191)
+   parser.add_argument("--json", help = "сохранить результат в файл (для сравнения в CI)")
+   parser.add_argument("--verbose", action = "store_true", help = "показывать логи бота")
+   args = parser.parse_args()
+
+   result = asyncio.run(run(args))
+   report(result)
+   if args.json:
+      Path(args.json).write_text(json.dumps(result, ensure_ascii = False, indent = 2), encoding = "utf-8")
+
+if __name__ == "__main__":
+   main()
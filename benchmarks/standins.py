@@ -0,0 +1,209 @@
+'''Заглушки внешних API для нагрузочных тестов: DeepSeek (обычные и потоковые ответы),
+Yandex SpeechKit (tts:synthesize) и Telegram Bot API. У каждой настраиваются задержка
+ответа и доля ошибок, поэтому можно проверить и медленный, и сбоящий сервис'''
+
+import asyncio
+import json
+import math
+import random
+import struct
+import time
+from aiohttp import web
+
+#Текст сказки из заглушки DeepSeek: предложения перемешиваются, чтобы сказки не совпадали
+#(иначе кэш озвучки отдавал бы готовое аудио и синтез не измерялся бы)
+SENTENCES = ["Жил-был в сказочном лесу маленький добрый медвежонок.",
+	     "Каждое утро он выходил на полянку и здоровался с солнышком.",
+	     "Однажды он услышал, как кто-то тихо плачет за старым дубом.",
+	     "Это был потерявшийся зайчонок, который не мог найти дорогу домой.",
+	     "Медвежонок взял его за лапку, и они вместе отправились в путь.",
+	     "По дороге им встретилась мудрая сова и показала короткую тропинку.",
+	     "Вечером зайчонок уже пил теплый чай со своей мамой.",
+	     "А медвежонок понял, что помогать другим - это настоящее счастье."]
+
+class Behaviour:
+   '''Поведение заглушки: задержка из логнормального распределения (медиана и разброс sigma;
+   sigma = 0 - постоянная задержка) и доля ответов с ошибкой'''
+   def __init__(self, median = 0.0, sigma = 0.0, error_rate = 0.0, error_status = 500):
+      self.median = median
+      self.sigma = sigma
+      self.error_rate = error_rate
+      self.error_status = error_status
+
+   def delay(self) -> float:
+      if self.median <= 0:
+         return 0.0
+      if self.sigma <= 0:
+         return self.median
+      return random.lognormvariate(math.log(self.median), self.sigma)
+
+   async def wait(self):
+      delay = self.delay()
+      if delay:
+         await asyncio.sleep(delay)
+
+   def failed(self) -> bool:
+      return self.error_rate > 0 and random.random() < self.error_rate
+
+   def error_response(self) -> web.Response:
+      return web.json_response({"error": {"message": "stand-in failure"}}, status = self.error_status)
+
+def story_text(chars) -> str:
+   sentences = []
+   length = 0
+   while length < chars:
+      sentence = random.choice(SENTENCES)
+      sentences.append(sentence)
+      length += len(sentence) + 1
+   return "Сказка про медвежонка\n\n" + " ".join(sentences)
+
+class FakeDeepSeek:
+   '''POST /v1/chat/completions. Модерация (системный промт модератора) всегда отвечает APPROVED,
+   сказка - story_chars символов. При stream=True сказка уходит SSE-фрагментами'''
+   def __init__(self, behaviour: Behaviour, story_chars = 2500, chunk_chars = 40, chunk_delay = 0.01):
+      self.behaviour = behaviour
+      self.story_chars = story_chars
+      self.chunk_chars = chunk_chars		#Размер одного фрагмента потока
+      self.chunk_delay = chunk_delay		#Пауза между фрагментами потока
+      self.requests = 0
+
+   def register(self, app: web.Application):
+      app.router.add_post("/v1/chat/completions", self.handle)
+
+   async def handle(self, request):
+      self.requests += 1
+      payload = await request.json()
+      await self.behaviour.wait()
+      if self.behaviour.failed():
+         return self.behaviour.error_response()
+
+      moderation = payload["messages"][0]["content"].startswith("Ты модератор")
+      content = "APPROVED" if moderation else story_text(self.story_chars)
+      prompt_tokens = sum(len(message["content"]) for message in payload["messages"]) // 3
+      usage = {"prompt_tokens": prompt_tokens,
+      	       "prompt_cache_hit_tokens": prompt_tokens // 2,
+      	       "prompt_cache_miss_tokens": prompt_tokens - prompt_tokens // 2,
+      	       "completion_tokens": len(content) // 3}
+      if not payload.get("stream"):
+         return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}],
+         			   "usage": usage})
+
+      response = web.StreamResponse(headers = {"Content-Type": "text/event-stream"})
+      await response.prepare(request)
+      for start in range(0, len(content), self.chunk_chars):
+         chunk = {"choices": [{"delta": {"content": content[start:start + self.chunk_chars]}}]}
+         await response.write(f"data: {json.dumps(chunk, ensure_ascii = False)}\n\n".encode("utf-8"))
+         if self.chunk_delay:
+            await asyncio.sleep(self.chunk_delay)
+      if payload.get("stream_options", {}).get("include_usage"):
+         await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+      await response.write(b"data: [DONE]\n\n")
+      await response.write_eof()
+      return response
+
+def ogg_opus(size, serial = None) -> bytes:
+   '''Поток Ogg со страницами OpusHead, OpusTags и случайными "аудио" страницами (без контрольных сумм)'''
+   serial = random.getrandbits(32) if serial is None else serial
+   bodies = [b"OpusHead" + bytes(11), b"OpusTags" + bytes(8)]
+   bodies += [random.randbytes(min(4000, size - start)) for start in range(0, size, 4000)]
+   pages = []
+   for sequence, body in enumerate(bodies):
+      flags = 0x02 if sequence == 0 else 0x04 if sequence == len(bodies) - 1 else 0
+      granule = max(0, sequence - 1) * 48000
+      segments = [255] * (len(body) // 255) + [len(body) % 255]
+      pages.append(b"OggS\x00" + struct.pack("<BqIIIB", flags, granule, serial, sequence, 0, len(segments))
+      		   + bytes(segments) + body)
+   return b"".join(pages)
+
+class FakeSpeechKit:
+   '''POST /speech/v1/tts:synthesize: возвращает "аудио" размером bytes_per_char на символ SSML
+   (для format=oggopus - в 6 раз меньше, как у речи в Opus)'''
+   def __init__(self, behaviour: Behaviour, bytes_per_char = 40):
+      self.behaviour = behaviour
+      self.bytes_per_char = bytes_per_char
+      self.requests = 0
+
+   def register(self, app: web.Application):
+      app.router.add_post("/speech/v1/tts:synthesize", self.handle)
+
+   async def handle(self, request):
+      self.requests += 1
+      form = await request.post()
+      await self.behaviour.wait()
+      if self.behaviour.failed():
+         return self.behaviour.error_response()
+      text = form.get("ssml") or form.get("text") or ""
+      if form.get("format") == "oggopus":
+         return web.Response(body = ogg_opus(len(text) * self.bytes_per_char // 6), content_type = "audio/ogg")
+      return web.Response(body = random.randbytes(len(text) * self.bytes_per_char),
+      			  content_type = "audio/mpeg")
+
+class FakeTelegram:
+   '''Telegram Bot API: отдает обновления через getUpdates и принимает ответы бота.
+   on_message(chat_id, text) вызывается для каждого сообщения бота (в том числе аудио)'''
+   def __init__(self, behaviour: Behaviour, on_message):
+      self.behaviour = behaviour
+      self.on_message = on_message
+      self.pending = []				#Обновления, которые еще не забрал бот
+      self.new_updates = asyncio.Event()
+      self.next_update_id = 1
+      self.next_message_id = 1
+
+   def register(self, app: web.Application):
+      app.router.add_route("*", "/bot{token}/{method}", self.handle)
+
+   def push_text(self, user_id, text):
+      message = {"message_id": self.next_message_id, "date": int(time.time()),
+      		 "chat": {"id": user_id, "type": "private", "first_name": "Load"},
+      		 "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+      		 "text": text}
+      if text.startswith("/"):
+         message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+      self.pending.append({"update_id": self.next_update_id, "message": message})
+      self.next_update_id += 1
+      self.next_message_id += 1
+      self.new_updates.set()
+
+   def message(self, chat_id, **fields) -> dict:
+      self.next_message_id += 1
+      return {"message_id": self.next_message_id, "date": int(time.time()),
+      	      "chat": {"id": chat_id, "type": "private"}, **fields}
+
+   async def handle(self, request):
+      method = request.match_info["method"]
+      params = dict(request.query)
+      if request.method == "POST":
+         params.update(await request.post())
+
+      if method == "getUpdates":
+         offset = int(params.get("offset", 0) or 0)
+         self.pending = [update for update in self.pending if update["update_id"] >= offset]
+         if not self.pending:
+            self.new_updates.clear()
+            try:
+               await asyncio.wait_for(self.new_updates.wait(), 1)
+            except asyncio.TimeoutError:
+               pass
+         return web.json_response({"ok": True, "result": self.pending[:100]})
+      if method == "getMe":
+         return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True,
+         						  "first_name": "Load", "username": "load_bot"}})
+
+      await self.behaviour.wait()
+      if self.behaviour.failed():
+         return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+         			   "parameters": {"retry_after": 1}}, status = 429)
+      if method in ("sendMessage", "editMessageText"):
+         chat_id = int(params["chat_id"])
+         text = params.get("text", "")
+         if method == "sendMessage":
+            self.on_message(chat_id, text)
+         return web.json_response({"ok": True, "result": self.message(chat_id, text = text)})
+      if method in ("sendAudio", "sendVoice"):
+         chat_id = int(params["chat_id"])
+         self.on_message(chat_id, f"<{method}>")
+         audio = {"file_id": f"audio{self.next_message_id}", "file_unique_id": f"u{self.next_message_id}",
+         	  "duration": 60}
+         kind = "audio" if method == "sendAudio" else "voice"
+         return web.json_response({"ok": True, "result": self.message(chat_id, **{kind: audio})})
+      return web.json_response({"ok": True, "result": True})
@@ -0,0 +1,354 @@
+'''Запасные сказки без обращения к сети: используются, когда DeepSeek недоступен
+или очередь генерации переполнена. Шаблоны подобраны по возрасту и жанру,
+имя ребенка, герой и злодей склоняются и согласуются по роду с помощью pymorphy2'''
+
+import html			#Ответы пользователя вставляются в HTML-сообщение
+import re
+from functools import lru_cache
+from morphology import get_morph
+
+#Что подставляется, если пользователь не указал значение или попросил придумать самому
+DEFAULTS = {"hero": "добрый медвежонок",
+	    "enemy": "хитрая лиса",
+	    "location": "сказочный лес",
+	    "child": "малыш"}
+
+#Ответы, которые пользователь вводит своим текстом: без одобрения модерации DeepSeek вместо них - DEFAULTS
+FREE_TEXT_FIELDS = ("hero", "enemy", "location", "child_name")
+
+#Жанр (кнопка или свой вариант) -> семейство шаблонов, по первому совпадению
+GENRE_FAMILIES = [("живот", "animals"),
+		  ("волшеб", "magic"),
+		  ("фантаст", "magic"),
+		  ("приключ", "adventure"),
+		  ("детектив", "adventure"),
+		  ("готич", "adventure"),
+		  ("страш", "adventure")]
+
+GENDER_INDEX = {"masc": 0, "femn": 1, "neut": 2, "plur": 3}
+
+"""++++++++++++++ШАБЛОНЫ++++++++++++++
+{hero} - герой в именительном падеже, {hero:accs} - в нужном падеже (gent, datv, accs, ablt, loct),
+{hero?пошел|пошла|пошло|пошли} - слово, согласованное с родом (м|ж|ср|мн; недостающие берутся из первого).
+Роли: hero, enemy, child, location. Роль с большой буквы ({Hero}) - результат с большой буквы"""
+TEMPLATES = {
+"1": {
+"default": """{Hero} и {enemy}
+
+{Hero?Жил-был|Жила-была|Жило-было|Жили-были} {hero}. Далеко-далеко есть чудесное место — {location}. Там и {hero?жил|жила|жило|жили} {hero}.
+
+Однажды {hero} {hero?пошел|пошла|пошло|пошли} гулять. Идет и песенку поет:
+«Я по тропинке иду, я друзей себе найду!»
+
+А навстречу — {enemy}. {Enemy?Сердитый|Сердитая|Сердитое|Сердитые}, {enemy?надутый|надутая|надутое|надутые}.
+— Не пущу! — {enemy?говорит|говорит|говорит|говорят}.
+
+А {hero} не {hero?испугался|испугалась|испугалось|испугались} и снова поет:
+«Я по тропинке иду, я друзей себе найду!»
+
+Тут {child?пришел|пришла} {child}.
+— Давайте дружить! — {child?сказал|сказала} {child} и {child?угостил|угостила} {enemy:accs} сладким пирожком.
+
+{Enemy} {enemy?улыбнулся|улыбнулась|улыбнулось|улыбнулись} и {enemy?перестал|перестала|перестало|перестали} сердиться.
+Теперь они гуляют вместе и поют:
+«Мы по тропинке идем, мы друзей себе нашли!»
+
+Тут и сказке конец, а кто слушал — молодец!""",
+
+"animals": """Как {hero} {hero?нашел|нашла|нашло|нашли} друга
+
+{Hero?Жил-был|Жила-была|Жило-было|Жили-были} {hero}. {Hero?Он|Она|Оно|Они} {hero?любил|любила|любило|любили} прыгать и играть.
+Прыг-скок, прыг-скок!
+
+{Hero?Пришел|Пришла|Пришло|Пришли} {hero} к речке. А там {enemy}.
+— Ой, кто это? — {hero?удивился|удивилась|удивилось|удивились} {hero}.
+— Это я, {enemy}! Мне скучно {enemy?одному|одной|одному|одним}...
+
+Прибежал{child?|а} {child} и говорит:
+— А давайте играть вместе!
+Прыг-скок, прыг-скок!
+
+Играли {hero}, {enemy} и {child} до самого вечера. А потом пили теплое молочко и смеялись.
+
+Хорошо, когда есть друзья!"""},
+
+"2": {
+"magic": """Волшебный подарок для {hero:gent}
+
+Далеко-далеко есть чудесное место — {location}. Там {hero?жил|жила|жило|жили} {hero}, {hero?добрый|добрая|доброе|добрые} и {hero?веселый|веселая|веселое|веселые}.
+
+Однажды утром {hero} {hero?проснулся|проснулась|проснулось|проснулись} и {hero?увидел|увидела|увидело|увидели}, что все цветы вокруг закрылись, а птицы замолчали. Это {enemy} {enemy?спрятал|спрятала|спрятало|спрятали} солнечный лучик в темный сундук.
+
+— Надо вернуть лучик! — {hero?решил|решила|решило|решили} {hero}.
+
+По дороге {hero?встретил|встретила|встретило|встретили} {hero} {child:accs}.
+— Я пойду с тобой, — {child?сказал|сказала} {child}. — Вдвоем не страшно!
+
+Долго они шли, пока не пришли к {enemy:datv}. {Enemy} {enemy?сидел|сидела|сидело|сидели} на сундуке и {enemy?хмурился|хмурилась|хмурилось|хмурились}.
+— Зачем тебе лучик? — {child?спросил|спросила} {child}.
+— Мне одиноко в темноте, — {enemy?признался|призналась|призналось|признались} {enemy}. — Я {enemy?хотел|хотела|хотело|хотели}, чтобы у меня тоже было светло.
+
+Тогда {child} {child?придумал|придумала} чудо: {child?он|она} {child?предложил|предложила} поставить сундук на самую высокую гору. Лучик засиял оттуда для всех — и для {hero:gent}, и для {enemy:gent}.
+
+С тех пор {enemy} больше не {enemy?грустил|грустила|грустило|грустили}, а {hero} и {child} часто {hero?приходил|приходила|приходило|приходили} к {enemy:datv} в гости.
+
+Настоящее волшебство — это доброта, которой делишься с другими.""",
+
+"animals": """{Hero} и {enemy}
+
+На лесной полянке, где пахнет земляникой, {hero?жил|жила|жило|жили} {hero}. Больше всего на свете {hero} {hero?любил|любила|любило|любили} собирать шишки и слушать, как поет ручеек.
+
+Но однажды ручеек замолчал. Звери испугались: как же теперь пить воду?
+— Это {enemy} {enemy?перегородил|перегородила|перегородило|перегородили} ручей камнями! — {hero?догадался|догадалась|догадалось|догадались} {hero}.
+
+На помощь {hero?позвал|позвала|позвало|позвали} {hero} {child:accs}. {Child} всегда {child?знал|знала}, как помирить друзей.
+
+Нашли они {enemy:accs} у большого камня.
+— Зачем ты закрыл{enemy?|а|о|и} ручей? — {child?спросил|спросила} {child}.
+— Я строил{enemy?|а|о|и} себе домик у воды, — {enemy?ответил|ответила|ответило|ответили} {enemy}. — Я не {enemy?знал|знала|знало|знали}, что всем станет плохо.
+
+Тогда все вместе построили {enemy:datv} домик рядом с ручьем, а камни убрали. Ручеек снова запел, а звери устроили праздник.
+
+Если спросить и выслушать, любую беду можно исправить вместе.""",
+
+"adventure": """Большое приключение {hero:gent}
+
+Далеко-далеко есть загадочное место — {location}. Там {hero?жил|жила|жило|жили} {hero}, {hero?который|которая|которое|которые} мечтал{hero?|а|о|и} о настоящих приключениях.
+
+Однажды ветер принес старую карту. На ней был нарисован путь к Звезде Желаний, а рядом написано: «Берегись, путь стережет {enemy}!»
+
+— Я не боюсь! — {hero?сказал|сказала|сказало|сказали} {hero} и {hero?позвал|позвала|позвало|позвали} с собой {child:accs}.
+
+Они перешли шаткий мостик, нашли дорогу в тумане и разгадали загадку говорящего камня. И вот перед ними {enemy}.
+— Дальше не пройдете! — {enemy?прогремел|прогремела|прогремело|прогремели} {enemy}.
+
+{Child} не {child?растерялся|растерялась}:
+— А ты сам{enemy?|а|о|и} хочешь увидеть Звезду Желаний?
+{Enemy} {enemy?задумался|задумалась|задумалось|задумались}. Оказалось, {enemy?он|она|оно|они} так долго {enemy?сторожил|сторожила|сторожило|сторожили} дорогу, что ни разу не {enemy?видел|видела|видело|видели} Звезду.
+
+Дальше они пошли втроем. Звезда засияла так ярко, что каждый загадал желание. А {enemy} {enemy?пожелал|пожелала|пожелало|пожелали} только одного — чтобы у {enemy?него|нее|него|них} всегда были такие друзья.
+
+Самое большое сокровище в любом приключении — друзья рядом.""",
+
+"default": """Сказка про {hero:accs}
+
+Далеко-далеко есть чудесное место — {location}. Там {hero?жил|жила|жило|жили} {hero}.
+
+Однажды {hero} {hero?заметил|заметила|заметило|заметили}, что {enemy} {enemy?ходит|ходит|ходит|ходят} хмур{enemy?ый|ая|ое|ые} и всех обижает.
+— Почему ты {enemy?такой сердитый|такая сердитая|такое сердитое|такие сердитые}? — {hero?спросил|спросила|спросило|спросили} {hero}.
+Но {enemy} только {enemy?отвернулся|отвернулась|отвернулось|отвернулись}.
+
+Тогда {hero} {hero?пошел|пошла|пошло|пошли} за советом к {child:datv}. {Child} {child?подумал|подумала} и {child?сказал|сказала}:
+— Наверное, {enemy?ему|ей|ему|им} просто никто не говорил доброго слова.
+
+На следующий день {hero} и {child} принесли {enemy:datv} корзинку яблок и позвали играть.
+{Enemy} сначала {enemy?удивился|удивилась|удивилось|удивились}, потом {enemy?улыбнулся|улыбнулась|улыбнулось|улыбнулись}, а к вечеру {enemy?смеялся|смеялась|смеялось|смеялись} громче всех.
+
+Доброе слово и дружба делают сердитых веселыми."""},
+
+"3": {
+"magic": """{Hero} и тайна волшебного колокольчика
+
+Далеко-далеко есть удивительное место — {location}. Там, среди старых деревьев и светящихся тропинок, {hero?жил|жила|жило|жили} {hero}. Каждый вечер {hero} {hero?слушал|слушала|слушало|слушали}, как звенит волшебный колокольчик: его звон зажигал звезды и укладывал спать всех жителей.
+
+Но однажды колокольчик не зазвенел. Звезды не зажглись, и в темноте никто не мог уснуть. Утром {hero} {hero?нашел|нашла|нашло|нашли} на тропинке следы и {hero?понял|поняла|поняло|поняли}: колокольчик {enemy?унес|унесла|унесло|унесли} {enemy}.
+
+{Hero} {hero?отправился|отправилась|отправилось|отправились} в путь вместе с {child:ablt}. {Child} {child?был|была} {child?смелым|смелой} и {child?умел|умела} замечать то, чего не видят другие.
+
+Они шли через Шепчущий лес, где деревья задавали загадки. Первую загадку {child?отгадал|отгадала} {child}, вторую — {hero}, а третью они отгадали вместе. Деревья расступились и показали дорогу.
+
+В конце пути они увидели {enemy:accs}. {Enemy} {enemy?сидел|сидела|сидело|сидели} у колокольчика и {enemy?пытался|пыталась|пыталось|пытались} в него позвонить, но колокольчик молчал.
+— Почему он не звенит? — {enemy?спросил|спросила|спросило|спросили} {enemy} с обидой. — Я так хотел{enemy?|а|о|и} услышать его совсем близко!
+
+{Child} {child?подумал|подумала} и {child?сказал|сказала}:
+— Колокольчик звенит, только когда его звон нужен всем, а не одному.
+
+{Enemy} {enemy?опустил|опустила|опустило|опустили} глаза. Тогда {hero} {hero?предложил|предложила|предложило|предложили} позвонить втроем. Колокольчик тихонько дрогнул — и вдруг зазвенел так чисто и звонко, что в небе одна за другой загорелись звезды.
+
+С тех пор {enemy} каждый вечер {enemy?приходил|приходила|приходило|приходили} к {hero:datv}, и они вместе слушали звон колокольчика. А {child} знал{child?|а}: самое сильное волшебство рождается, когда им делятся.""",
+
+"adventure": """{Hero} и загадка старого маяка
+
+Далеко-далеко есть таинственное место — {location}. Там {hero?жил|жила|жило|жили} {hero}, {hero?который|которая|которое|которые} больше всего на свете {hero?любил|любила|любило|любили} загадки.
+
+Однажды на берегу погас старый маяк. Корабли не могли найти дорогу домой, а по ночам над водой слышался странный гул. Все говорили, что во всем виноват{enemy?|а|о|ы} {enemy}.
+
+— Надо разобраться, — {hero?решил|решила|решило|решили} {hero} и {hero?позвал|позвала|позвало|позвали} на помощь {child:accs}. {Child} {child?был|была} {child?наблюдательным|наблюдательной} и {child?умел|умела} замечать мелочи.
+
+Они взяли фонарик, блокнот и отправились к маяку. По дороге {child} {child?нашел|нашла} первую подсказку — перо, пахнущее морской солью. Потом {hero} {hero?заметил|заметила|заметило|заметили} на песке следы, которые вели наверх по винтовой лестнице.
+
+На самой вершине маяка сидел{enemy?|а|о|и} {enemy}. Рядом лежала разбитая лампа.
+— Это ты погасил{enemy?|а|о|и} маяк? — {child?спросил|спросила} {child}.
+— Я не {enemy?хотел|хотела|хотело|хотели}! — {enemy?воскликнул|воскликнула|воскликнуло|воскликнули} {enemy}. — Я {enemy?пытался|пыталась|пыталось|пытались} починить лампу, но только сломал{enemy?|а|о|и} ее еще сильнее. А гудел ветер в трубе: я закрыл{enemy?|а|о|и} окно, чтобы никто меня не увидел.
+
+{Hero} и {child} переглянулись. Оказалось, {enemy} просто {enemy?боялся|боялась|боялось|боялись}, что все рассердятся.
+
+Втроем они собрали лампу: {child} {child?держал|держала} детали, {hero} {hero?прикручивал|прикручивала|прикручивало|прикручивали} винтики, а {enemy} {enemy?светил|светила|светило|светили} фонариком. К ночи маяк засиял, и корабли один за другим вернулись в гавань.
+
+Жители устроили праздник и пригласили {enemy:accs} почетным гостем. А {hero} записал{hero?|а|о|и} в блокнот главный вывод: прежде чем винить, нужно узнать, что случилось на самом деле.""",
+
+"default": """Сказка про {hero:accs}
+
+Далеко-далеко есть чудесное место — {location}. Там {hero?жил|жила|жило|жили} {hero}. Жизнь текла спокойно, пока однажды не {enemy?появился|появилась|появилось|появились} {enemy}.
+
+{Enemy} {enemy?ворчал|ворчала|ворчало|ворчали}, {enemy?прогонял|прогоняла|прогоняло|прогоняли} всех с полянки и никому не {enemy?давал|давала|давало|давали} играть. Жители стали обходить {enemy:accs} стороной, а {hero} {hero?задумался|задумалась|задумалось|задумались}: почему кто-то становится таким сердитым?
+
+Посоветоваться {hero} {hero?пошел|пошла|пошло|пошли} к {child:datv}. {Child} внимательно {child?выслушал|выслушала} и {child?сказал|сказала}:
+— Может быть, {enemy?ему|ей|ему|им} просто плохо и одиноко? Давай узнаем.
+
+Они долго наблюдали за {enemy:ablt} и заметили, что каждый вечер {enemy} {enemy?сидит|сидит|сидит|сидят} у старого пня и грустно смотрит на чужие окна, где горит свет и слышен смех.
+
+Тогда {hero} и {child} решились. Они постучали и позвали {enemy:accs} на чай с пирогами.
+— Меня? — {enemy?удивился|удивилась|удивилось|удивились} {enemy}. — Но я ведь всех прогонял{enemy?|а|о|и}...
+— Мы знаем, — {child?ответил|ответила} {child}. — Но мы думаем, что ты можешь быть {enemy?другим|другой|другим|другими}.
+
+В тот вечер {enemy} впервые {enemy?смеялся|смеялась|смеялось|смеялись}. А на следующий день {enemy?сам|сама|само|сами} {enemy?позвал|позвала|позвало|позвали} всех на полянку играть.
+
+Иногда за сердитым видом прячется тот, кому просто нужен друг. И одно доброе дело может изменить очень многое."""}}
+
+TEMPLATES["1"]["magic"] = TEMPLATES["1"]["default"]
+TEMPLATES["2"]["lesson"] = TEMPLATES["2"]["default"]
+TEMPLATES["3"]["animals"] = TEMPLATES["3"]["default"]
+TEMPLATES["3"]["lesson"] = TEMPLATES["3"]["default"]
+
+PLACEHOLDER = re.compile(r"\{(\w+)(?::(\w+))?(?:\?([^}]*))?\}")
+
+def compile_template(template: str) -> list:
+   '''Разбивает шаблон на текст и подстановки (роль, падеж, формы по роду)'''
+   parts = []
+   position = 0
+   for match in PLACEHOLDER.finditer(template):
+      parts.append(template[position:match.start()])
+      role, case, forms = match.groups()
+      parts.append((role.lower(), case, forms.split("|") if forms is not None else None,
+      		    role[0].isupper()))
+      position = match.end()
+   parts.append(template[position:])
+   return parts
+
+#Шаблоны разбираются один раз при импорте
+COMPILED = {age: {family: compile_template(text) for family, text in templates.items()}
+	    for age, templates in TEMPLATES.items()}
+
+NOMINAL = {"NOUN", "ADJF", "PRTF", "NUMR"}
+
+def match_case(word, original):
+   word = word.replace("ё", "е")			#В шаблонах и ответах бота "е"
+   if original.isupper() and len(original) > 1:
+      return word.upper()
+   return word.capitalize() if original[:1].isupper() else word
+
+def nominative_parse(morph, word):
+   '''Разбор слова как существительного или прилагательного в именительном падеже'''
+   for parse in morph.parse(word):
+      if parse.tag.POS in NOMINAL and parse.tag.case == "nomn":
+         return parse
+   return None
+
+@lru_cache(maxsize = 4096)
+def analyze(phrase: str):
+   '''Слова именной группы в начале фразы ("девочка Катя", "котенок-плутишка")
+   и род главного слова. Остаток ("..., которая не верила в магию") не склоняется'''
+   morph = get_morph()
+   tokens = re.split(r"(\s+|-)", phrase)
+   if morph is None:
+      return tokens, [], None
+   parses = []
+   gender = None
+   animacy = None
+   for index, token in enumerate(tokens):
+      if not token.strip() or token == "-":
+         continue
+      word = token.lower().rstrip(",;:")
+      parse = nominative_parse(morph, word) if word.isalpha() else None
+      if parse is None:
+         if word.isalpha() and "ADVB" in morph.parse(word)[0].tag:	#"вечно смеющийся мышонок"
+            continue
+         break
+      parses.append((index, parse))
+      if parse.tag.POS == "NOUN" and gender is None:
+         gender = "plur" if parse.tag.number == "plur" else parse.tag.gender
+         animacy = parse.tag.animacy
+      if word != token.lower():			#Дальше запятая: придаточное не склоняем
+         break
+   return tokens, [(index, parse, animacy) for index, parse in parses], gender
+
+@lru_cache(maxsize = 4096)
+def inflect(phrase: str, case: str) -> str:
+   '''Фраза в нужном падеже; без pymorphy2 или для незнакомых слов - как есть'''
+   tokens, parses, gender = analyze(phrase)
+   if case == "nomn" or not parses:
+      return phrase
+   tokens = list(tokens)
+   for index, parse, animacy in parses:
+      grammemes = {case}
+      if (case == "accs" and parse.tag.POS != "NOUN" and animacy
+      	  and (parse.tag.gender == "masc" or parse.tag.number == "plur")):
+         grammemes.add(animacy)				#"страшного льва", но "высохший ручей"
+      inflected = parse.inflect(grammemes) or parse.inflect({case})
+      if inflected:
+         original = tokens[index]
+         tail = original[len(original.rstrip(",;:")):]
+         tokens[index] = match_case(inflected.word, original) + tail
+   return "".join(tokens)
+
+ENDING_GENDERS = [("ая", "femn"), ("яя", "femn"), ("ое", "neut"), ("ее", "neut"),
+		  ("ые", "plur"), ("ие", "plur"), ("а", "femn"), ("я", "femn"), ("о", "neut")]
+
+def phrase_gender(phrase: str) -> str:
+   '''Род главного слова; без pymorphy2 - по окончанию первого слова'''
+   gender = analyze(phrase)[2]
+   if gender:
+      return gender
+   word = re.split(r"[\s,-]", phrase.lower(), 1)[0]
+   for ending, gender in ENDING_GENDERS:
+      if word.endswith(ending):
+         return gender
+   return "masc"
+
+def clean(value, default) -> str:
+   '''Ответ пользователя без лишних пробелов; "придумай сам" и пустой ответ - значение по умолчанию'''
+   text = " ".join(str(value or "").split()).strip(" .!?")
+   if not text or "придумай" in text.lower():
+      return default
+   return text
+
+def genre_family(genre: str) -> str:
+   genre = (genre or "").lower()
+   for key, family in GENRE_FAMILIES:
+      if key in genre:
+         return family
+   return "default"
+
+def render(parts, roles: dict, genders: dict) -> str:
+   out = []
+   for part in parts:
+      if isinstance(part, str):
+         out.append(part)
+         continue
+      role, case, forms, capital = part
+      if forms is not None:
+         index = GENDER_INDEX.get(genders[role], 0)
+         text = forms[index] if index < len(forms) else forms[0]
+      else:
+         text = html.escape(inflect(roles[role], case or "nomn"))
+      out.append(text[:1].upper() + text[1:] if capital else text)
+   return "".join(out)
+
+def without_free_text(data: dict) -> dict:
+   '''Копия анкеты без ответов своим текстом: сказка получится по значениям DEFAULTS'''
+   return {key: value for key, value in data.items() if key not in FREE_TEXT_FIELDS}
+
+def fallback_story(data: dict) -> str:
+   '''Запасная сказка по анкете: подбирает шаблон и подставляет склоненные значения'''
+   roles = {"hero": clean(data.get("hero"), DEFAULTS["hero"]),
+   	    "enemy": clean(data.get("enemy"), DEFAULTS["enemy"]),
+   	    "location": clean(data.get("location"), DEFAULTS["location"]),
+   	    "child": clean(data.get("child_name"), DEFAULTS["child"])}
+   genders = {"hero": phrase_gender(roles["hero"]),
+   	      "enemy": phrase_gender(roles["enemy"]),
+   	      "location": phrase_gender(roles["location"]),
+   	      "child": "femn" if data.get("gender") == "девочка" else "masc"}
+   templates = COMPILED.get(data.get("age"), COMPILED["2"])
+   parts = templates.get(genre_family(data.get("genre")), templates["default"])
+   return render(parts, roles, genders).strip()
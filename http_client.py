@@ -0,0 +1,57 @@
+import os			#Для чтения настроек из переменных окружения
+import aiohttp			#Для асинхронных HTTP-запросов к API
+from metrics import metrics
+
+#Настройки по умолчанию для каждого внешнего сервиса
+UPSTREAM_DEFAULTS = {"deepseek": {"limit": 20,			#Максимум одновременных соединений
+				  "keepalive": 60,		#Сколько держать простаивающее соединение, сек
+				  "dns_ttl": 300,		#Кэш DNS, сек
+				  "connect_timeout": 10,	#Установка TCP+TLS соединения, сек
+				  "read_timeout": 120,		#Ожидание данных от сервера, сек
+				  "total_timeout": 180},	#Весь запрос целиком, сек
+		     "speechkit": {"limit": 10,
+		     		   "keepalive": 60,
+		     		   "dns_ttl": 300,
+		     		   "connect_timeout": 10,
+		     		   "read_timeout": 60,
+		     		   "total_timeout": 90}}
+
+def upstream_settings(name) -> dict:
+   '''Настройки сервиса с учетом переменных окружения,
+   например DEEPSEEK_CONNECT_TIMEOUT=5 или SPEECHKIT_LIMIT=4'''
+   settings = dict(UPSTREAM_DEFAULTS[name])
+   for key, value in settings.items():
+      env_value = os.getenv(f"{name.upper()}_{key.upper()}")
+      if env_value:
+         settings[key] = int(env_value) if key == "limit" else float(env_value)
+   return settings
+
+def make_trace_config(name) -> aiohttp.TraceConfig:
+   '''Считает новые соединения (рукопожатия) и повторно использованные'''
+   trace_config = aiohttp.TraceConfig()
+
+   async def on_connection_create_end(session, context, params):
+      metrics.inc("http_handshakes_total", upstream = name)
+
+   async def on_connection_reuseconn(session, context, params):
+      metrics.inc("http_connections_reused_total", upstream = name)
+
+   trace_config.on_connection_create_end.append(on_connection_create_end)
+   trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+   return trace_config
+
+def create_session(name) -> aiohttp.ClientSession:
+   '''Долгоживущая сессия для одного внешнего сервиса с пулом соединений.
+   Создается в main() и закрывается при остановке бота'''
+   settings = upstream_settings(name)
+   connector = aiohttp.TCPConnector(limit = settings["limit"],
+   				    keepalive_timeout = settings["keepalive"],
+   				    ttl_dns_cache = settings["dns_ttl"],
+   				    use_dns_cache = True)
+   timeout = aiohttp.ClientTimeout(total = settings["total_timeout"],
+   				   connect = settings["connect_timeout"],
+   				   sock_connect = settings["connect_timeout"],
+   				   sock_read = settings["read_timeout"])
+   return aiohttp.ClientSession(connector = connector,
+   				timeout = timeout,
+   				trace_configs = [make_trace_config(name)])
@@ -0,0 +1,138 @@
+'''Структурированные логи: одна JSON-строка на запись. Обработчики бота только кладут
+запись в очередь, форматирование и вывод в stdout идут в потоке QueueListener.
+Каждая запись несет request_id обновления Telegram, по которому видна вся цепочка
+модерация -> генерация -> озвучка'''
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os			#Для чтения настроек из переменных окружения
+import queue
+import random
+import re
+import sys
+import zlib
+from datetime import datetime, timezone
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+#Переменные окружения с секретами: их значения вырезаются из логов
+SECRET_ENV = ("TELEGRAM_TOKEN", "DEEPSEEK_API_KEY", "YANDEX_TTS_API_KEY", "WEBHOOK_SECRET")
+SECRET_PATTERNS = [re.compile(r"(Bearer|Api-Key)\s+[\w.\-]+", re.IGNORECASE),
+		   re.compile(r"\b\d{6,}:[\w-]{30,}")]			#Токен бота, в том числе в URL
+
+request_id = contextvars.ContextVar("request_id", default = None)
+current_user_id = contextvars.ContextVar("current_user_id", default = None)
+
+#Стандартные поля LogRecord; остальное (extra=...) попадает в JSON как есть
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "user_id"}
+
+class ContextFilter(logging.Filter):
+   '''Выполняется в потоке, где создана запись: запоминает контекст запроса и делает выборку'''
+   def __init__(self, sample_rate = 1.0):
+      super().__init__()
+      self.sample_rate = sample_rate
+
+   def filter(self, record):
+      record.request_id = request_id.get()
+      record.user_id = current_user_id.get()
+      if self.sample_rate >= 1 or record.levelno >= logging.WARNING:
+         return True
+      if record.request_id is None:
+         return random.random() < self.sample_rate
+      return zlib.crc32(str(record.request_id).encode()) % 10000 < self.sample_rate * 10000
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+   '''QueueHandler без форматирования в вызывающем потоке: сообщение собирается
+   из msg и args уже в потоке QueueListener'''
+   def prepare(self, record):
+      return record
+
+class Redactor:
+   def __init__(self):
+      self.secrets = sorted({value for value in (os.getenv(name) for name in SECRET_ENV)
+      			     if value and len(value) >= 6}, key = len, reverse = True)
+
+   def __call__(self, text: str) -> str:
+      for secret in self.secrets:
+         text = text.replace(secret, "***")
+      for pattern in SECRET_PATTERNS:
+         text = pattern.sub(lambda match: (match.group(1) + " ***") if match.lastindex else "***", text)
+      return text
+
+class JsonFormatter(logging.Formatter):
+   def __init__(self, redact):
+      super().__init__()
+      self.redact = redact
+
+   def format(self, record):
+      entry = {"ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec = "milliseconds"),
+      	       "level": record.levelname,
+      	       "logger": record.name,
+      	       "msg": record.getMessage()}
+      if getattr(record, "request_id", None) is not None:
+         entry["request_id"] = record.request_id
+      if getattr(record, "user_id", None) is not None:
+         entry["user_id"] = record.user_id
+      for key, value in vars(record).items():
+         if key not in RECORD_FIELDS:
+            entry[key] = value
+      if record.exc_info:
+         entry["exc"] = self.formatException(record.exc_info)
+      return self.redact(json.dumps(entry, ensure_ascii = False, default = str))
+
+class TextFormatter(logging.Formatter):
+   def __init__(self, redact):
+      super().__init__("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+      self.redact = redact
+
+   def format(self, record):
+      return self.redact(super().format(record))
+
+listener = None
+
+def setup_logging():
+   '''Настраивает корневой логгер. Вызывается один раз при запуске, после загрузки .env'''
+   global listener
+   if listener is not None:
+      return
+   log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+   log_format = os.getenv("LOG_FORMAT", "json")			#json или text (удобнее читать при разработке)
+   #Доля сохраняемых записей DEBUG и INFO (WARNING и выше пишутся всегда).
+   #Выборка идет по request_id: цепочка одного обновления сохраняется или отбрасывается целиком
+   sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+   #Уровни отдельных логгеров, например "aiogram.event=WARNING,speechkit=DEBUG"
+   log_levels = os.getenv("LOG_LEVELS", "aiogram.event=WARNING,aiohttp.access=WARNING")
+
+   redact = Redactor()
+   output = logging.StreamHandler(sys.stdout)
+   output.setFormatter(TextFormatter(redact) if log_format == "text" else JsonFormatter(redact))
+
+   records = queue.SimpleQueue()
+   handler = DeferredQueueHandler(records)
+   handler.addFilter(ContextFilter(sample_rate))
+   root = logging.getLogger()
+   root.handlers[:] = [handler]
+   root.setLevel(log_level)
+   for item in filter(None, log_levels.split(",")):
+      name, _, level = item.partition("=")
+      logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+   listener = logging.handlers.QueueListener(records, output)
+   listener.start()
+   atexit.register(listener.stop)			#Дописываем очередь при выходе
+
+class CorrelationMiddleware(BaseMiddleware):
+   '''Привязывает к обработке обновления request_id (update_id) и user_id.
+   Значения переходят во все await, задачи asyncio и asyncio.to_thread, запущенные из обработчика'''
+   async def __call__(self, handler, event: Update, data):
+      user = data.get("event_from_user")
+      tokens = (request_id.set(event.update_id),
+      		current_user_id.set(user.id if user else None))
+      try:
+         return await handler(event, data)
+      finally:
+         request_id.reset(tokens[0])
+         current_user_id.reset(tokens[1])
@@ -0,0 +1,171 @@
+'''Метрики бота: счетчики, текущие показатели и гистограммы длительности.
+Отдаются в текстовом формате Prometheus (см. start_metrics_server)'''
+
+import asyncio
+import logging
+import threading			#Счетчики обновляются и из потоков записи статистики
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+#Границы корзин гистограмм по умолчанию, в секундах: от проверки слов до генерации сказки
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+class Metrics:
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.counters = {}			#Накопительные счетчики
+      self.gauges = {}				#Текущие значения
+      self.gauge_callbacks = {}			#Показатели, вычисляемые при чтении
+      self.histograms = {}			#(имя, метки) -> [счетчики по корзинам, сумма, количество]
+      self.buckets = {}				#Имя гистограммы -> границы корзин, если не по умолчанию
+
+   @staticmethod
+   def key(name, labels):
+      return (name, tuple(sorted(labels.items())))
+
+   def inc(self, name, value = 1, **labels):
+      '''Увеличивает счетчик name с метками labels'''
+      key = self.key(name, labels)
+      with self.lock:
+         self.counters[key] = self.counters.get(key, 0) + value
+
+   def set(self, name, value, **labels):
+      '''Устанавливает текущее значение показателя'''
+      with self.lock:
+         self.gauges[self.key(name, labels)] = value
+
+   def gauge(self, name, callback, **labels):
+      '''Регистрирует показатель, значение которого берется из callback().
+      callback вызывается в потоке цикла событий (см. collect) и может читать его объекты
+      (asyncio.Queue, словари сессий), но не должен блокировать: никакого ввода-вывода'''
+      with self.lock:
+         self.gauge_callbacks[self.key(name, labels)] = callback
+
+   def histogram(self, name, buckets):
+      '''Задает свои границы корзин для гистограммы name'''
+      with self.lock:
+         self.buckets[name] = tuple(sorted(buckets))
+
+   def observe(self, name, value, **labels):
+      '''Добавляет значение в гистограмму name с метками labels'''
+      key = self.key(name, labels)
+      with self.lock:
+         buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+         histogram = self.histograms.get(key)
+         if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+         index = bisect_left(buckets, value)		#Первая корзина, в которую попадает значение
+         if index < len(buckets):
+            histogram[0][index] += 1
+         histogram[1] += value
+         histogram[2] += 1
+
+   @contextmanager
+   def timer(self, name, **labels):
+      '''Замеряет длительность блока with (в том числе с await внутри) в секундах'''
+      started = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.observe(name, time.perf_counter() - started, **labels)
+
+   def get(self, name, **labels):
+      key = self.key(name, labels)
+      with self.lock:
+         if key in self.gauge_callbacks:
+            callback = self.gauge_callbacks[key]
+         else:
+            return self.counters.get(key, self.gauges.get(key, 0))
+      return callback()
+
+   def snapshot(self) -> dict:
+      '''Все метрики в виде {(имя, метки): значение}'''
+      with self.lock:
+         result = dict(self.counters)
+         result.update(self.gauges)
+         callbacks = dict(self.gauge_callbacks)
+      for key, callback in callbacks.items():
+         result[key] = callback()
+      return result
+
+   def collect(self) -> tuple:
+      '''Копия всех метрик для format_metrics. Показатели-callback вычисляются здесь,
+      в вызывающем потоке: для /metrics это цикл событий'''
+      with self.lock:
+         counters = dict(self.counters)
+         gauges = dict(self.gauges)
+         callbacks = dict(self.gauge_callbacks)
+         histograms = {key: (list(counts), total, count)
+         	       for key, (counts, total, count) in self.histograms.items()}
+         buckets = dict(self.buckets)
+      for key, callback in callbacks.items():
+         try:
+            gauges[key] = callback()
+         except Exception as e:
+            log.warning("Ошибка чтения метрики %s: %r", key[0], e)
+      return counters, gauges, histograms, buckets
+
+   def render(self) -> str:
+      '''Все метрики в текстовом формате Prometheus'''
+      return format_metrics(self.collect())
+
+def format_metrics(collected) -> str:
+   '''Текст в формате Prometheus по результату Metrics.collect(). Только форматирование
+   готовых значений, поэтому может выполняться в отдельном потоке'''
+   counters, gauges, histograms, buckets = collected
+   lines = []
+   for kind, values in (("counter", counters), ("gauge", gauges)):
+      for name, series in group(values):
+         lines.append(f"# TYPE {name} {kind}")
+         for labels, value in series:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+   for name, series in group(histograms):
+      lines.append(f"# TYPE {name} histogram")
+      bounds = buckets.get(name, DEFAULT_BUCKETS)
+      for labels, (counts, total, count) in series:
+         cumulative = 0
+         for bound, bucket_count in zip(bounds, counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+         lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+         lines.append(f"{name}_sum{format_labels(labels)} {total}")
+         lines.append(f"{name}_count{format_labels(labels)} {count}")
+   return "\n".join(lines) + "\n"
+
+def group(values: dict):
+   '''Серии метрик, сгруппированные по имени: [(имя, [(метки, значение)])]'''
+   grouped = {}
+   for (name, labels), value in values.items():
+      grouped.setdefault(name, []).append((labels, value))
+   return sorted((name, sorted(series, key = lambda item: item[0])) for name, series in grouped.items())
+
+def escape(value) -> str:
+   return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels) -> str:
+   if not labels:
+      return ""
+   return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+async def start_metrics_server(host, port) -> web.AppRunner:
+   '''HTTP-сервер с метриками на /metrics (для Prometheus)'''
+   async def handle(request):
+      #Показатели-callback читают объекты цикла событий и вычисляются здесь же,
+      #в потоке - только форматирование текста
+      text = await asyncio.to_thread(format_metrics, metrics.collect())
+      return web.Response(text = text, content_type = "text/plain", charset = "utf-8")
+
+   app = web.Application()
+   app.router.add_get("/metrics", handle)
+   runner = web.AppRunner(app, access_log = None)
+   await runner.setup()
+   await web.TCPSite(runner, host, port).start()
+   log.info("📈 Метрики доступны на http://%s:%s/metrics", host, port)
+   return runner
+
+#Глобальный реестр метрик
+metrics = Metrics()
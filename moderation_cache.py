@@ -0,0 +1,75 @@
+import hashlib			#Для ключа кэша
+import json
+import logging
+import threading		#Кэш используется из потоков asyncio.to_thread
+import time
+from metrics import metrics
+from stats_store import connect_db
+
+log = logging.getLogger(__name__)
+
+#Параметры анкеты, от которых зависит вердикт модерации
+MODERATION_FIELDS = ['age', 'genre', 'style', 'location', 'hero', 'enemy', 'child_name', 'gender']
+
+def normalize_value(value) -> str:
+   '''Приводит ответ к единому виду: регистр, ё/е, лишние пробелы и знаки по краям'''
+   text = str(value).lower().replace('ё', 'е')
+   return " ".join(text.split()).strip(" .,!?;:\"'")
+
+class ModerationCache:
+   '''Кэш вердиктов модерации по нормализованным параметрам анкеты.
+   Записи живут ttl секунд, их число ограничено max_entries.
+   При изменении промта модерации (prompt_version) старые вердикты удаляются'''
+   CLEANUP_EVERY = 100
+   def __init__(self, db_path, prompt_version, ttl = 7 * 24 * 3600, max_entries = 50000):
+      self.prompt_version = prompt_version	#Хэш промта модерации
+      self.ttl = ttl				#Время жизни вердикта, сек
+      self.max_entries = max_entries		#Максимум записей
+      self.lock = threading.Lock()
+      self.puts = 0				#Очистка выполняется раз в CLEANUP_EVERY записей
+      self.conn = connect_db(db_path)
+      with self.conn:
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS verdicts (
+         			key TEXT PRIMARY KEY,
+         			approved INTEGER NOT NULL,
+         			feedback TEXT NOT NULL,
+         			created REAL NOT NULL,
+         			prompt_version TEXT NOT NULL)""")
+         self.conn.execute("CREATE INDEX IF NOT EXISTS verdicts_created ON verdicts (created)")
+         #Вердикты, полученные со старым промтом, больше не действительны
+         deleted = self.conn.execute("DELETE FROM verdicts WHERE prompt_version != ?",
+         			     (prompt_version,)).rowcount
+      if deleted:
+         log.info("🧹 Промт модерации изменился, удалено вердиктов из кэша: %s", deleted)
+
+   @staticmethod
+   def make_key(user_data: dict) -> str:
+      values = [normalize_value(user_data.get(field, 'N/A')) for field in MODERATION_FIELDS]
+      return hashlib.sha256(json.dumps(values, ensure_ascii = False).encode("utf-8")).hexdigest()
+
+   def get(self, user_data: dict):
+      '''Возвращает (is_approved, feedback) или None'''
+      key = self.make_key(user_data)
+      with self.lock:
+         row = self.conn.execute("""SELECT approved, feedback FROM verdicts
+         			    WHERE key = ? AND prompt_version = ? AND created > ?""",
+         			    (key, self.prompt_version, time.time() - self.ttl)).fetchone()
+      metrics.inc("moderation_cache_total", result = "hit" if row else "miss")
+      return (bool(row[0]), row[1]) if row else None
+
+   def put(self, user_data: dict, is_approved: bool, feedback: str):
+      key = self.make_key(user_data)
+      now = time.time()
+      with self.lock, self.conn:
+         self.conn.execute("""INSERT OR REPLACE INTO verdicts
+         		      (key, approved, feedback, created, prompt_version)
+         		      VALUES (?, ?, ?, ?, ?)""",
+         		      (key, int(is_approved), feedback, now, self.prompt_version))
+         self.puts += 1
+         if self.puts % self.CLEANUP_EVERY:
+            return
+         #Удаляем устаревшие и самые старые записи сверх лимита
+         self.conn.execute("DELETE FROM verdicts WHERE created <= ?", (now - self.ttl,))
+         self.conn.execute("""DELETE FROM verdicts WHERE key IN (
+         		      SELECT key FROM verdicts ORDER BY created DESC LIMIT -1 OFFSET ?)""",
+         		      (self.max_entries,))
@@ -0,0 +1,25 @@
+'''Общий анализатор pymorphy2 для проверки сообщений и склонения в запасных сказках'''
+
+import logging
+import threading		#Словари загружаются один раз, даже при одновременных вызовах
+
+log = logging.getLogger(__name__)
+
+morph = None
+morph_unavailable = False
+morph_lock = threading.Lock()
+
+def get_morph():
+   '''MorphAnalyzer, созданный при первом вызове, или None, если pymorphy2 недоступен'''
+   global morph, morph_unavailable
+   if morph is not None or morph_unavailable:
+      return morph
+   with morph_lock:
+      if morph is None and not morph_unavailable:
+         try:
+            import pymorphy2
+            morph = pymorphy2.MorphAnalyzer()
+         except Exception as e:
+            morph_unavailable = True
+            log.warning("⚠️ pymorphy2 недоступен: %r", e)
+   return morph
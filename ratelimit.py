@@ -0,0 +1,98 @@
+'''Ограничение частоты сообщений от одного пользователя (token bucket).
+Отдельные лимиты для команд, шагов анкеты и дорогих действий (генерация сказки, озвучка),
+чтобы несколько назойливых клиентов не замедляли бота для всех остальных'''
+
+import logging
+import math
+import os			#Для чтения настроек из переменных окружения
+import time
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+#Лимиты по видам сообщений по умолчанию, переопределяются переменной RATE_LIMITS:
+#"вид=запас:пополнение в секунду", например "command=5:0.1". Вид без лимита (или пустая строка) не ограничивается
+DEFAULT_RATE_LIMITS = "command=5:0.1,step=15:1,expensive=4:0.05"
+
+def parse_limits(text: str) -> dict:
+   '''"command=5:0.1,step=15:1" -> {"command": (5.0, 0.1), "step": (15.0, 1.0)}'''
+   limits = {}
+   for item in filter(None, text.split(",")):
+      kind, _, value = item.partition("=")
+      burst, _, rate = value.partition(":")
+      if float(burst) > 0 and float(rate) > 0:
+         limits[kind.strip()] = (float(burst), float(rate))
+   return limits
+
+class RateLimiter:
+   '''Ведра токенов по (вид, user_id). Состояние ведра - одно число: момент, когда оно снова
+   наполнится. Полное ведро хранить незачем, такие записи удаляются при очистке'''
+   def __init__(self, limits: dict, sweep_interval = 60.0):
+      self.limits = limits				#Вид -> (запас, пополнение в секунду)
+      self.sweep_interval = sweep_interval
+      self.full_at = {kind: {} for kind in limits}	#Вид -> {user_id: момент наполнения ведра}
+      self.next_sweep = time.monotonic() + sweep_interval
+      metrics.gauge("ratelimit_buckets", lambda: sum(map(len, self.full_at.values())))
+
+   def take(self, kind, user_id, now = None) -> float:
+      '''Забирает токен. Возвращает 0, если запрос разрешен, иначе сколько секунд ждать'''
+      limit = self.limits.get(kind)
+      if limit is None:
+         return 0.0
+      burst, rate = limit
+      now = time.monotonic() if now is None else now
+      if now >= self.next_sweep:
+         self.sweep(now)
+      buckets = self.full_at[kind]
+      full_at = max(buckets.get(user_id, now), now)
+      deficit = (full_at - now) * rate			#Сколько токенов не хватает до полного ведра
+      if deficit > burst - 1:
+         return (deficit - burst + 1) / rate
+      buckets[user_id] = full_at + 1 / rate
+      return 0.0
+
+   def sweep(self, now):
+      '''Удаляет наполнившиеся ведра пользователей, которые давно не писали'''
+      for kind, buckets in self.full_at.items():
+         idle = [user_id for user_id, full_at in buckets.items() if full_at <= now]
+         for user_id in idle:
+            del buckets[user_id]
+      self.next_sweep = now + self.sweep_interval
+
+class RateLimitMiddleware(BaseMiddleware):
+   '''Пропускает сообщение, если у пользователя есть токен для его вида (kind_of(message)).
+   Иначе отвечает "подождите" - один раз, пока ограничение не снимется, - и не обрабатывает.
+   Без limits лимиты берутся из RATE_LIMITS в момент создания (после загрузки .env)'''
+   def __init__(self, kind_of, limits: dict = None):
+      self.kind_of = kind_of
+      if limits is None:
+         limits = parse_limits(os.getenv("RATE_LIMITS", DEFAULT_RATE_LIMITS))
+      self.limiter = RateLimiter(limits)
+      self.warned = set()				#(вид, user_id), которым уже ответили "подождите"
+
+   async def __call__(self, handler, event: Update, data):
+      message = event.message
+      user = data.get("event_from_user")
+      if message is None or user is None or not self.limiter.limits:
+         return await handler(event, data)
+      kind = self.kind_of(message)
+      wait = self.limiter.take(kind, user.id)
+      if not wait:
+         self.warned.discard((kind, user.id))
+         return await handler(event, data)
+
+      metrics.inc("updates_throttled_total", kind = kind)
+      if (kind, user.id) in self.warned:
+         return None					#Не отвечаем на каждое лишнее сообщение
+      self.warned.add((kind, user.id))
+      if len(self.warned) > 10000:			#Сброс на случай массовой рассылки
+         self.warned.clear()
+      log.info("⏳ Пользователь %s ограничен (%s) на %.1f сек", user.id, kind, wait)
+      try:
+         await message.answer(f"⏳ <b><i>Подождите немного</i></b>, слишком много сообщений.\n"
+         		      f"Попробуйте еще раз через {math.ceil(wait)} сек.")
+      except Exception as e:
+         log.warning("Ошибка ответа об ограничении: %r", e)
+      return None
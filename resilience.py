@@ -0,0 +1,182 @@
+import asyncio			#Для пауз между попытками и ограничения времени попытки
+import logging
+import os			#Для чтения настроек из переменных окружения
+import random			#Для разброса пауз между попытками
+import time
+import aiohttp
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+#Настройки по умолчанию для каждого внешнего сервиса
+RESILIENCE_DEFAULTS = {"deepseek": {"attempts": 3,		#Сколько всего попыток
+				    "base_delay": 0.5,		#Начальная пауза между попытками, сек
+				    "max_delay": 8,		#Максимальная пауза, сек
+				    "attempt_timeout": 90,	#Ограничение одной попытки, сек
+				    "deadline": 120,		#Ограничение всех попыток вместе, сек
+				    "failure_threshold": 5,	#Сколько ошибок подряд размыкают цепь
+				    "reset_timeout": 30},	#Через сколько секунд пробовать снова
+		       "speechkit": {"attempts": 3,
+		       		     "base_delay": 0.5,
+		       		     "max_delay": 5,
+		       		     "attempt_timeout": 30,
+		       		     "deadline": 60,
+		       		     "failure_threshold": 5,
+		       		     "reset_timeout": 30}}
+
+#Коды ответа, при которых есть смысл повторить запрос
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+#Состояния цепи (значение метрики circuit_state)
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+class UpstreamError(Exception):
+   '''Сервис ответил ошибкой. retry_after - пауза из заголовка Retry-After, сек'''
+   def __init__(self, upstream, status, text = "", retry_after = None):
+      super().__init__(f"{upstream} API error: {status}, {text[:500]}")
+      self.status = status
+      self.retry_after = retry_after
+
+   @property
+   def retryable(self) -> bool:
+      return self.status in RETRYABLE_STATUSES
+
+class CircuitOpen(Exception):
+   '''Сервис недоступен: цепь разомкнута, запрос не отправлялся'''
+
+def parse_retry_after(value):
+   '''Retry-After в секундах (формат даты не используется DeepSeek и SpeechKit)'''
+   try:
+      return max(0.0, float(value))
+   except (TypeError, ValueError):
+      return None
+
+async def raise_for_status(upstream, response: aiohttp.ClientResponse):
+   '''Превращает ответ с ошибкой в UpstreamError'''
+   if response.status == 200:
+      return
+   text = await response.text()
+   raise UpstreamError(upstream, response.status, text,
+   		       parse_retry_after(response.headers.get("Retry-After")))
+
+def is_retryable(error: Exception) -> bool:
+   if isinstance(error, UpstreamError):
+      return error.retryable
+   return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+   			     asyncio.TimeoutError))
+
+class CircuitBreaker:
+   '''После failure_threshold ошибок подряд цепь размыкается на reset_timeout секунд:
+   запросы сразу получают CircuitOpen. Затем пропускается один пробный запрос'''
+   def __init__(self, name, failure_threshold, reset_timeout):
+      self.name = name
+      self.failure_threshold = failure_threshold
+      self.reset_timeout = reset_timeout
+      self.state = CLOSED
+      self.failures = 0				#Ошибок подряд
+      self.opened_at = 0.0
+      self.probing = False			#Пробный запрос уже идет
+      metrics.gauge("circuit_state", lambda: self.state, upstream = name)
+
+   def allow(self):
+      if self.state == OPEN:
+         if time.monotonic() - self.opened_at < self.reset_timeout:
+            metrics.inc("circuit_rejected_total", upstream = self.name)
+            raise CircuitOpen(f"{self.name} is unavailable")
+         self.state = HALF_OPEN
+      if self.state == HALF_OPEN:
+         if self.probing:
+            metrics.inc("circuit_rejected_total", upstream = self.name)
+            raise CircuitOpen(f"{self.name} is unavailable")
+         self.probing = True
+
+   def record_success(self):
+      self.failures = 0
+      self.probing = False
+      if self.state != CLOSED:
+         log.info("✅ Сервис %s снова доступен", self.name)
+      self.state = CLOSED
+
+   def record_failure(self):
+      self.failures += 1
+      self.probing = False
+      if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+         if self.state != OPEN:
+            log.warning("⚡ Сервис %s недоступен, запросы приостановлены на %s сек", self.name, self.reset_timeout)
+            metrics.inc("circuit_opened_total", upstream = self.name)
+         self.state = OPEN
+         self.opened_at = time.monotonic()
+
+   def record_neutral(self):
+      '''Ошибка на стороне запроса (например, 400) - сервис работает'''
+      self.probing = False
+      if self.state == HALF_OPEN:
+         self.state = CLOSED
+         self.failures = 0
+
+class Upstream:
+   '''Повторы с экспоненциальной паузой и разбросом, учет Retry-After,
+   ограничение времени попытки и всего вызова, размыкатель цепи'''
+   def __init__(self, name, settings: dict):
+      self.name = name
+      self.settings = settings
+      self.breaker = CircuitBreaker(name, settings["failure_threshold"], settings["reset_timeout"])
+
+   def backoff(self, attempt) -> float:
+      '''Пауза перед повтором: случайная в пределах base_delay * 2^attempt (full jitter)'''
+      return random.uniform(0, min(self.settings["max_delay"], self.settings["base_delay"] * 2 ** attempt))
+
+   async def call(self, attempt_func):
+      '''Вызывает attempt_func() (новый запрос на каждую попытку) с повторами.
+      Бросает CircuitOpen, если сервис недоступен, иначе последнюю ошибку'''
+      deadline = time.monotonic() + self.settings["deadline"]
+      attempts = int(self.settings["attempts"])
+      for attempt in range(attempts):
+         self.breaker.allow()
+         remaining = deadline - time.monotonic()
+         try:
+            result = await asyncio.wait_for(attempt_func(),
+            				    min(self.settings["attempt_timeout"], remaining))
+         except asyncio.CancelledError:
+            self.breaker.probing = False		#Пользователь ушел - пробу сделает следующий запрос
+            raise
+         except Exception as e:
+            if not is_retryable(e):
+               self.breaker.record_neutral()
+               metrics.inc("upstream_requests_total", upstream = self.name, outcome = "error")
+               raise
+            self.breaker.record_failure()
+            outcome = "timeout" if isinstance(e, asyncio.TimeoutError) else "retryable_error"
+            metrics.inc("upstream_requests_total", upstream = self.name, outcome = outcome)
+            delay = self.backoff(attempt)
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None:
+               delay = max(delay, retry_after)
+            #Последняя попытка или пауза не укладывается в общий срок - сдаемся
+            if attempt == attempts - 1 or time.monotonic() + delay >= deadline:
+               raise
+            log.warning("🔁 %s: %r, повтор через %.1f сек", self.name, e, delay)
+            metrics.inc("upstream_retries_total", upstream = self.name)
+            await asyncio.sleep(delay)
+            continue
+         self.breaker.record_success()
+         metrics.inc("upstream_requests_total", upstream = self.name, outcome = "ok")
+         return result
+
+def resilience_settings(name) -> dict:
+   '''Настройки с учетом переменных окружения, например DEEPSEEK_ATTEMPTS=2
+   или SPEECHKIT_DEADLINE=45'''
+   settings = dict(RESILIENCE_DEFAULTS[name])
+   for key, value in settings.items():
+      env_value = os.getenv(f"{name.upper()}_{key.upper()}")
+      if env_value:
+         settings[key] = float(env_value)
+   return settings
+
+#Один экземпляр на сервис, чтобы состояние цепи было общим
+upstreams = {}
+
+def get_upstream(name) -> Upstream:
+   if name not in upstreams:
+      upstreams[name] = Upstream(name, resilience_settings(name))
+   return upstreams[name]
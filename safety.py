@@ -0,0 +1,225 @@
+'''Проверка сообщений на запрещенный контент по черному списку'''
+
+import logging
+import os
+import re			#Для однопроходного поиска по всему черному списку
+import threading		#Словари pymorphy2 загружаются один раз
+from functools import lru_cache
+from morphology import get_morph
+
+log = logging.getLogger(__name__)
+
+#Латинские буквы, похожие на русские: заменяются перед проверкой
+HOMOGLYPHS = str.maketrans({'a': 'а', 'e': 'е', 'o': 'о', 'p': 'р', 'c': 'с', 'x': 'х',
+			    'y': 'у', 'k': 'к', 'm': 'м', 'h': 'н', 'b': 'в', 't': 'т'})
+
+#Черный список. Каждое слово - отдельная строка с запятой: без запятой Python
+#склеивает соседние строки в одну, и оба слова перестают проверяться
+DANGEROUS_WORDS = [
+	# === ПОЛИТИКА И ГОСУДАРСТВО ===
+	# Должности
+	'президент', 'премьер', 'министр', 'губернатор', 'мэр', 'депутат',
+	'сенатор', 'политик', 'чиновник', 'администрация', 'правительство',
+	'парламент', 'правитель', 'власть', 'государство',
+	'глава',
+	#Политические термины
+	'выборы', 'голосование', 'избиратель', 'партия', 'оппозиция',
+	'революция', 'митинг', 'протест', 'демонстрация', 'закон',
+	'конституция', 'бюллетень', 'пропаганда', 'агитация',
+
+	# === ИЗВЕСТНЫЕ ПОЛИТИКИ ===
+	#Российские
+	'путин', 'медведев', 'мишустин', 'собянин', 'жириновский',
+	'зюганов', 'навальный', 'песков', 'лавров', 'шойгу', 'белоусов',
+
+	#Украинские
+	'зеленский', 'порошенко', 'янукович', 'тимошенко',
+
+	#Международные
+	'трамп', 'байден', 'обама', 'макрон', 'меркель',
+	'лукашенко', 'эрдоган', 'моди',
+
+	# === КОНФЛИКТЫ И ВОЙНА ===
+	'война', 'конфликт', 'сражение', 'битва', 'военный', 'армия',
+	'солдат', 'офицер', 'генерал', 'пушка', 'оружие',
+	'бомба', 'взрыв', 'стрельба', 'атака', 'оборона', 'фронт',
+	'окоп', 'пленных', 'убить', 'убийство', 'убив', 'смерть', 'труп',
+
+	# === НАСИЛИЕ И АГРЕССИЯ ===
+	'насилие', 'жестокость', 'агрессия', 'избиение', 'пытка',
+	'истязание', 'мучение', 'страдание', 'боль', 'кровь',
+	'рана', 'увечье', 'травма', 'нож', 'пистолет', 'автомат',
+	'граната', 'мина', 'снаряд',
+
+	# === НЕЦЕНЗУРНАЯ ЛЕКСИКА ===
+	'хуй', 'пизд', 'ебан', 'ебать', 'бляд', 'блять', 'хер',
+	'мудак', 'говно', 'дерьмо', 'залуп', 'манда', 'пидр', 'пидор',
+	'пидар', 'гондон', 'гандон', 'шлюх', 'шлюш', 'дрищ', 'даун',
+	'дебил', 'дибил', 'тупица',
+
+	# === ОПАСНОЕ ПОВЕДЕНИЕ ===
+	'наркотик', 'героин', 'кокаин', 'марихуана', 'гашиш', 'гошиш',
+	'алкоголь', 'водка', 'пиво', 'вино', 'пьяный', 'алкаш', 'драл',
+	'самоубийство', 'суицид', 'вешаться', 'резать', 'отравление',
+
+	# === ЭКСТРЕМИЗМ И СЕКТЫ ===
+	'террор', 'экстреми','экстрими', 'исламист', 'сатанизм', 'секта',
+	'оккультизм', 'колдовство', 'шаман', 'дьявол',
+	'сатана', 'демон', 'ислам', 'религия', 'бог', 'аллах',
+
+	# === ДИСКРИМИНАЦИЯ ===
+	'нацист', 'фашист', 'расист', 'ксенофоб', 'гомофоб',
+	'шовинизм', 'национал', 'еврей', 'цыган', 'кавказ',
+
+	# === ЭРОТИКА И ПОРНО ===
+	'порно', 'секс', 'интим', 'оргазм', 'сперма', 'вагина',
+	'пенис', 'грудь', 'сиськи', 'сися', 'попа', 'жопа', 'трах', 'пися',
+	'писька','писюн', 'ебля', 'сексуальный', 'эротика', 'голый', 'нагой',
+	'гомосек', 'презерват', 'призерват','призирват', 'проститут', 'лисби', 'лисбу',
+
+	# === ОПАСНЫЕ МЕСТА И СИТУАЦИИ ===
+	'тюрьма', 'зона', 'заключение', 'арест', 'суд', 'следователь',
+	'полиция', 'ментов', 'уголовник', 'преступник', 'бандит',
+	'мафия', 'наркоторговля', 'проститу', 'сутенер',
+]
+
+def build_trie_pattern(words) -> str:
+   '''Собирает слова в префиксное дерево и превращает его в регулярное выражение:
+   общие начала слов проверяются один раз (пр(?:езидент|емьер|...)), а не для каждого слова'''
+   trie = {}
+   for word in words:
+      node = trie
+      for char in word:
+         node = node.setdefault(char, {})
+      node[''] = True					#Здесь заканчивается слово
+
+   def build(node) -> str:
+      if list(node) == ['']:
+         return ''
+      branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+      body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+      if '' in node:					#Слово может закончиться здесь, а может продолжиться
+         body = '(?:' + body + ')?'
+      return body
+   return build(trie)
+
+#Весь черный список - одно регулярное выражение: текст просматривается один раз
+DANGEROUS_PATTERN = re.compile(build_trie_pattern(set(DANGEROUS_WORDS)))
+
+#Безобидные слова, внутри которых есть слово из черного списка (посуда - суд, опушка - пушка).
+#Пропускаются только слова текста, целиком совпадающие с одной из форм ниже: "посудахуй"
+#или "героином" проверяются как обычно. Формы собираются из основы и окончаний
+NOUN_MASC = ('', 'а', 'у', 'ом', 'е', 'ы', 'ов', 'ам', 'ами', 'ах')	#сезон, сезона, ...
+NOUN_MASC_K = ('', 'а', 'у', 'ом', 'е', 'и', 'ов', 'ам', 'ами', 'ах')	#После г, к, х: судаки
+NOUN_FEM = ('а', 'ы', 'е', 'у', 'ой', 'ою', '', 'ам', 'ами', 'ах')	#посуда, посуды, ...
+NOUN_FEM_K = ('а', 'и', 'е', 'у', 'ой', 'ою', 'ам', 'ами', 'ах')	#ножка, ножки, ...
+NOUN_NEUT = ('о', 'а', 'у', 'ом', 'е', '', 'ам', 'ами', 'ах')		#множество, ...
+ADJ = ('ый', 'ая', 'ое', 'ые', 'ого', 'ой', 'ому', 'ым', 'ом', 'ую', 'ою', 'ых', 'ыми')
+ALLOWED_FORMS = [
+	('посуд', NOUN_FEM), ('судьб', NOUN_FEM), ('суд', ('еб',)),		#суд
+	('сосуд', NOUN_MASC), ('судак', NOUN_MASC_K),
+	('судн', ('о', 'а', 'у', 'ом', 'е')),		#Только ед. число: "суда", "судов" - формы и слова "суд"
+	('озон', NOUN_MASC), ('сезон', NOUN_MASC), ('газон', NOUN_MASC),	#зона
+	('богат', ADJ + ('', 'а', 'о', 'ы')),					#бог
+	('богатыр', ('ь', 'я', 'ю', 'ем', 'ём', 'е', 'и', 'ей', 'ям', 'ями', 'ях')),
+	('богатств', NOUN_NEUT),
+	('стран', NOUN_FEM), ('охран', NOUN_FEM),				#рана
+	('баран', NOUN_MASC), ('экран', NOUN_MASC),
+	('виноград', NOUN_MASC), ('виноват', ADJ + ('', 'а', 'о', 'ы')),	#вино
+	('команд', NOUN_FEM), ('мандарин', NOUN_MASC),				#манда
+	('попада', ('ть', 'ю', 'ешь', 'ет', 'ем', 'ете', 'ют', 'л', 'ла', 'ло', 'ли', 'й', 'йте', 'я')),	#попа
+	('попад', ('у', 'ешь', 'ёшь', 'ет', 'ёт', 'ем', 'ём', 'ете', 'ёте', 'ут', 'и', 'ите')),
+	('попа', ('сть', 'л', 'ла', 'ло', 'ли')),
+	('страх', NOUN_MASC_K),							#трах
+	('запис', ('ь', 'и', 'ью', 'ей', 'ям', 'ями', 'ях')),			#пися: записях
+	('удра', ('л', 'ла', 'ло', 'ли')),					#драл
+	('камин', NOUN_MASC),							#мина
+	('множеств', NOUN_NEUT), ('ножниц', ('ы', '', 'ам', 'ами', 'ах')),	#нож
+	('ножк', NOUN_FEM_K), ('нож', ('ек',)),
+	('больш', ('ой', 'ая', 'ое', 'ие', 'ого', 'ому', 'им', 'ом', 'ую', 'ою', 'их', 'ими', 'е')),	#боль
+	('побольш', ('е',)),
+	('опушк', NOUN_FEM_K), ('опуш', ('ек',)),				#пушка
+	('трамплин', NOUN_MASC),						#трамп
+	#героин. Формы "героине" нет: "о героине" - это и о героине сказки, и о наркотике
+	('героин', ('я', 'и', 'ю', 'ей', 'ею', 'ь', 'ям', 'ями', 'ях')),
+]
+ALLOWED_WORDS = {stem + ending for stem, endings in ALLOWED_FORMS for ending in endings}
+#Совпадение только целым словом: до и после формы нет других букв
+ALLOWED_PATTERN = re.compile(r'(?<![а-яёa-z])' + build_trie_pattern(ALLOWED_WORDS) + r'(?![а-яёa-z])')
+
+def normalize_text(text: str) -> str:
+   '''Нижний регистр и замена английских букв на русские в похожих словах'''
+   return text.lower().translate(HOMOGLYPHS)
+
+def search_dangerous(normalized: str):
+   '''Ищет слово из черного списка как подстроку, пропуская слова текста из ALLOWED_WORDS'''
+   masked = ALLOWED_PATTERN.sub(lambda match: '_' * len(match.group(0)), normalized)
+   match = DANGEROUS_PATTERN.search(masked)
+   return match.group(0) if match else None
+
+#Слова текста (после normalize_text)
+TOKEN_PATTERN = re.compile(r'[а-яёa-z]+')
+
+#Сколько разных слов хранить в кэше слово -> результат проверки начальной формы
+LEMMA_CACHE_SIZE = int(os.getenv("SAFETY_LEMMA_CACHE_SIZE", "50000"))
+
+class MorphMatcher:
+   '''Проверка с учетом морфологии. Слова черного списка ищутся подстрокой в тексте
+   (производные слова: "террористы", "солдатик") и дополнительно в начальной форме
+   каждого слова: "войны" -> "война", "убила" -> "убить"'''
+   def __init__(self, morph):
+      self.morph = morph
+      self.check_lemma = lru_cache(maxsize = LEMMA_CACHE_SIZE)(self.search_lemma)
+
+   def search_lemma(self, token: str):
+      if token in ALLOWED_WORDS:
+         return None
+      lemma = self.morph.parse(token)[0].normal_form
+      return search_dangerous(lemma) if lemma != token else None
+
+   def find(self, normalized: str):
+      word = search_dangerous(normalized)
+      if word:
+         return word
+      for token in TOKEN_PATTERN.findall(normalized):
+         word = self.check_lemma(token)
+         if word:
+            return word
+      return None
+
+#Общий экземпляр; создается при первой проверке или в warm_up()
+morph_matcher = None
+morph_unavailable = os.getenv("SAFETY_MORPHOLOGY", "1") != "1"	#SAFETY_MORPHOLOGY=0 - только подстроки
+morph_lock = threading.Lock()
+
+def get_morph_matcher():
+   '''Строит проверку по словарям pymorphy2 один раз. Если библиотека недоступна,
+   возвращает None, и проверка идет по подстрокам'''
+   global morph_matcher, morph_unavailable
+   if morph_matcher is not None or morph_unavailable:
+      return morph_matcher
+   with morph_lock:
+      if morph_matcher is None and not morph_unavailable:
+         morph = get_morph()
+         if morph is None:
+            morph_unavailable = True
+            log.warning("⚠️ Проверка сообщений только по подстрокам")
+         else:
+            morph_matcher = MorphMatcher(morph)
+   return morph_matcher
+
+def warm_up():
+   '''Загрузка словарей при старте, чтобы первое сообщение не ждало'''
+   get_morph_matcher()
+
+def find_dangerous_word(text: str):
+   '''Возвращает найденное слово из черного списка или None'''
+   normalized = normalize_text(text or "")
+   matcher = get_morph_matcher()
+   if matcher is not None:
+      return matcher.find(normalized)
+   return search_dangerous(normalized)
+
+#Быстрая проверка по черному списку
+def safety_check(text: str) -> bool:
+   return find_dangerous_word(text) is None
@@ -0,0 +1,119 @@
+import asyncio			#Для очереди ожидания и отмены задач
+import os			#Для чтения настроек из переменных окружения
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from metrics import metrics
+
+#Ограничения по умолчанию: сколько задач одновременно выполняется и сколько ждет в очереди
+SCHEDULER_DEFAULTS = {"deepseek": {"concurrency": 8, "queue": 100},
+		      "speechkit": {"concurrency": 4, "queue": 50}}
+
+class QueueFull(Exception):
+   '''Очередь к сервису заполнена - задача отклонена сразу, без ожидания'''
+
+class AlreadyRunning(Exception):
+   '''У пользователя уже выполняется такая же задача'''
+
+class Lane:
+   '''Очередь к одному внешнему сервису: не больше concurrency задач одновременно
+   и не больше max_waiting ожидающих (FIFO)'''
+   def __init__(self, name, concurrency, max_waiting):
+      self.name = name
+      self.concurrency = concurrency
+      self.max_waiting = max_waiting
+      self.active = 0				#Сколько задач сейчас выполняется
+      self.waiting = deque()			#Ожидающие задачи (future на каждую)
+      metrics.gauge("scheduler_active", lambda: self.active, upstream = name)
+      metrics.gauge("scheduler_waiting", lambda: len(self.waiting), upstream = name)
+
+   def has_capacity(self) -> bool:
+      return self.active < self.concurrency and not self.waiting
+
+   async def acquire(self, notify = None, wait = True):
+      '''Занимает место; notify(position) вызывается, если пришлось встать в очередь'''
+      if self.has_capacity():
+         self.active += 1
+         return
+      if not wait or len(self.waiting) >= self.max_waiting:
+         metrics.inc("scheduler_rejected_total", upstream = self.name, reason = "queue_full")
+         raise QueueFull(self.name)
+      future = asyncio.get_running_loop().create_future()
+      self.waiting.append(future)
+      started = time.monotonic()
+      try:
+         if notify is not None:
+            await notify(len(self.waiting))
+         await future					#Место передаст release()
+      except BaseException:
+         if future.done() and not future.cancelled():
+            self.release()				#Место уже передано, но задача отменена
+         else:
+            future.cancel()
+            try:
+               self.waiting.remove(future)
+            except ValueError:
+               pass
+         raise
+      finally:
+         metrics.inc("scheduler_wait_seconds_total", time.monotonic() - started, upstream = self.name)
+
+   def release(self):
+      '''Освобождает место и передает его первому ожидающему'''
+      while self.waiting:
+         future = self.waiting.popleft()
+         if not future.done():
+            future.set_result(None)		#active не меняется: место переходит к следующему
+            return
+      self.active -= 1
+
+class Scheduler:
+   '''Планировщик обращений к DeepSeek и SpeechKit: отдельные ограничения
+   на каждый сервис и не больше одной задачи одного вида на пользователя'''
+   def __init__(self, settings: dict):
+      self.lanes = {name: Lane(name, limits["concurrency"], limits["queue"])
+      		    for name, limits in settings.items()}
+      self.running = set()			#(вид задачи, user_id) выполняющихся задач
+
+   def has_capacity(self, upstream) -> bool:
+      return self.lanes[upstream].has_capacity()
+
+   @asynccontextmanager
+   async def single_flight(self, kind, user_id):
+      '''Не дает пользователю запустить вторую задачу вида kind, пока идет первая'''
+      key = (kind, user_id)
+      if key in self.running:
+         metrics.inc("scheduler_rejected_total", upstream = kind, reason = "duplicate")
+         raise AlreadyRunning(kind)
+      self.running.add(key)
+      try:
+         yield
+      finally:
+         self.running.discard(key)
+
+   @asynccontextmanager
+   async def job(self, upstream, user_id = None, notify = None, wait = True):
+      '''async with scheduler.job("deepseek", user_id): ...
+      С user_id повторная задача того же пользователя вызывает AlreadyRunning.
+      Переполненная очередь (или wait=False без свободного места) - QueueFull'''
+      if user_id is not None:
+         async with self.single_flight(upstream, user_id):
+            async with self.job(upstream, None, notify, wait):
+               yield
+         return
+      lane = self.lanes[upstream]
+      await lane.acquire(notify, wait)
+      metrics.inc("scheduler_jobs_total", upstream = upstream)
+      try:
+         yield
+      finally:
+         lane.release()
+
+def scheduler_settings() -> dict:
+   '''Ограничения с учетом переменных окружения,
+   например DEEPSEEK_CONCURRENCY=4 или SPEECHKIT_QUEUE=20'''
+   settings = {}
+   for name, defaults in SCHEDULER_DEFAULTS.items():
+      settings[name] = {key: int(os.getenv(f"{name.upper()}_{key.upper()}", str(value)))
+      			for key, value in defaults.items()}
+   return settings
@@ -0,0 +1,49 @@
+'''Отправляет записанные обновления Telegram (JSON, по одному на строку) в вебхук бота.
+Нужен для проверки режима BOT_MODE=webhook без Telegram.
+
+Запуск: python scripts/post_updates.py [файл] [--url URL] [--secret SECRET] [--repeat N] [--delay SEC]
+
+--repeat 2 отправляет каждое обновление дважды: второй раз бот должен его пропустить.
+Ответы бота уходят в Telegram API: с тестовым токеном они завершатся ошибкой в логе бота,
+но прием, проверка секрета и отбрасывание повторов проверяются и так'''
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import aiohttp
+from yarl import URL
+
+DEFAULT_FILE = Path(__file__).resolve().parent / "updates.jsonl"
+
+def load_updates(path) -> list:
+   updates = []
+   for line in Path(path).read_text(encoding = "utf-8").splitlines():
+      if line.strip():
+         updates.append(json.loads(line))
+   return updates
+
+async def main():
+   parser = argparse.ArgumentParser(description = "Отправка записанных обновлений в вебхук")
+   parser.add_argument("file", nargs = "?", default = str(DEFAULT_FILE))
+   parser.add_argument("--url", default = f"http://127.0.0.1:{os.getenv('WEBHOOK_PORT', '8080')}"
+   					  f"{os.getenv('WEBHOOK_PATH', '/webhook')}")
+   parser.add_argument("--secret", default = os.getenv("WEBHOOK_SECRET", ""))
+   parser.add_argument("--repeat", type = int, default = 1, help = "сколько раз отправлять каждое обновление")
+   parser.add_argument("--delay", type = float, default = 0.5, help = "пауза между обновлениями, сек")
+   args = parser.parse_args()
+
+   headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+   async with aiohttp.ClientSession() as session:
+      health_url = URL(args.url).with_path("/health")
+      async with session.get(health_url) as response:
+         print(f"/health: {response.status} {await response.text()}")
+      for update in load_updates(args.file):
+         for _ in range(args.repeat):
+            async with session.post(args.url, json = update, headers = headers) as response:
+               print(f"update_id {update.get('update_id')}: {response.status}")
+         await asyncio.sleep(args.delay)
+
+if __name__ == "__main__":
+   asyncio.run(main())
@@ -0,0 +1,332 @@
+import asyncio			#Для фоновой очистки устаревших анкет
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from metrics import metrics
+from stats_store import connect_db
+
+log = logging.getLogger(__name__)
+
+class WriteBehind(ABC):
+   '''Отложенная запись: изменения копятся в unsaved и раз в interval секунд
+   пишутся в SQLite одной транзакцией в отдельном потоке, не блокируя цикл событий.
+   Пока запись не завершилась, чтение берет значение из unsaved.
+   lock защищает только данные в памяти, db_lock - соединение с базой: пока поток пишет,
+   цикл событий не ждет базу, чтобы прочитать анкету из памяти'''
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.db_lock = threading.Lock()
+      self.unsaved = {}				#Ключ -> значение, еще не записанное в базу
+      self.flush_lock = asyncio.Lock()
+      self.closing = asyncio.Event()
+      self.writer = None
+
+   @abstractmethod
+   def encode(self, batch: dict) -> list:
+      '''Строки для write() из пачки изменений; выполняется в цикле событий'''
+
+   @abstractmethod
+   def write(self, rows: list):
+      '''Записывает строки в базу; выполняется в отдельном потоке'''
+
+   async def flush(self):
+      '''Записывает накопленные изменения'''
+      async with self.flush_lock:
+         with self.lock:
+            batch = dict(self.unsaved)
+         if not batch:
+            return
+         await asyncio.to_thread(self.write, self.encode(batch))
+         with self.lock:
+            for key, value in batch.items():
+               if self.unsaved.get(key, batch) is value:	#Не изменилось, пока писали
+                  del self.unsaved[key]
+
+   async def run_writer(self, interval):
+      while not self.closing.is_set():
+         try:
+            await asyncio.wait_for(self.closing.wait(), interval)
+         except asyncio.TimeoutError:
+            pass
+         try:
+            await self.flush()
+         except Exception as e:
+            log.exception("❌ Ошибка записи %s: %r", type(self).__name__, e)
+
+   def start_writer(self, interval = 1.0):
+      if self.writer is None:
+         self.writer = asyncio.create_task(self.run_writer(interval))
+
+   async def stop_writer(self):
+      '''Останавливает фоновую запись и дописывает то, что осталось'''
+      self.closing.set()
+      if self.writer is not None:
+         await self.writer
+         self.writer = None
+      await self.flush()
+
+class Session(dict):
+   '''Анкета одного пользователя: каждое изменение поля отмечается в хранилище
+   и попадает в базу при ближайшей записи'''
+   def __init__(self, store, user_id, data):
+      super().__init__(data)
+      self.store = store
+      self.user_id = user_id
+
+   def __setitem__(self, key, value):
+      super().__setitem__(key, value)
+      self.store.save(self.user_id, self)
+
+   def __delitem__(self, key):
+      super().__delitem__(key)
+      self.store.save(self.user_id, self)
+
+class SessionStore(WriteBehind):
+   '''Анкеты пользователей (user_data), переживающие перезапуск бота.
+   Работает как словарь: user_id in store, store[user_id], store[user_id] = {...},
+   store[user_id]["step"] = ..., del store[user_id] - изменения пишутся в SQLite
+   фоновой задачей (start_writer), несколько изменений за обработку - одной записью.
+   Каждая анкета живет ttl секунд с последнего изменения; в памяти держится
+   не больше max_cached последних анкет, остальные читаются из базы в отдельном потоке
+   (preload, см. SessionPreloadMiddleware). Какие анкеты есть в базе, известно
+   по индексу в памяти: пользователь без анкеты не требует обращения к базе'''
+   def __init__(self, db_path, ttl = 24 * 3600, max_cached = 1000, on_expire = None):
+      super().__init__()
+      self.ttl = ttl				#Время жизни анкеты без активности, сек
+      self.max_cached = max_cached		#Сколько анкет держать в памяти
+      self.on_expire = on_expire		#Вызывается с user_id для каждой удаленной устаревшей анкеты
+      self.cache = OrderedDict()		#user_id -> (анкета, размер в байтах)
+      self.task = None
+      self.conn = connect_db(db_path)
+      with self.conn:
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+         			user_id INTEGER PRIMARY KEY,
+         			data TEXT NOT NULL,
+         			expires REAL NOT NULL)""")
+         self.conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+      #Индекс анкет: user_id -> когда устареет. Заполняется при запуске, дальше ведется в памяти
+      self.expires = dict(self.conn.execute("SELECT user_id, expires FROM sessions WHERE expires > ?",
+      					    (time.time(),)))
+      metrics.gauge("sessions_live", self.live_count)
+      metrics.gauge("sessions_cached", lambda: len(self.cache))
+      metrics.gauge("sessions_resident_bytes", self.resident_bytes)
+
+   def remember(self, user_id, data, size):
+      self.cache[user_id] = (data, size)
+      self.cache.move_to_end(user_id)
+      while len(self.cache) > self.max_cached:	#Вытесняем давно не использованные анкеты
+         self.cache.popitem(last = False)
+
+   def lookup(self, user_id):
+      '''Анкета из памяти: (True, анкета или None), если база не нужна, иначе (False, None)'''
+      with self.lock:
+         if user_id in self.unsaved:
+            entry = self.unsaved[user_id]
+            return True, None if entry is None else entry[0]
+         if user_id in self.cache:
+            self.cache.move_to_end(user_id)
+            return True, self.cache[user_id][0]
+         if self.expires.get(user_id, 0) <= time.time():
+            return True, None			#Анкеты нет или она устарела
+      return False, None
+
+   def read(self, user_id):
+      '''Читает анкету из базы и кладет в память'''
+      with self.db_lock:
+         row = self.conn.execute("SELECT data FROM sessions WHERE user_id = ? AND expires > ?",
+         			 (user_id, time.time())).fetchone()
+      if not row:
+         return None
+      with self.lock:
+         if user_id in self.unsaved:		#Пока читали, анкету изменили в памяти
+            entry = self.unsaved[user_id]
+            return None if entry is None else entry[0]
+         if user_id in self.cache:
+            return self.cache[user_id][0]
+         data = Session(self, user_id, json.loads(row[0]))
+         self.remember(user_id, data, len(row[0]))
+      return data
+
+   async def preload(self, user_id):
+      '''Подгружает анкету в память в отдельном потоке до запуска обработчиков'''
+      found, data = self.lookup(user_id)
+      if not found:
+         await asyncio.to_thread(self.read, user_id)
+
+   def load(self, user_id):
+      '''Анкета из памяти или из базы; None, если ее нет или она устарела'''
+      found, data = self.lookup(user_id)
+      if found:
+         return data
+      #Анкету не подгрузили заранее (или она вытеснена во время обработки) - читаем в цикле событий
+      metrics.inc("sessions_loop_reads_total")
+      return self.read(user_id)
+
+   def cached(self, user_id):
+      '''Анкета только из памяти, без обращения к базе; None, если ее там нет'''
+      return self.lookup(user_id)[1]
+
+   def __contains__(self, user_id):
+      return self.load(user_id) is not None
+
+   def __getitem__(self, user_id):
+      data = self.load(user_id)
+      if data is None:
+         raise KeyError(user_id)
+      return data
+
+   def get(self, user_id, default = None):
+      data = self.load(user_id)
+      return default if data is None else data
+
+   def __setitem__(self, user_id, data: dict):
+      self.save(user_id, Session(self, user_id, data))
+
+   def save(self, user_id, data: Session, ttl = None):
+      '''Отмечает анкету измененной и продлевает ее жизнь на ttl (по умолчанию self.ttl).
+      В базу она попадет при ближайшей записи'''
+      with self.lock:
+         self.unsaved[user_id] = (data, ttl)
+         self.expires[user_id] = time.time() + (ttl or self.ttl)
+         self.remember(user_id, data, self.cache[user_id][1] if user_id in self.cache else 0)
+
+   def __delitem__(self, user_id):
+      with self.lock:
+         self.cache.pop(user_id, None)
+         self.expires.pop(user_id, None)
+         self.unsaved[user_id] = None
+
+   def encode(self, batch: dict) -> list:
+      now = time.time()
+      rows = []
+      for user_id, entry in batch.items():
+         if entry is None:
+            rows.append((user_id, None, None))
+            continue
+         data, ttl = entry
+         encoded = json.dumps(data, ensure_ascii = False)
+         rows.append((user_id, encoded, now + (ttl or self.ttl)))
+         with self.lock:
+            if user_id in self.cache:
+               self.cache[user_id] = (data, len(encoded))
+      return rows
+
+   def write(self, rows: list):
+      with self.db_lock, self.conn:
+         self.conn.executemany("INSERT OR REPLACE INTO sessions (user_id, data, expires) VALUES (?, ?, ?)",
+         		       [row for row in rows if row[1] is not None])
+         self.conn.executemany("DELETE FROM sessions WHERE user_id = ?",
+         		       [(row[0],) for row in rows if row[1] is None])
+
+   def sweep(self) -> list:
+      '''Удаляет устаревшие анкеты, возвращает их user_id.
+      Анкеты с незаписанными изменениями не устаревают - они будут записаны заново'''
+      now = time.time()
+      with self.db_lock, self.conn:
+         with self.lock:
+            unsaved = set(self.unsaved)
+         expired = [row[0] for row in self.conn.execute(
+         	    "SELECT user_id FROM sessions WHERE expires <= ?", (now,))
+         	    if row[0] not in unsaved]
+         self.conn.executemany("DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in expired])
+      with self.lock:
+         for user_id in expired:
+            if user_id not in self.unsaved:		#Пока удаляли, пользователь мог вернуться
+               self.cache.pop(user_id, None)
+         self.expires = {user_id: expires for user_id, expires in self.expires.items() if expires > now}
+      return expired
+
+   async def run_sweeper(self, interval):
+      while True:
+         await asyncio.sleep(interval)
+         try:
+            expired = await asyncio.to_thread(self.sweep)
+         except Exception as e:
+            log.exception("❌ Ошибка очистки анкет: %r", e)
+            continue
+         metrics.inc("sessions_expired_total", len(expired))
+         if self.on_expire:
+            for user_id in expired:
+               self.on_expire(user_id)
+
+   def start_sweeper(self, interval = 300):
+      if self.task is None:
+         self.task = asyncio.create_task(self.run_sweeper(interval))
+
+   async def stop(self):
+      if self.task is not None:
+         self.task.cancel()
+         self.task = None
+      await self.stop_writer()
+      with self.db_lock:
+         self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+   def live_count(self) -> int:
+      '''Число анкет по индексу в памяти; устаревшие выбывают при очистке (sweep)'''
+      return len(self.expires)
+
+   def resident_bytes(self) -> int:
+      '''Примерный объем анкет в памяти (по размеру в JSON)'''
+      with self.lock:
+         return sum(size for data, size in self.cache.values())
+
+class PrivacyStore(WriteBehind):
+   '''Согласие с политикой конфиденциальности: хранится бессрочно и отдельно от анкет.
+   Значение False - политика показана, True - пользователь согласился.
+   Все согласия держатся в памяти (одно число на пользователя) и читаются без обращения к базе;
+   изменения пишутся в базу фоновой задачей (start_writer)'''
+   def __init__(self, db_path):
+      super().__init__()
+      self.conn = connect_db(db_path)
+      with self.conn:
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS privacy (
+         			user_id INTEGER PRIMARY KEY,
+         			agreed INTEGER NOT NULL,
+         			updated REAL NOT NULL)""")
+      self.agreed = {user_id: bool(agreed) for user_id, agreed
+      		     in self.conn.execute("SELECT user_id, agreed FROM privacy")}
+
+   def get(self, user_id, default = None):
+      return self.agreed.get(user_id, default)
+
+   def __contains__(self, user_id):
+      return self.get(user_id) is not None
+
+   def __getitem__(self, user_id):
+      agreed = self.get(user_id)
+      if agreed is None:
+         raise KeyError(user_id)
+      return agreed
+
+   def __setitem__(self, user_id, agreed: bool):
+      with self.lock:
+         self.agreed[user_id] = agreed
+         self.unsaved[user_id] = agreed
+
+   def encode(self, batch: dict) -> list:
+      now = time.time()
+      return [(user_id, int(agreed), now) for user_id, agreed in batch.items()]
+
+   def write(self, rows: list):
+      with self.db_lock, self.conn:
+         self.conn.executemany("INSERT OR REPLACE INTO privacy (user_id, agreed, updated) VALUES (?, ?, ?)", rows)
+
+   async def stop(self):
+      await self.stop_writer()
+
+class SessionPreloadMiddleware(BaseMiddleware):
+   '''Подгружает анкету пользователя из базы в отдельном потоке до обработчиков,
+   чтобы user_data[user_id] в обработчике читал только память'''
+   def __init__(self, store: SessionStore):
+      self.store = store
+
+   async def __call__(self, handler, event: Update, data):
+      user = data.get("event_from_user")
+      if user is not None:
+         await self.store.preload(user.id)
+      return await handler(event, data)
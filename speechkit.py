@@ -1,12 +1,105 @@
 import aiohttp			#Для асинхронных HTTP-запросов к API
+import asyncio			#Для параллельного синтеза частей текста
 import io			#Для работы с бинарными данными в памяти 
+import logging
 import os			#Для работы с переменными окружения
+import re			#Для разбиения текста на абзацы и предложения
+import struct			#Для разбора страниц Ogg
+import zlib			#Для контрольной суммы страниц Ogg
+from metrics import metrics
+from audio_cache import AudioCache
+from resilience import get_upstream, raise_for_status
+
+log = logging.getLogger(__name__)
+
+#Форматы аудио SpeechKit: mp3 отправляется файлом (answer_audio), oggopus - голосовым сообщением
+#(answer_voice): при той же разборчивости речи он в несколько раз меньше
+AUDIO_FORMATS = ("mp3", "oggopus")
+
+#Размер готового аудио по форматам, байт
+metrics.histogram("tts_audio_bytes", (64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024, 1024 ** 2,
+				      2 * 1024 ** 2, 4 * 1024 ** 2, 8 * 1024 ** 2, 16 * 1024 ** 2, 50 * 1024 ** 2))
+
+#Разделители для разбиения длинного текста: абзацы, строки, предложения, слова
+SPLIT_PATTERNS = [re.compile(r'(?<=\n\n)'),
+		  re.compile(r'(?<=\n)'),
+		  re.compile(r'(?<=[.!?…] )'),
+		  re.compile(r'(?<= )')]
+
+def strip_id3(data: bytes, keep_head = True, keep_tail = True) -> bytes:
+   '''Убирает теги ID3 из MP3, чтобы склеенный файл состоял только из аудиокадров'''
+   if not keep_head and data[:3] == b"ID3" and len(data) >= 10:
+      size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]	#Размер тега в формате synchsafe
+      data = data[10 + size:]
+   if not keep_tail and len(data) >= 128 and data[-128:-125] == b"TAG":
+      data = data[:-128]
+   return data
+
+#Контрольная сумма Ogg - CRC-32 без отражения битов (полином 04C11DB7, начальное значение 0).
+#Считаем через zlib.crc32 (отраженный вариант) на байтах с обратным порядком бит - это быстрее цикла на Python
+REVERSED_BITS = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+def ogg_crc(data: bytes) -> int:
+   crc = zlib.crc32(data.translate(REVERSED_BITS), 0xFFFFFFFF) ^ 0xFFFFFFFF
+   return int(f"{crc:032b}"[::-1], 2)
+
+def ogg_pages(data: bytes):
+   '''Страницы Ogg: (заголовок страницы с таблицей сегментов, тело)'''
+   offset = 0
+   while offset + 27 <= len(data) and data[offset:offset + 4] == b"OggS":
+      segments = data[offset + 26]
+      header_size = 27 + segments
+      body_size = sum(data[offset + 27:offset + header_size])
+      yield data[offset:offset + header_size], data[offset + header_size:offset + header_size + body_size]
+      offset += header_size + body_size
+
+def join_ogg_opus(parts: list) -> bytes:
+   '''Склеивает ответы SpeechKit в oggopus в один поток Ogg, чтобы Telegram показал
+   длительность всего голосового сообщения: у частей после первой убираются заголовки
+   OpusHead/OpusTags, номер потока, номера страниц и позиции отсчетов продолжают первую часть'''
+   if len(parts) == 1:
+      return parts[0]
+   output = []
+   serial = None
+   sequence = 0
+   granule_offset = 0
+   for index, part in enumerate(parts):
+      last_granule = 0
+      for header, body in ogg_pages(part):
+         flags, granule, page_serial = struct.unpack_from("<BqI", header, 5)
+         if serial is None:
+            serial = page_serial
+         if index and granule == 0:			#Страницы заголовков следующих частей
+            continue
+         if granule != -1:				#-1: на странице не заканчивается ни один пакет
+            last_granule = granule
+            granule += granule_offset
+         if index < len(parts) - 1:
+            flags &= ~0x04				#Конец потока - только в последней части
+         page = bytearray(header + body)
+         struct.pack_into("<BqIII", page, 5, flags, granule, serial, sequence, 0)
+         struct.pack_into("<I", page, 22, ogg_crc(bytes(page)))
+         output.append(bytes(page))
+         sequence += 1
+      granule_offset += last_granule
+   return b"".join(output)
 
 class YandexSpeechKit:
-   def __init__(self, api_key, folder_id):
+   def __init__(self, api_key, folder_id, session: aiohttp.ClientSession = None,
+   		max_chunk_chars = 4500, concurrency = 3, cache = None,
+   		audio_format = "mp3", opus_min_chars = 0):
       self.api_key = api_key			#Ключ для доступа к API
       self.folder_id = folder_id		#ID  папки в Yandex Cloud
-      self.api_url = "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize"
+      self.session = session			#Общая сессия с пулом соединений (создается в main)
+      self.max_chunk_chars = max_chunk_chars	#Ограничение длины SSML в одном запросе (у API - 5000 символов)
+      self.concurrency = concurrency		#Сколько частей одной сказки синтезируется одновременно
+      self.cache = cache			#Кэш готового аудио (AudioCache) или None
+      self.api_url = os.getenv("SPEECHKIT_API_URL", "https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize")
+      #Формат аудио: mp3, oggopus или auto - oggopus для текстов от opus_min_chars символов
+      if audio_format not in AUDIO_FORMATS + ("auto",):
+         raise ValueError(f"Unknown TTS format: {audio_format}")
+      self.audio_format = audio_format
+      self.opus_min_chars = opus_min_chars
       
       #Доступные голоса для русского языка
       self.available_voices = {"женский": {"voice": "oksana",
@@ -17,6 +110,12 @@ class YandexSpeechKit:
       			       		   "description": "Филипп - глубокий мужской голос",
       			       		   "emotion": "good",
       					   "speed": "1.0"}}
+   def format_for(self, text) -> str:
+      '''Формат аудио для текста: mp3 или oggopus'''
+      if self.audio_format != "auto":
+         return self.audio_format
+      return "oggopus" if len(text) >= self.opus_min_chars else "mp3"
+
    def ssml_pauses(self, text):
       #Добавляем паузы для более естественной речи
       text = text.replace('\n\n', '<break time="700ms"/>')
@@ -27,12 +126,63 @@ class YandexSpeechKit:
       text = text.replace(', ', ',<break time="300ms"/>')
       text = text.replace(': ', ':<break time="300ms"/>')
       return f'<speak>{text}</speak>'
-   async def text_to_speech(self, text: str, voice_type: str = "женский", 
-   emotion: str = None) -> io.BytesIO:
+
+   def split_text(self, text, level = 0) -> list:
+      '''Разбивает текст на части, SSML каждой из которых укладывается в max_chunk_chars.
+      Сначала по абзацам, затем по строкам, предложениям и словам'''
+      if len(self.ssml_pauses(text)) <= self.max_chunk_chars:
+         return [text]
+      if level >= len(SPLIT_PATTERNS):			#Одно очень длинное слово - режем как есть
+         step = self.max_chunk_chars // 2
+         return [text[i:i + step] for i in range(0, len(text), step)]
       
-      '''Преобразование текста в речь через Yandex SpeechKit
-      voice_type: "женский" или "мужской"'''
+      chunks = []
+      current = ""
+      for piece in SPLIT_PATTERNS[level].split(text):
+         if not piece:
+            continue
+         if len(self.ssml_pauses(current + piece)) <= self.max_chunk_chars:
+            current += piece
+            continue
+         if current:
+            chunks.append(current)
+         if len(self.ssml_pauses(piece)) <= self.max_chunk_chars:
+            current = piece
+         else:						#Кусок не помещается целиком - делим мельче
+            smaller = self.split_text(piece, level + 1)
+            chunks.extend(smaller[:-1])
+            current = smaller[-1]			#Остаток можно дополнить следующим куском
+      if current:
+         chunks.append(current)
+      return chunks
+
+   async def synthesize(self, ssml, voice, emotion, speed, audio_format = "mp3") -> bytes:
+      '''Один запрос к SpeechKit, возвращает аудио в формате audio_format'''
+      headers = {"Authorization": f"Api-Key {self.api_key}",		#Авторизация по API-ключу
+      		"Content-Type": "application/x-www-form-urlencoded"}	
       
+      data = {"ssml": ssml,				#Текст озвучки
+      	      "lang": "ru-RU",			#Язык - русский
+      	      "voice": voice,			#Выбор голоса
+      	      "emotion": emotion,		#Эмоциональная окраска (добрая, злая, нормальная)
+      	      "speed": speed,			#Скорость речи (нормальная)
+      	      "format": audio_format,		#Формат аудио
+      	      "folderId": self.folder_id}	#Идентификатор облака
+
+      async def attempt():
+         async with self.session.post(self.api_url, headers = headers, data = data) as response:
+            await raise_for_status("SpeechKit", response)
+            return await response.read()		#Если запрос успешен, то читаем аудио-данные
+
+      #Повторы при сбоях сети и ответах 429/5xx, размыкатель цепи при недоступности сервиса
+      try:
+         return await get_upstream("speechkit").call(attempt)
+      except Exception as e:
+         log.warning("SpeechKit error: %r", e)
+         raise
+
+   def voice_params(self, voice_type, emotion = None) -> tuple:
+      '''Возвращает (голос, эмоция, скорость) для типа голоса'''
       #Получаем конкретный голос из доступных
       voice_info = self.available_voices.get(voice_type, self.available_voices["женский"])
       voice = voice_info["voice"]
@@ -41,54 +191,81 @@ class YandexSpeechKit:
       speed = voice_info.get("speed", "1.0")
       if emotion is None:
          emotion = voice_info.get("emotion", "good")
-         
-      #Подготавливаем текст
-      prepared_text = self.ssml_pauses(text)
+      return voice, emotion, speed
+
+   def cache_key(self, text: str, voice_type: str = "женский", emotion: str = None) -> str:
+      '''Ключ кэша: хэш подготовленного SSML, параметров голоса и формата'''
+      voice, emotion, speed = self.voice_params(voice_type, emotion)
+      return AudioCache.make_key(self.ssml_pauses(text), voice, emotion, speed, self.format_for(text))
+
+   async def text_to_speech(self, text: str, voice_type: str = "женский", 
+   emotion: str = None) -> io.BytesIO:
       
-      headers = {"Authorization": f"Api-Key {self.api_key}",		#Авторизация по API-ключу
-      		"Content-Type": "application/x-www-form-urlencoded"}	
+      '''Преобразование текста в речь через Yandex SpeechKit
+      voice_type: "женский" или "мужской"'''
       
-      data = {"ssml": prepared_text,			#Текст озвучки
-      	      "lang": "ru-RU",			#Язык - русский
-      	      "voice": voice,			#Выбор голоса
-      	      "emotion": emotion,		#Эмоциональная окраска (добрая, злая, нормальная)
-      	      "speed": speed,			#Скорость речи (нормальная)
-      	      "format": "mp3",			#Формат аудио
-      	      "folderId": self.folder_id}	#Идентификатор облака
+      voice, emotion, speed = self.voice_params(voice_type, emotion)
+      audio_format = self.format_for(text)
+      
+      #Одинаковый текст с тем же голосом берем из кэша
+      if self.cache:
+         key = self.cache_key(text, voice_type, emotion)
+         audio_data = await asyncio.to_thread(self.cache.get, key)
+         if audio_data is not None:
+            return io.BytesIO(audio_data)
+         
+      #Делим длинный текст на части в пределах ограничения API
+      chunks = [self.ssml_pauses(chunk) for chunk in self.split_text(text)]
+      metrics.inc("tts_chunks_total", len(chunks))
 
-      print(f"TTS params: voice={voice}, emotion={emotion}, speed={speed}")
+      log.debug("TTS params: voice=%s, emotion=%s, speed=%s, format=%s, chunks=%s",
+      		voice, emotion, speed, audio_format, len(chunks))
       
+      #Синтезируем части одновременно, не больше self.concurrency запросов на сказку
+      semaphore = asyncio.Semaphore(self.concurrency)
+      async def synthesize_chunk(ssml):
+         async with semaphore:
+            return await self.synthesize(ssml, voice, emotion, speed, audio_format)
+
+      tasks = [asyncio.create_task(synthesize_chunk(ssml)) for ssml in chunks]
       try:
-         async with aiohttp.ClientSession() as session:
-            async with session.post(self.api_url, headers = headers, data = data) as response:
-               if response.status == 200:
-                  audio_data = await response.read()		#Если запрос успешен, то читаем аудио-данные
-                  return io.BytesIO(audio_data)			#Создание файла в виртуальной памяти
-               else:
-                  error_text = await response.text()
-                  print(f"SpeechKit error: {response.status}, {error_text}")
-                  print(f"API Key: {self.api_key[:10]}...")
-                  print(f"Folder ID: {self.folder_id}")
-                  raise Exception (f"SpeechKit API error: {response.status}")
-      except Exception as e:
-         print(f"SpeechKit connection error: {e}")
+         parts = await asyncio.gather(*tasks)
+      except BaseException:
+         for task in tasks:				#Ошибка в одной части - остальные не нужны
+            task.cancel()
          raise
+      
+      #Склеиваем части по порядку: MP3 - по кадрам, Ogg - в один поток
+      if audio_format == "oggopus":
+         audio_data = await asyncio.to_thread(join_ogg_opus, parts)
+      else:
+         last = len(parts) - 1
+         audio_data = b"".join(strip_id3(part, keep_head = i == 0, keep_tail = i == last)
+         			       for i, part in enumerate(parts))
+      metrics.observe("tts_audio_bytes", len(audio_data), format = audio_format)
+      if self.cache:
+         await asyncio.to_thread(self.cache.put, key, audio_data)
+      return io.BytesIO(audio_data)			#Создание файла в виртуальной памяти
+
 #Глобальный экземпляр TTS менеджера
 tts_manager = None
 
-def init_tts_manager():
+def init_tts_manager(session: aiohttp.ClientSession = None, cache = None):
    global tts_manager
    api_key = os.getenv("YANDEX_TTS_API_KEY")
    folder_id = os.getenv("YANDEX_FOLDER_ID")
-   print(f"API Key exists: {bool(api_key)}")		#Для отладки
-   print(f"Folder ID exists: {bool(folder_id)}")	#Для отладки
    
    if api_key and folder_id:
-      tts_manager = YandexSpeechKit(api_key, folder_id)
-      print("Yandex SpeechKit initialized successfully!")
+      tts_manager = YandexSpeechKit(api_key, folder_id, session,
+      				    max_chunk_chars = int(os.getenv("TTS_CHUNK_CHARS", "4500")),
+      				    concurrency = int(os.getenv("TTS_CONCURRENCY", "3")),
+      				    cache = cache,
+      				    audio_format = os.getenv("TTS_FORMAT", "auto"),
+      				    opus_min_chars = int(os.getenv("TTS_OPUS_MIN_CHARS", "1500")))
+      log.info("Yandex SpeechKit initialized successfully!")
       return tts_manager
    else:
-      print("Yandex TTS API keys not found - audio generation disabled")
+      log.warning("Yandex TTS API keys not found - audio generation disabled")
    return None
 
 #Функция для получения менеджера
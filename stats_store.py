@@ -0,0 +1,322 @@
+import csv			#Для импорта старого файла статистики
+import datetime			#Для периодов /stats
+import logging
+import sqlite3			#Для индексированного хранилища статистики
+import threading		#Для защиты соединения при работе из разных потоков
+from collections import Counter
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+#Столбцы статистики пользователей (совпадают с заголовком user_stats.csv)
+USER_FIELDS = ['user_id', 'username', 'first_name', 'last_name',
+	       'first_seen', 'last_seen', 'tales_generated']
+
+#Столбцы статистики сказок (совпадают с заголовком tale_stats.csv)
+TALE_FIELDS = ['timestamp', 'user_id', 'age_group',
+	       'genre', 'style', 'location', 'hero',
+	       'enemy', 'child_name', 'gender',
+	       'audio_requested', 'voice_type']
+
+def connect_db(db_path):
+   '''Открывает базу SQLite в режиме WAL: запись не блокирует чтение,
+   а commit не требует fsync на каждую операцию'''
+   conn = sqlite3.connect(db_path, check_same_thread = False, timeout = 30)
+   conn.execute("PRAGMA journal_mode=WAL")
+   conn.execute("PRAGMA synchronous=NORMAL")
+   return conn
+
+class UserStatsStore:
+   '''Статистика пользователей с ключом user_id.
+   Обновление одного пользователя - это поиск по первичному ключу,
+   а не перезапись всего файла'''
+   def __init__(self, db_path, csv_path = None, tale_csv_path = None):
+      self.db_path = db_path				#Путь к базе SQLite
+      self.csv_path = csv_path				#Старый CSV для импорта при первом запуске
+      self.tale_csv_path = tale_csv_path		#История выбора голоса для импорта при первом запуске
+      self.lock = threading.Lock()
+      self.conn = connect_db(db_path)
+      with self.conn:
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS users (
+         			user_id INTEGER PRIMARY KEY,
+         			username TEXT,
+         			first_name TEXT,
+         			last_name TEXT,
+         			first_seen TEXT,
+         			last_seen TEXT,
+         			tales_generated INTEGER NOT NULL DEFAULT 0)""")
+         self.conn.execute("CREATE INDEX IF NOT EXISTS users_first_seen ON users (first_seen)")
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS user_voices (
+         			user_id INTEGER NOT NULL,
+         			voice_type TEXT NOT NULL,
+         			count INTEGER NOT NULL DEFAULT 0,
+         			PRIMARY KEY (user_id, voice_type))""")
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+         			key TEXT PRIMARY KEY,
+         			value TEXT)""")
+      self.import_csv()
+      self.import_voice_history()
+
+   def get_meta(self, key, default = None):
+      with self.lock:
+         row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+      return row[0] if row else default
+
+   def set_meta(self, key, value):
+      with self.lock, self.conn:
+         self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+   def import_csv(self):
+      '''Однократный импорт user_stats.csv в базу при первом запуске'''
+      if self.get_meta("csv_imported") or not self.csv_path or not Path(self.csv_path).exists():
+         return 0
+      rows = []
+      with open(self.csv_path, 'r', newline = '', encoding = 'utf-8') as f:
+         for row in csv.DictReader(f):
+            try:
+               rows.append((int(row['user_id']),
+               		    row.get('username') or "N/A",
+               		    row.get('first_name') or "N/A",
+               		    row.get('last_name') or "N/A",
+               		    row.get('first_seen'),
+               		    row.get('last_seen'),
+               		    int(row.get('tales_generated') or 0)))
+            except (KeyError, ValueError):
+               continue					#Пропускаем поврежденные строки
+      with self.lock, self.conn:
+         self.conn.executemany("""INSERT OR IGNORE INTO users
+         			  (user_id, username, first_name, last_name,
+         			   first_seen, last_seen, tales_generated)
+         			  VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+         self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_imported', ?)",
+         		   (str(len(rows)),))
+      log.info("📥 Импортировано пользователей из %s: %s", self.csv_path, len(rows))
+      return len(rows)
+
+   def import_voice_history(self):
+      '''Однократный импорт выбранных голосов из tale_stats.csv'''
+      if (self.get_meta("voices_imported") or not self.tale_csv_path
+          or not Path(self.tale_csv_path).exists()):
+         return 0
+      voices = []
+      with open(self.tale_csv_path, 'r', newline = '', encoding = 'utf-8') as f:
+         for row in csv.DictReader(f):
+            try:
+               voices.append((int(row['user_id']), row.get('voice_type', 'N/A')))
+            except (KeyError, ValueError):
+               continue
+      self.add_voices(voices)
+      self.set_meta("voices_imported", len(voices))
+      return len(voices)
+
+   def add_voices(self, voices):
+      '''Учитывает выбор голоса: voices - пары (user_id, voice_type)'''
+      voices = [(user_id, voice) for user_id, voice in voices if voice and voice != 'N/A']
+      if not voices:
+         return
+      with self.lock, self.conn:
+         self.conn.executemany("""INSERT INTO user_voices (user_id, voice_type, count)
+         			  VALUES (?, ?, 1)
+         			  ON CONFLICT (user_id, voice_type) DO UPDATE SET count = count + 1""",
+         			  voices)
+
+   def preferred_voice(self, user_id):
+      '''Голос, который пользователь выбирал чаще всего, или None'''
+      with self.lock:
+         row = self.conn.execute("""SELECT voice_type FROM user_voices WHERE user_id = ?
+         			    ORDER BY count DESC LIMIT 1""", (user_id,)).fetchone()
+      return row[0] if row else None
+
+   def upsert(self, user_id, username, first_name, last_name, seen_at) -> bool:
+      '''Добавляет нового пользователя или обновляет last_seen и счетчик.
+      Возвращает True, если пользователь новый'''
+      return self.upsert_many([(user_id, username, first_name, last_name, seen_at)])[0]
+
+   def upsert_many(self, users) -> list:
+      '''Пакетное обновление в одной транзакции. users - кортежи
+      (user_id, username, first_name, last_name, seen_at)'''
+      created = []
+      with self.lock, self.conn:
+         for user_id, username, first_name, last_name, seen_at in users:
+            cursor = self.conn.execute("""INSERT OR IGNORE INTO users
+            			  (user_id, username, first_name, last_name,
+            			   first_seen, last_seen, tales_generated)
+            			  VALUES (?, ?, ?, ?, ?, ?, 1)""",
+            			  (user_id, username, first_name, last_name, seen_at, seen_at))
+            if cursor.rowcount:
+               created.append(True)
+               continue
+            self.conn.execute("""UPDATE users SET last_seen = ?,
+            			 tales_generated = tales_generated + 1
+            			 WHERE user_id = ?""", (seen_at, user_id))
+            created.append(False)
+      return created
+
+   def get(self, user_id):
+      with self.lock:
+         row = self.conn.execute(f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE user_id = ?",
+         			 (user_id,)).fetchone()
+      return dict(zip(USER_FIELDS, row)) if row else None
+
+   def totals(self) -> tuple:
+      '''Возвращает (число пользователей, сумма tales_generated)'''
+      with self.lock:
+         users, tales = self.conn.execute(
+         	"SELECT COUNT(*), COALESCE(SUM(tales_generated), 0) FROM users").fetchone()
+      return users, tales
+
+   def new_users(self, start: str, end: str) -> int:
+      '''Сколько пользователей впервые пришли с start по end включительно
+      (префиксы времени ISO: 2026-10-18 или 2026-10-18T13)'''
+      with self.lock:
+         return self.conn.execute("SELECT COUNT(*) FROM users WHERE first_seen >= ? AND first_seen < ?",
+         			  (start, end + "~")).fetchone()[0]		#"~" больше любого символа времени
+
+   def checkpoint(self):
+      '''Переносит журнал WAL в основной файл базы с fsync'''
+      with self.lock:
+         self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+   def close(self):
+      with self.lock:
+         self.conn.close()
+
+
+class TaleRollups:
+   '''Агрегаты статистики сказок по часам, дням и за все время: число сказок и разбивка
+   по возрастной группе, жанру, стилю, озвучке и голосу. Обновляются при записи каждой
+   пачки строк, поэтому /stats за любой период - это сумма нескольких строк таблицы,
+   а не чтение tale_stats.csv'''
+   PERIODS = {"hour": 13, "day": 10, "all": 0}		#Длина префикса времени строки: 2026-10-18T13 / 2026-10-18 / ""
+   FIELDS = ('age_group', 'genre', 'style', 'audio_requested', 'voice_type')
+
+   def __init__(self, db_path, csv_path = None):
+      self.csv_path = csv_path				#tale_stats.csv для первичного заполнения
+      self.lock = threading.Lock()
+      self.conn = connect_db(db_path)
+      with self.conn:
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS tale_rollups (
+         			period TEXT NOT NULL,
+         			bucket TEXT NOT NULL,
+         			field TEXT NOT NULL,
+         			value TEXT NOT NULL,
+         			count INTEGER NOT NULL DEFAULT 0,
+         			PRIMARY KEY (period, bucket, field, value))""")
+         self.conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+         			key TEXT PRIMARY KEY,
+         			value TEXT)""")
+      self.import_csv()
+
+   def count_rows(self, rows) -> Counter:
+      '''Строки tale_stats.csv (словари) -> {(период, интервал, поле, значение): количество}'''
+      counts = Counter()
+      for row in rows:
+         timestamp = row.get('timestamp') or ""
+         for period, length in self.PERIODS.items():
+            bucket = timestamp[:length]
+            counts[(period, bucket, 'tales', '')] += 1
+            for field in self.FIELDS:
+               counts[(period, bucket, field, row.get(field) or 'N/A')] += 1
+      return counts
+
+   def write_counts(self, counts: Counter):
+      self.conn.executemany("""INSERT INTO tale_rollups (period, bucket, field, value, count)
+      			       VALUES (?, ?, ?, ?, ?)
+      			       ON CONFLICT (period, bucket, field, value) DO UPDATE SET count = count + excluded.count""",
+      			       [(*key, count) for key, count in counts.items()])
+
+   def add_rows(self, rows):
+      '''Учитывает пачку строк tale_stats.csv одной транзакцией'''
+      counts = self.count_rows(rows)
+      if counts:
+         with self.lock, self.conn:
+            self.write_counts(counts)
+
+   def import_csv(self):
+      '''Однократное заполнение агрегатов по уже накопленному tale_stats.csv.
+      Проверка и заполнение идут в одной транзакции, чтобы процессы-обработчики
+      не учли строки дважды'''
+      if not self.csv_path or not Path(self.csv_path).exists():
+         return 0
+      with self.lock:
+         self.conn.execute("BEGIN IMMEDIATE")
+         try:
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'rollups_imported'").fetchone():
+               self.conn.rollback()
+               return 0
+            imported = 0
+            with open(self.csv_path, 'r', newline = '', encoding = 'utf-8') as f:
+               batch = []
+               for row in csv.DictReader(f, fieldnames = TALE_FIELDS):
+                  if row['timestamp'] == 'timestamp':		#Заголовок
+                     continue
+                  batch.append(row)
+                  if len(batch) >= 10000:
+                     self.write_counts(self.count_rows(batch))
+                     imported += len(batch)
+                     batch = []
+               self.write_counts(self.count_rows(batch))
+               imported += len(batch)
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollups_imported', ?)",
+            		      (str(imported),))
+            self.conn.commit()
+         except BaseException:
+            self.conn.rollback()
+            raise
+      log.info("📊 Агрегаты статистики заполнены по %s: строк %s", self.csv_path, imported)
+      return imported
+
+   def summary(self, period = "all", start = "", end = "") -> dict:
+      '''Сумма агрегатов за интервалы от start до end включительно:
+      {поле: {значение: количество}}, число сказок - в ["tales"][""]'''
+      with self.lock:
+         rows = self.conn.execute("""SELECT field, value, SUM(count) FROM tale_rollups
+         			     WHERE period = ? AND bucket BETWEEN ? AND ?
+         			     GROUP BY field, value""", (period, start, end)).fetchall()
+      result = {}
+      for field, value, count in rows:
+         result.setdefault(field, {})[value] = count
+      return result
+
+   def prune_hourly(self, before: str) -> int:
+      '''Удаляет почасовые агрегаты раньше before (2026-10-18T13); дневные хранятся всегда'''
+      with self.lock, self.conn:
+         return self.conn.execute("DELETE FROM tale_rollups WHERE period = 'hour' AND bucket < ?",
+         			  (before,)).rowcount
+
+   def close(self):
+      with self.lock:
+         self.conn.close()
+
+def parse_stats_range(text: str, now: datetime.datetime = None, hourly_days = 0) -> tuple:
+   '''Период для /stats: "" - за все время, "7d" - последние 7 дней, "24h" - последние 24 часа,
+   "2026-10-01" - один день, "2026-10-01 2026-10-15" - дни с первого по второй.
+   Почасовые агрегаты хранятся hourly_days дней (0 - всегда): более длинный период в часах
+   считается по дневным агрегатам, иначе часть сказок потерялась бы.
+   Возвращает (период агрегатов, начало, конец, подпись); ValueError, если не разобрать'''
+   now = now or datetime.datetime.now()
+   parts = text.replace("..", " ").split()
+   if not parts:
+      return "all", "", "", "за все время"
+   if len(parts) == 1 and parts[0][:-1].isdigit() and parts[0][-1].lower() in "dдhч":
+      amount = int(parts[0][:-1])
+      if amount <= 0:
+         raise ValueError(text)
+      hours = parts[0][-1].lower() in "hч"
+      try:
+         start = now - (datetime.timedelta(hours = amount - 1) if hours else datetime.timedelta(days = amount - 1))
+      except OverflowError:
+         raise ValueError(text) from None		#Раньше первого года нашей эры
+      if not hours:
+         return "day", start.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d"), f"за {amount} дн."
+      if hourly_days <= 0 or amount <= hourly_days * 24:
+         return "hour", start.strftime("%Y-%m-%dT%H"), now.strftime("%Y-%m-%dT%H"), f"за {amount} ч."
+      start, end = start.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")
+      return "day", start, end, f"за {amount} ч. (по дням, с {start} по {end})"
+   if len(parts) <= 2:
+      days = [datetime.date.fromisoformat(part).isoformat() for part in parts]
+      start, end = days[0], days[-1]
+      if start > end:
+         start, end = end, start
+      return "day", start, end, f"за {start}" if start == end else f"с {start} по {end}"
+   raise ValueError(text)
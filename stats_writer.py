@@ -0,0 +1,214 @@
+import asyncio			#Для очереди и фоновой задачи записи
+import csv			#Для записи строк tale_stats.csv
+import datetime			#Для ротации CSV по дате первой строки
+import fcntl			#Блокировка CSV, когда в него пишут несколько процессов
+import gzip			#Для сжатия старых частей CSV
+import io
+import logging
+import os			#Для fsync при остановке
+import shutil
+import time
+from pathlib import Path
+from stats_store import TALE_FIELDS
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+class StatsWriter:
+   '''Неблокирующая запись статистики. Обработчики только кладут записи
+   в очередь, а фоновая задача пачками пишет их на диск в отдельном потоке.
+   Пачка сбрасывается при наборе batch_size записей или через flush_interval секунд.
+   Строки старше retention_days дней переносятся из tale_stats.csv в сжатый архив
+   tale_stats.<первый день>_<последний день>.csv.gz; архивы старше archive_days дней удаляются (0 - хранить все)'''
+   def __init__(self, tale_csv_path, user_store, rollups,
+   		batch_size = 100, flush_interval = 2.0, max_queue = 10000,
+   		retention_days = 7, archive_days = 365, hourly_days = 30):
+      self.tale_csv_path = tale_csv_path		#tale_stats.csv
+      self.user_store = user_store			#Статистика пользователей (SQLite)
+      self.rollups = rollups				#Агрегаты для /stats (TaleRollups)
+      self.batch_size = batch_size			#Максимальный размер пачки
+      self.flush_interval = flush_interval		#Максимальная задержка записи, сек
+      self.max_queue = max_queue			#При переполнении записи отбрасываются
+      self.retention_days = retention_days		#Сколько дней строки живут в несжатом CSV
+      self.archive_days = archive_days			#Сколько дней хранить сжатые архивы
+      self.hourly_days = hourly_days			#Сколько дней хранить почасовые агрегаты
+      self.next_rotation_check = 0.0			#Ротация проверяется не чаще раза в час
+      self.queue = asyncio.Queue()
+      self.task = None
+      metrics.gauge("stats_queue_depth", self.queue_depth)
+
+   def queue_depth(self) -> int:
+      '''Количество записей, ожидающих сброса на диск'''
+      return self.queue.qsize()
+
+   def put(self, item) -> bool:
+      if self.queue.qsize() >= self.max_queue:
+         metrics.inc("stats_dropped_total", kind = item[0])
+         log.warning("⚠️ Очередь статистики переполнена, запись отброшена: %s", item[0])
+         return False
+      self.queue.put_nowait(item)
+      return True
+
+   def log_tale(self, row: list) -> bool:
+      '''Ставит в очередь строку tale_stats.csv (в порядке TALE_FIELDS)'''
+      return self.put(("tale", row))
+
+   def touch_user(self, user_id, username, first_name, last_name, seen_at) -> bool:
+      '''Ставит в очередь обновление статистики пользователя'''
+      return self.put(("user", (user_id, username, first_name, last_name, seen_at)))
+
+   async def start(self):
+      if self.task is None:
+         self.task = asyncio.create_task(self.run())
+
+   async def run(self):
+      loop = asyncio.get_running_loop()
+      while True:
+         item = await self.queue.get()
+         if item is None:				#Сигнал остановки
+            return
+         batch = [item]
+         deadline = loop.time() + self.flush_interval
+         stopping = False
+         while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+               break
+            try:
+               item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+               break
+            if item is None:
+               stopping = True
+               break
+            batch.append(item)
+         await self.flush(batch)
+         if stopping:
+            return
+
+   async def flush(self, batch):
+      if not batch:
+         return
+      try:
+         with metrics.timer("stage_duration_seconds", stage = "stats_write"):
+            await asyncio.to_thread(self.write_batch, batch)
+      except Exception as e:
+         metrics.inc("stats_write_errors_total")
+         log.exception("❌ Ошибка записи статистики: %r", e)
+
+   def write_batch(self, batch):
+      '''Записывает пачку: строки сказок - одним открытием CSV,
+      пользователей - одной транзакцией SQLite'''
+      tale_rows = [data for kind, data in batch if kind == "tale"]
+      users = [data for kind, data in batch if kind == "user"]
+
+      if tale_rows:
+         buffer = io.StringIO()
+         csv.writer(buffer).writerows(tale_rows)
+         with self.open_locked() as f:			#Пачка дописывается целиком, без чужих строк посередине
+            f.write(buffer.getvalue())
+         rows = [dict(zip(TALE_FIELDS, row)) for row in tale_rows]
+         #Каждый процесс учитывает в агрегатах только свои строки
+         self.rollups.add_rows(rows)
+         #История голосов для предсказания выбора
+         self.user_store.add_voices([(row['user_id'], row['voice_type']) for row in rows])
+
+      if users:
+         self.user_store.upsert_many(users)
+      metrics.inc("stats_rows_written_total", len(batch))
+      metrics.inc("stats_flush_total")
+
+      if time.monotonic() >= self.next_rotation_check:
+         self.next_rotation_check = time.monotonic() + 3600
+         self.rotate()
+
+   def open_locked(self):
+      '''Открывает tale_stats.csv на дозапись под монопольной блокировкой.
+      Если пока ждали блокировку, файл ушел в архив (ротация в другом процессе), открываем новый'''
+      while True:
+         f = open(self.tale_csv_path, 'a', newline = '', encoding = 'utf-8')
+         fcntl.flock(f, fcntl.LOCK_EX)
+         try:
+            current = os.stat(self.tale_csv_path).st_ino
+         except FileNotFoundError:
+            current = None
+         if current == os.fstat(f.fileno()).st_ino:
+            if f.tell() == 0:					#Файл создан заново - нужен заголовок
+               csv.writer(f).writerow(TALE_FIELDS)
+            return f
+         f.close()
+
+   def first_day(self):
+      '''Дата первой строки tale_stats.csv (2026-10-18) или None, если строк нет'''
+      with open(self.tale_csv_path, 'r', newline = '', encoding = 'utf-8') as f:
+         f.readline()						#Заголовок
+         return f.readline()[:10] or None
+
+   def rotate(self):
+      '''Переносит tale_stats.csv в архив, когда первой строке больше retention_days дней,
+      сжимает архивы и удаляет устаревшие архивы и почасовые агрегаты'''
+      today = datetime.date.today()
+      if self.retention_days > 0:
+         cutoff = (today - datetime.timedelta(days = self.retention_days)).isoformat()
+         first_day = self.first_day()
+         if first_day and first_day <= cutoff:
+            with self.open_locked() as f:
+               first_day = self.first_day()			#Под блокировкой: другой процесс мог успеть раньше
+               if first_day and first_day <= cutoff:
+                  path = Path(self.tale_csv_path)
+                  name = f"{path.stem}.{first_day}_{today.isoformat()}"	#Даты первой и последней строки
+                  archive = path.with_name(f"{name}.csv")
+                  index = 1
+                  while archive.exists() or archive.with_suffix(".csv.gz").exists():
+                     archive = path.with_name(f"{name}-{index}.csv")
+                     index += 1
+                  tmp_path = f"{path}.{os.getpid()}.tmp"
+                  with open(tmp_path, 'w', newline = '', encoding = 'utf-8') as new:
+                     csv.writer(new).writerow(TALE_FIELDS)
+                  os.rename(path, archive)
+                  os.replace(tmp_path, path)
+                  metrics.inc("stats_rotations_total")
+                  log.info("🗄 %s перенесен в архив %s", path.name, archive.name)
+      self.compress_archives(today)
+      if self.hourly_days > 0:
+         before = datetime.datetime.now() - datetime.timedelta(days = self.hourly_days)
+         self.rollups.prune_hourly(before.strftime("%Y-%m-%dT%H"))
+
+   def compress_archives(self, today):
+      '''Сжимает архивные части CSV и удаляет сжатые архивы старше archive_days дней'''
+      path = Path(self.tale_csv_path)
+      for archive in path.parent.glob(f"{path.stem}.*.csv"):
+         compressed = archive.with_suffix(".csv.gz")
+         tmp_path = f"{compressed}.{os.getpid()}.tmp"
+         try:
+            with open(archive, 'rb') as source, gzip.open(tmp_path, 'wb') as target:
+               shutil.copyfileobj(source, target)
+            os.replace(tmp_path, compressed)
+            archive.unlink()
+         except FileNotFoundError:
+            pass						#Архив уже сжал другой процесс
+      if self.archive_days > 0:
+         cutoff = (today - datetime.timedelta(days = self.archive_days)).isoformat()
+         for compressed in path.parent.glob(f"{path.stem}.*.csv.gz"):
+            if compressed.name.rpartition("_")[2][:10] < cutoff:		#Дата последней строки архива
+               compressed.unlink(missing_ok = True)
+
+   async def stop(self):
+      '''Дописывает все, что осталось в очереди, с fsync'''
+      if self.task is not None:
+         self.queue.put_nowait(None)
+         await self.task
+         self.task = None
+      rest = []
+      while not self.queue.empty():
+         item = self.queue.get_nowait()
+         if item is not None:
+            rest.append(item)
+      await self.flush(rest)
+      await asyncio.to_thread(self.sync)
+
+   def sync(self):
+      '''Сбрасывает записанные данные на диск (fsync)'''
+      with open(self.tale_csv_path, 'a', encoding = 'utf-8') as f:
+         os.fsync(f.fileno())
+      self.user_store.checkpoint()
@@ -0,0 +1,27 @@
+'''Кэш озвучки: вытеснение удаляет аудио, но сохраняет file_id Telegram'''
+
+from audio_cache import AudioCache
+
+def key(text, audio_format = "mp3") -> str:
+   return AudioCache.make_key(text, "alena", "good", "1.0", audio_format)
+
+def test_eviction_keeps_file_id(tmp_path):
+   cache = AudioCache(tmp_path, max_bytes = 250)
+   cache.put(key("sent"), b"a" * 100)
+   cache.set_file_id(key("sent"), "FILE_ID")
+   cache.put(key("unsent"), b"b" * 100)
+   cache.put(key("new"), b"c" * 100)			#300 байт - вытесняется "sent"
+   cache.put(key("newer"), b"d" * 100)			#Дальше - "unsent"; запись "sent" места не занимает
+
+   assert cache.get(key("sent")) is None
+   assert cache.get_file_id(key("sent")) == "FILE_ID"
+   assert not (tmp_path / f"{key('sent')}.audio").exists()
+   assert cache.get(key("unsent")) is None
+   rows = cache.conn.execute("SELECT COUNT(*) FROM entries WHERE key = ?", (key("unsent"),)).fetchone()[0]
+   assert rows == 0					#Без file_id запись удалена целиком
+   assert cache.get(key("new")) == b"c" * 100
+   assert cache.get(key("newer")) == b"d" * 100
+
+def test_format_is_part_of_key():
+   assert key("сказка") == key("сказка", "mp3")
+   assert key("сказка", "mp3") != key("сказка", "oggopus")
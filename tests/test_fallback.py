@@ -0,0 +1,41 @@
+'''Запасная сказка при переполненной очереди DeepSeek: ответы без одобрения модерации в нее не попадают'''
+
+import asyncio
+import importlib
+import os
+import pytest
+
+FORM = {"step": "moderation", "age": "2", "genre": "волшебная сказка", "style": "уютный",
+	"location": "Помойкино", "hero": "Вонючка", "enemy": "Злыдня",
+	"child_name": "Дурындин", "gender": "мальчик"}
+
+class FakeMessage:
+   '''Сообщение пользователя: ответы бота складываются в answers'''
+   def __init__(self):
+      self.answers = []
+
+   async def answer(self, text, **kwargs):
+      self.answers.append(text)
+
+@pytest.fixture(scope = "module")
+def bot_tale(tmp_path_factory):
+   os.environ.setdefault("TELEGRAM_TOKEN", "123456:test")
+   os.environ["DATA_DIR"] = str(tmp_path_factory.mktemp("data"))
+   return importlib.import_module("Bot_tale")
+
+def serve(bot_tale, user_id) -> str:
+   bot_tale.user_data[user_id] = dict(FORM)
+   message = FakeMessage()
+   asyncio.run(bot_tale.serve_fallback_story(message, user_id))
+   return message.answers[0]
+
+def test_unmoderated_answers_are_replaced(bot_tale):
+   story = serve(bot_tale, 1)
+   for stem in ("Вонюч", "Злыдн", "Помойкин", "Дурындин"):
+      assert stem not in story
+   assert "медвежон" in story
+
+def test_approved_answers_are_used(bot_tale):
+   bot_tale.moderation_cache.put(dict(FORM), True, "")
+   story = serve(bot_tale, 2)
+   assert "Дурындин" in story
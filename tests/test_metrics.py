@@ -0,0 +1,43 @@
+'''Метрики: показатели-callback вычисляются в потоке цикла событий, текст форматируется отдельно'''
+
+import asyncio
+import socket
+import threading
+import aiohttp
+from metrics import Metrics, format_metrics, metrics, start_metrics_server
+
+def free_port() -> int:
+   with socket.socket() as sock:
+      sock.bind(("127.0.0.1", 0))
+      return sock.getsockname()[1]
+
+def test_gauge_callbacks_run_on_event_loop():
+   async def scenario():
+      threads = []
+      queue = asyncio.Queue()
+      queue.put_nowait("item")
+      def depth():
+         threads.append(threading.get_ident())
+         return queue.qsize()
+      metrics.gauge("test_queue_depth", depth)
+      port = free_port()
+      runner = await start_metrics_server("127.0.0.1", port)
+      try:
+         async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+               text = await response.text()
+      finally:
+         await runner.cleanup()
+      return threads, threading.get_ident(), text
+   threads, loop_thread, text = asyncio.run(scenario())
+   assert threads == [loop_thread]
+   assert "test_queue_depth 1\n" in text
+
+def test_render_matches_collect_and_format():
+   registry = Metrics()
+   registry.inc("stories_total", genre = "сказка")
+   registry.gauge("cached", lambda: 3)
+   registry.observe("latency_seconds", 0.2)
+   assert registry.render() == format_metrics(registry.collect())
+   assert 'stories_total{genre="сказка"} 1' in registry.render()
+   assert "cached 3" in registry.render()
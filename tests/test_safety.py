@@ -0,0 +1,101 @@
+'''Проверка черного списка: производные слова находятся, безобидные слова из ALLOWED_WORDS - нет'''
+
+import io
+import tokenize
+from pathlib import Path
+import pytest
+import safety
+from safety import DANGEROUS_WORDS, MorphMatcher, find_dangerous_word, normalize_text
+from morphology import get_morph
+
+#Производные слова, которые находил прежний поиск подстрокой
+DERIVED_WORDS = ['террористы', 'порнография', 'нацистский', 'фашистский', 'расистский',
+		 'взрывчатка', 'взрывать', 'алкогольный', 'солдатик', 'пистолетик',
+		 'демонический', 'дьявольский', 'интимный', 'арестант', 'судья',
+		 'президентский', 'депутатский']
+
+#Отдельные слова черного списка, записанные здесь, а не взятые из DANGEROUS_WORDS:
+#склеенная из-за пропущенной запятой строка ('белоусов' 'зеленский') их уже не находит
+STANDALONE_WORDS = ['белоусов', 'зеленский', 'путин', 'убив', 'смерть', 'экстрими', 'исламист', 'героин']
+
+#Безобидные слова, внутри которых есть слово из черного списка
+ALLOWED_SAMPLES = ['посуда', 'из озона', 'богатырь', 'богатый', 'страна', 'виноград',
+		   'команда', 'мандарин', 'опушка леса', 'героиня', 'героини', 'страх',
+		   'попал в беду', 'удрал', 'ножка', 'множество', 'больше', 'судьба',
+		   'баран', 'экрана', 'камин', 'сезона', 'газона', 'трамплин', 'сосуд',
+		   'в записях', 'виноватый', 'судак', 'поймал судака', 'много судеб',
+		   'попадёшь домой', 'ножек', 'на опушке', 'побольше', 'на судне']
+
+#Слова, похожие на безобидные, но не совпадающие с ними целиком: проверяются как обычно
+NOT_ALLOWED_SAMPLES = ['героине', 'о героине', 'героином', 'героинщик', 'посудахуй',
+		       'судаксуд', 'суда', 'судов', 'попа', 'зона', 'озоназона', 'мина',
+		       'минами', 'трамп', 'рана', 'ранами', 'вино', 'боль', 'нож', 'пушка',
+		       'богохульник', 'странаманда']
+
+@pytest.fixture(params = ["substring", "morphology"])
+def find(request):
+   '''Проверка по подстрокам и, если pymorphy2 доступен, с учетом морфологии'''
+   if request.param == "substring":
+      return lambda text: safety.search_dangerous(normalize_text(text))
+   morph = get_morph()
+   if morph is None:
+      pytest.skip("pymorphy2 недоступен")
+   matcher = MorphMatcher(morph)
+   return lambda text: matcher.find(normalize_text(text))
+
+def find_concatenated_literals(path) -> list:
+   '''Соседние строковые литералы внутри DANGEROUS_WORDS (пропущенная запятая)'''
+   source = Path(path).read_text(encoding = 'utf-8')
+   tokens = tokenize.generate_tokens(io.StringIO(source).readline)
+   skip = {tokenize.NL, tokenize.NEWLINE, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT}
+   problems = []
+   inside = False
+   previous = None
+   for token in tokens:
+      if token.type == tokenize.NAME and token.string == "DANGEROUS_WORDS":
+         inside = True
+         continue
+      if not inside or token.type in skip:
+         continue
+      if token.type == tokenize.OP and token.string == "]":
+         break
+      if token.type == tokenize.STRING and previous is not None and previous.type == tokenize.STRING:
+         problems.append(f"строка {token.start[0]}: {previous.string} {token.string}")
+      previous = token
+   return problems
+
+def test_no_concatenated_literals():
+   assert find_concatenated_literals(safety.__file__) == []
+
+def test_concatenated_literals_are_detected(tmp_path):
+   path = tmp_path / "words.py"
+   path.write_text("DANGEROUS_WORDS = ['путин',\n\t'белоусов' 'зеленский']\n", encoding = 'utf-8')
+   assert len(find_concatenated_literals(path)) == 1
+
+@pytest.mark.parametrize("word", DANGEROUS_WORDS)
+def test_every_dangerous_word_is_found(find, word):
+   assert find(word) is not None
+
+@pytest.mark.parametrize("word", STANDALONE_WORDS)
+def test_standalone_words_are_found(find, word):
+   assert find(word) is not None
+
+@pytest.mark.parametrize("word", DERIVED_WORDS)
+def test_derived_words_are_found(find, word):
+   assert find(word) is not None
+
+@pytest.mark.parametrize("text", ALLOWED_SAMPLES)
+def test_allowed_words_pass(find, text):
+   assert find(text) is None
+
+@pytest.mark.parametrize("word", sorted(safety.ALLOWED_WORDS))
+def test_every_allowed_form_passes(find, word):
+   assert find(word) is None
+
+@pytest.mark.parametrize("text", NOT_ALLOWED_SAMPLES)
+def test_allowed_word_does_not_hide_dangerous_one(find, text):
+   assert find(text) is not None
+
+def test_homoglyphs():
+   assert find_dangerous_word("пoлиция") is not None		#Латинская o
+   assert find_dangerous_word("волшебная сказка") is None
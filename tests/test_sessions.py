@@ -0,0 +1,44 @@
+'''Хранилище анкет: отложенная запись и чтение без обращения к базе в цикле событий'''
+
+import asyncio
+import pytest
+from metrics import metrics
+from sessions import PrivacyStore, SessionStore, WriteBehind
+
+def test_write_behind_is_abstract():
+   with pytest.raises(TypeError):
+      WriteBehind()
+
+def test_session_survives_restart(tmp_path):
+   async def scenario():
+      store = SessionStore(tmp_path / "s.sqlite3")
+      store[1] = {"step": "age"}
+      store[1]["age"] = "3-5 лет"
+      store[2] = {"step": "age"}
+      del store[2]
+      await store.stop()
+
+      store = SessionStore(tmp_path / "s.sqlite3")
+      assert store.live_count() == 1
+      assert store.cached(1) is None			#В памяти только индекс
+      reads = metrics.get("sessions_loop_reads_total")
+      await store.preload(1)
+      await store.preload(2)				#Анкеты нет - база не нужна
+      assert store[1] == {"step": "age", "age": "3-5 лет"}
+      assert 2 not in store
+      assert metrics.get("sessions_loop_reads_total") == reads	#Обработчики не читали базу в цикле событий
+      await store.stop()
+   asyncio.run(scenario())
+
+def test_privacy_is_read_from_memory(tmp_path):
+   async def scenario():
+      store = PrivacyStore(tmp_path / "s.sqlite3")
+      store[1] = False
+      store[1] = True
+      await store.stop()
+
+      store = PrivacyStore(tmp_path / "s.sqlite3")
+      store.conn.close()				#Чтение не должно идти в базу
+      assert store[1] is True
+      assert 2 not in store
+   asyncio.run(scenario())
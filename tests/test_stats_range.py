@@ -0,0 +1,28 @@
+'''Разбор периода /stats'''
+
+import datetime
+import pytest
+from stats_store import parse_stats_range
+
+NOW = datetime.datetime(2026, 10, 18, 13, 30)
+
+@pytest.mark.parametrize("text", ["99999999d", "99999999h", "800000д", "0d", "7w", "2026-13-01"])
+def test_bad_ranges_raise_value_error(text):
+   with pytest.raises(ValueError):
+      parse_stats_range(text, NOW, hourly_days = 30)
+
+def test_hours_within_hourly_retention():
+   assert parse_stats_range("24h", NOW, hourly_days = 30) == ("hour", "2026-10-17T14", "2026-10-18T13", "за 24 ч.")
+   assert parse_stats_range("720h", NOW, hourly_days = 30)[0] == "hour"
+
+def test_hours_beyond_hourly_retention_use_days():
+   period, start, end, name = parse_stats_range("1000h", NOW, hourly_days = 30)
+   assert (period, start, end) == ("day", "2026-09-06", "2026-10-18")
+   assert "по дням" in name
+   assert parse_stats_range("1000h", NOW, hourly_days = 0)[0] == "hour"	#Почасовые агрегаты не удаляются
+
+def test_days_and_dates():
+   assert parse_stats_range("7d", NOW) == ("day", "2026-10-12", "2026-10-18", "за 7 дн.")
+   assert parse_stats_range("2026-10-15 2026-10-01", NOW) == ("day", "2026-10-01", "2026-10-15",
+   							      "с 2026-10-01 по 2026-10-15")
+   assert parse_stats_range("", NOW) == ("all", "", "", "за все время")
@@ -0,0 +1,63 @@
+'''Обработчик в режиме worker: обновления одного пользователя обрабатываются по порядку'''
+
+import asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+from webhook import create_app
+
+SETTINGS = {"path": "/update", "secret": "test-secret"}
+HEADERS = {"X-Telegram-Bot-Api-Secret-Token": "test-secret"}
+
+def message_update(update_id, user_id, text) -> dict:
+   return {"update_id": update_id,
+   	   "message": {"message_id": update_id, "date": 0, "text": text,
+   	   	       "chat": {"id": user_id, "type": "private"},
+   	   	       "from": {"id": user_id, "is_bot": False, "first_name": "Test"}}}
+
+async def run_updates(ordered) -> list:
+   '''Отправляет обработчику обновления как принимающий процесс - по одному, дожидаясь ответа.
+   Первое обновление обрабатывается дольше второго'''
+   processed = []
+   done = asyncio.Event()
+   dp = Dispatcher()
+
+   @dp.message()
+   async def handle(message: Message):
+      if message.text == "slow":
+         await asyncio.sleep(0.1)
+      processed.append((message.from_user.id, message.text))
+      if len(processed) == 3:
+         done.set()
+
+   bot = Bot(token = "123456:test")
+   client = TestClient(TestServer(create_app(dp, bot, SETTINGS, ordered = ordered)))
+   await client.start_server()
+   try:
+      for update in (message_update(1, 10, "slow"), message_update(2, 10, "fast"),
+      		     message_update(3, 20, "other")):
+         response = await client.post("/update", json = update, headers = HEADERS)
+         assert response.status == 200
+      await asyncio.wait_for(done.wait(), 5)
+   finally:
+      await client.close()
+      await bot.session.close()
+   return processed
+
+def test_same_user_updates_are_processed_in_order():
+   processed = asyncio.run(run_updates(ordered = True))
+   assert [text for user_id, text in processed if user_id == 10] == ["slow", "fast"]
+   assert processed[0] == (20, "other")				#Другой пользователь не ждет первого
+
+def test_wrong_secret_is_rejected():
+   async def scenario():
+      bot = Bot(token = "123456:test")
+      client = TestClient(TestServer(create_app(Dispatcher(), bot, SETTINGS, ordered = True)))
+      await client.start_server()
+      try:
+         response = await client.post("/update", json = message_update(1, 10, "x"))
+         assert response.status == 401
+      finally:
+         await client.close()
+         await bot.session.close()
+   asyncio.run(scenario())
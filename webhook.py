@@ -0,0 +1,138 @@
+import asyncio			#Для ожидания сигнала остановки
+import logging
+import os			#Для чтения настроек из переменных окружения
+import signal
+import time
+from collections import OrderedDict
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from metrics import metrics
+from workers import update_user_id
+
+log = logging.getLogger(__name__)
+
+#Настройки читаются из окружения при вызове, то есть уже после загрузки .env
+
+def bot_mode() -> str:
+   '''Режим работы: polling (по умолчанию) или webhook; worker - процесс-обработчик (см. workers.py)'''
+   return os.getenv("BOT_MODE", "polling")
+
+def webhook_settings() -> dict:
+   '''Настройки вебхука из переменных окружения WEBHOOK_*'''
+   return {"url": os.getenv("WEBHOOK_URL", ""),			#Внешний адрес бота, например https://bot.example.com
+   	   "path": os.getenv("WEBHOOK_PATH", "/webhook"),
+   	   "secret": os.getenv("WEBHOOK_SECRET", ""),		#Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+   	   "host": os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+   	   "port": int(os.getenv("WEBHOOK_PORT", "8080")),
+   	   "max_connections": int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))}	#Сколько запросов Telegram шлет параллельно
+
+class UpdateDeduplicator(BaseMiddleware):
+   '''Пропускает повторно доставленные обновления (Telegram повторяет запрос,
+   если не получил ответ вовремя). Помнит последние max_size update_id'''
+   def __init__(self, max_size = 10000):
+      self.max_size = max_size
+      self.seen = OrderedDict()
+
+   async def __call__(self, handler, event: Update, data):
+      if event.update_id in self.seen:
+         metrics.inc("updates_duplicate_total")
+         return None
+      self.seen[event.update_id] = None
+      if len(self.seen) > self.max_size:
+         self.seen.popitem(last = False)
+      return await handler(event, data)
+
+class OrderedFeeder:
+   '''Обработка обновлений в фоне с сохранением порядка для каждого пользователя:
+   следующее обновление пользователя ждет окончания предыдущего, разные пользователи
+   обрабатываются параллельно. Порядок задается моментом приема (feed вызывается синхронно)'''
+   def __init__(self, dp: Dispatcher, bot: Bot):
+      self.dp = dp
+      self.bot = bot
+      self.tails = {}				#user_id -> последняя задача пользователя
+      self.tasks = set()			#Ссылки на задачи, чтобы их не собрал сборщик мусора
+
+   def feed(self, update: dict) -> asyncio.Task:
+      user_id = update_user_id(update)
+      task = asyncio.create_task(self.process(update, self.tails.get(user_id)))
+      self.tails[user_id] = task
+      self.tasks.add(task)
+      task.add_done_callback(lambda done: self.finished(user_id, done))
+      return task
+
+   def finished(self, user_id, task):
+      self.tasks.discard(task)
+      if self.tails.get(user_id) is task:
+         del self.tails[user_id]
+
+   async def process(self, update: dict, previous):
+      if previous is not None:
+         await asyncio.wait([previous])		#Ошибка предыдущего обновления не мешает следующему
+      try:
+         result = await self.dp.feed_raw_update(self.bot, update)
+         if isinstance(result, TelegramMethod):
+            await self.dp.silent_call_request(self.bot, result)
+      except Exception as e:
+         log.exception("❌ Ошибка обработки обновления: %r", e)
+
+def create_app(dp: Dispatcher, bot: Bot, settings: dict, ordered = False) -> web.Application:
+   '''Приложение aiohttp: прием обновлений на WEBHOOK_PATH и проверка работоспособности на /health.
+   ordered - обновления одного пользователя обрабатываются строго по очереди (режим worker:
+   принимающий процесс присылает их по порядку, и обработчик не должен его нарушать)'''
+   app = web.Application()
+   started = time.monotonic()
+
+   async def health(request):
+      return web.json_response({"status": "ok",
+      				"mode": "webhook",
+      				"uptime": round(time.monotonic() - started)})
+
+   app.router.add_get("/health", health)
+   if ordered:
+      feeder = OrderedFeeder(dp, bot)
+      secret = settings["secret"]
+
+      async def receive(request):
+         if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status = 401)
+         feeder.feed(await request.json())
+         return web.json_response({})
+
+      app.router.add_post(settings["path"], receive)
+   else:
+      SimpleRequestHandler(dispatcher = dp, bot = bot,
+      			   secret_token = settings["secret"] or None).register(app, path = settings["path"])
+   setup_application(app, dp, bot = bot)
+   return app
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+   '''Запускает сервер и регистрирует вебхук в Telegram (если задан WEBHOOK_URL).
+   Без WEBHOOK_URL сервер принимает обновления только локально - удобно для проверки'''
+   settings = webhook_settings()
+   if settings["url"] and not settings["secret"]:
+      log.warning("⚠️ WEBHOOK_SECRET не задан - запросы к вебхуку не проверяются")
+   runner = web.AppRunner(create_app(dp, bot, settings, ordered = bot_mode() == "worker"))
+   await runner.setup()
+   site = web.TCPSite(runner, settings["host"], settings["port"])
+   await site.start()
+   log.info("🌐 Вебхук слушает %s:%s%s", settings["host"], settings["port"], settings["path"])
+
+   if settings["url"]:
+      await bot.set_webhook(settings["url"].rstrip("/") + settings["path"],
+      			    secret_token = settings["secret"] or None,
+      			    allowed_updates = dp.resolve_used_update_types(),
+      			    max_connections = settings["max_connections"],
+      			    drop_pending_updates = True)
+
+   #Работаем до SIGINT/SIGTERM, затем корректно останавливаем сервер
+   stop = asyncio.Event()
+   loop = asyncio.get_running_loop()
+   for sig in (signal.SIGINT, signal.SIGTERM):
+      loop.add_signal_handler(sig, stop.set)
+   try:
+      await stop.wait()
+   finally:
+      await runner.cleanup()
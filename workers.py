@@ -0,0 +1,241 @@
+import asyncio			#Для процессов-обработчиков и очередей пересылки
+import bisect			#Для поиска на кольце хэшей
+import hashlib
+import json
+import logging
+import os			#Для чтения настроек из переменных окружения
+import secrets			#Для внутреннего ключа между процессами
+import signal
+import sys
+import time
+from collections import OrderedDict
+import aiohttp
+from aiohttp import web
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+WORKER_PATH = "/update"
+
+def worker_settings() -> dict:
+   '''Настройки из окружения; читаются при вызове, то есть уже после загрузки .env'''
+   return {"workers": int(os.getenv("WORKERS", "0")),		#Число процессов-обработчиков; 0 или 1 - обычный режим в одном процессе
+   	   "base_port": int(os.getenv("WORKER_BASE_PORT", "8200"))}	#Обработчик i слушает 127.0.0.1:WORKER_BASE_PORT+i
+
+class HashRing:
+   '''Согласованное хэширование: пользователь всегда попадает к одному обработчику,
+   а при изменении их числа переезжает только примерно 1/N пользователей'''
+   def __init__(self, nodes, replicas = 100):
+      self.ring = []
+      for node in nodes:
+         for replica in range(replicas):			#Виртуальные узлы выравнивают нагрузку
+            self.ring.append((self.hash(f"{node}:{replica}"), node))
+      self.ring.sort()
+      self.keys = [key for key, node in self.ring]
+
+   @staticmethod
+   def hash(value) -> int:
+      return int.from_bytes(hashlib.md5(str(value).encode("utf-8")).digest()[:8], "big")
+
+   def node(self, key):
+      index = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+      return self.ring[index][1]
+
+def update_user_id(update: dict) -> int:
+   '''user_id отправителя обновления (from или chat), 0 - если его нет'''
+   for key, event in update.items():
+      if key == "update_id" or not isinstance(event, dict):
+         continue
+      user = event.get("from") or event.get("user") or event.get("chat")
+      if isinstance(user, dict) and "id" in user:
+         return user["id"]
+   return 0
+
+class Worker:
+   '''Процесс-обработчик: тот же Bot_tale.py в режиме BOT_MODE=worker.
+   Обновления пересылаются ему по одному в порядке поступления'''
+   def __init__(self, index, secret, port):
+      self.index = index
+      self.secret = secret
+      self.port = port
+      self.url = f"http://127.0.0.1:{port}{WORKER_PATH}"
+      self.queue = asyncio.Queue()
+      self.process = None
+      self.stopping = False
+      metrics.gauge("front_queue_depth", self.queue.qsize, worker = str(index))
+
+   async def spawn(self):
+      env = dict(os.environ,
+      		 BOT_MODE = "worker",
+      		 WORKER_INDEX = str(self.index),
+      		 WEBHOOK_HOST = "127.0.0.1",
+      		 WEBHOOK_PORT = str(self.port),
+      		 WEBHOOK_PATH = WORKER_PATH,
+      		 WEBHOOK_SECRET = self.secret,
+      		 WEBHOOK_URL = "")
+      self.process = await asyncio.create_subprocess_exec(sys.executable, sys.argv[0], env = env)
+      log.info("👷 Обработчик %s запущен, pid %s", self.index, self.process.pid)
+
+   async def supervise(self):
+      '''Перезапускает обработчик, если он завершился не по команде'''
+      while not self.stopping:
+         await self.spawn()
+         code = await self.process.wait()
+         if self.stopping:
+            return
+         metrics.inc("worker_restarts_total", worker = str(self.index))
+         log.error("❌ Обработчик %s завершился с кодом %s, перезапуск", self.index, code)
+         await asyncio.sleep(1)
+
+   async def forward(self, session: aiohttp.ClientSession):
+      '''Пересылает обновления из очереди строго по порядку'''
+      headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret,
+      		 "Content-Type": "application/json"}
+      while True:
+         body = await self.queue.get()
+         for attempt in range(60):			#Обработчик может еще запускаться или перезапускаться
+            try:
+               async with session.post(self.url, data = body, headers = headers) as response:
+                  if response.status == 200:
+                     metrics.inc("front_forwarded_total", worker = str(self.index))
+                     break
+                  log.warning("⚠️ Обработчик %s ответил %s", self.index, response.status)
+            except aiohttp.ClientError:
+               pass
+            await asyncio.sleep(0.5)
+         else:
+            metrics.inc("front_dropped_total", worker = str(self.index))
+            log.error("❌ Обновление не доставлено обработчику %s", self.index)
+
+   async def stop(self):
+      self.stopping = True
+      if self.process and self.process.returncode is None:
+         self.process.send_signal(signal.SIGTERM)	#Обработчик дописывает статистику и закрывает сессии
+         try:
+            await asyncio.wait_for(self.process.wait(), 30)
+         except asyncio.TimeoutError:
+            self.process.kill()
+
+class Front:
+   '''Принимающий процесс: получает обновления (long polling или вебхук) и раскладывает
+   их по обработчикам по user_id. Порядок обновлений одного пользователя сохраняется'''
+   def __init__(self, workers_count, base_port):
+      self.secret = secrets.token_urlsafe(24)
+      self.workers = [Worker(index, self.secret, base_port + index) for index in range(workers_count)]
+      self.ring = HashRing(range(workers_count))
+      self.seen = OrderedDict()				#Недавние update_id для отбрасывания повторов
+      self.tasks = []
+
+   def route(self, update: dict, body: bytes = None):
+      update_id = update.get("update_id")
+      if update_id in self.seen:
+         metrics.inc("updates_duplicate_total")
+         return
+      self.seen[update_id] = None
+      if len(self.seen) > 10000:
+         self.seen.popitem(last = False)
+      worker = self.workers[self.ring.node(update_user_id(update))]
+      worker.queue.put_nowait(body or json.dumps(update, ensure_ascii = False).encode("utf-8"))
+
+   async def start(self):
+      #Без ограничения соединений: у каждого обработчика своя очередь и одно соединение
+      self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = 0))
+      for worker in self.workers:
+         self.tasks.append(asyncio.create_task(worker.supervise()))
+         self.tasks.append(asyncio.create_task(worker.forward(self.session)))
+
+   async def stop(self):
+      await asyncio.gather(*(worker.stop() for worker in self.workers))
+      for task in self.tasks:
+         task.cancel()
+      await self.session.close()
+
+   async def poll(self, api_url, token, allowed_updates):
+      '''Long polling getUpdates без разбора обновлений в объекты aiogram'''
+      url = f"{api_url.rstrip('/')}/bot{token}/getUpdates"
+      offset = None
+      timeout = aiohttp.ClientTimeout(total = 60)
+      async with aiohttp.ClientSession(timeout = timeout) as session:
+         while True:
+            params = {"timeout": 30, "allowed_updates": json.dumps(allowed_updates)}
+            if offset is not None:
+               params["offset"] = offset
+            try:
+               async with session.get(url, params = params) as response:
+                  result = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+               log.warning("Ошибка getUpdates: %r", e)
+               await asyncio.sleep(1)
+               continue
+            if not result.get("ok"):
+               log.warning("Ошибка getUpdates: %s", result)
+               await asyncio.sleep(result.get("parameters", {}).get("retry_after", 1))
+               continue
+            for update in result["result"]:
+               offset = update["update_id"] + 1
+               self.route(update)
+
+   def create_app(self, path, secret) -> web.Application:
+      '''Вебхук принимающего процесса'''
+      app = web.Application()
+      started = time.monotonic()
+
+      async def receive(request):
+         if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status = 401)
+         body = await request.read()
+         self.route(json.loads(body), body)
+         return web.Response()
+
+      async def health(request):
+         alive = sum(1 for worker in self.workers
+         	     if worker.process and worker.process.returncode is None)
+         return web.json_response({"status": "ok" if alive == len(self.workers) else "degraded",
+         			   "mode": "front",
+         			   "workers": len(self.workers),
+         			   "workers_alive": alive,
+         			   "uptime": round(time.monotonic() - started)})
+
+      app.router.add_post(path, receive)
+      app.router.add_get("/health", health)
+      return app
+
+async def run_front(bot, dp, mode, api_url):
+   '''Запускает WORKERS обработчиков и принимает для них обновления.
+   mode - polling или webhook (настройки вебхука те же, что в одиночном режиме)'''
+   from webhook import webhook_settings
+   settings = webhook_settings()
+   workers = worker_settings()
+   front = Front(workers["workers"], workers["base_port"])
+   await front.start()
+   allowed_updates = dp.resolve_used_update_types()
+   stop = asyncio.Event()
+   loop = asyncio.get_running_loop()
+   for sig in (signal.SIGINT, signal.SIGTERM):
+      loop.add_signal_handler(sig, stop.set)
+   runner = None
+   try:
+      if mode == "webhook":
+         runner = web.AppRunner(front.create_app(settings["path"], settings["secret"]))
+         await runner.setup()
+         await web.TCPSite(runner, settings["host"], settings["port"]).start()
+         log.info("🌐 Вебхук слушает %s:%s%s, обработчиков: %s",
+         	  settings["host"], settings["port"], settings["path"], workers["workers"])
+         if settings["url"]:
+            await bot.set_webhook(settings["url"].rstrip("/") + settings["path"],
+            			  secret_token = settings["secret"] or None,
+            			  allowed_updates = allowed_updates,
+            			  max_connections = settings["max_connections"],
+            			  drop_pending_updates = True)
+         await stop.wait()
+      else:
+         await bot.delete_webhook(drop_pending_updates = True)
+         log.info("Получаем обновления (long polling), обработчиков: %s", workers["workers"])
+         poller = asyncio.create_task(front.poll(api_url, bot.token, allowed_updates))
+         await stop.wait()
+         poller.cancel()
+   finally:
+      if runner is not None:
+         await runner.cleanup()
+      await front.stop()
+      await bot.session.close()